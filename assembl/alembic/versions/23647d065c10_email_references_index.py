@@ -0,0 +1,60 @@
+"""email references index
+
+Revision ID: 23647d065c10
+Revises: cc4fe855cd8c
+Create Date: 2017-03-15 10:12:44.310528
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '23647d065c10'
+down_revision = 'cc4fe855cd8c'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            "email_reference",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("email_id", sa.Integer, sa.ForeignKey(
+                "email.id", ondelete="CASCADE", onupdate="CASCADE"),
+                nullable=False, index=True),
+            sa.Column("position", sa.SmallInteger, nullable=False),
+            sa.Column("message_id", sa.Unicode, nullable=False, index=True))
+
+    # Index the references of existing emails
+    from email.parser import HeaderParser
+    from assembl import models as m
+    from assembl.models.mail import email_references
+    from assembl.lib.sqla import mark_changed
+    db = m.get_session_maker()()
+    reference_t = m.EmailReference.__table__
+    parser = HeaderParser()
+    with transaction.manager:
+        emails = db.query(m.Email.id, m.Email.imported_blob).yield_per(1000)
+        rows = []
+        for (email_id, blob) in emails:
+            if not blob:
+                continue
+            references = email_references(parser.parsestr(blob))
+            rows.extend(dict(email_id=email_id, position=position,
+                             message_id=message_id)
+                        for (position, message_id) in enumerate(references))
+            if len(rows) >= 1000:
+                db.execute(reference_t.insert(), rows)
+                rows = []
+        if rows:
+            db.execute(reference_t.insert(), rows)
+        mark_changed()
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table("email_reference")
@@ -0,0 +1,49 @@
+"""idea post counts cache
+
+Revision ID: 3c0c8d7a5b21
+Revises: 498e7af689d2
+Create Date: 2017-03-02 11:24:08.511390
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c0c8d7a5b21'
+down_revision = '498e7af689d2'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            "idea_post_count",
+            sa.Column("idea_id", sa.Integer, sa.ForeignKey(
+                "idea.id", ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True),
+            sa.Column("discussion_id", sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete="CASCADE", onupdate="CASCADE"),
+                nullable=False, index=True),
+            sa.Column("num_posts", sa.Integer, nullable=False))
+        op.create_table(
+            "idea_read_post_count",
+            sa.Column("idea_id", sa.Integer, sa.ForeignKey(
+                "idea.id", ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True),
+            sa.Column("user_id", sa.Integer, sa.ForeignKey(
+                "user.id", ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True),
+            sa.Column("discussion_id", sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete="CASCADE", onupdate="CASCADE"),
+                nullable=False, index=True),
+            sa.Column("num_read_posts", sa.Integer, nullable=False))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table("idea_read_post_count")
+        op.drop_table("idea_post_count")
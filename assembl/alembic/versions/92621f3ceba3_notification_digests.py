@@ -0,0 +1,51 @@
+"""notification digests
+
+Revision ID: 92621f3ceba3
+Revises: 3c0c8d7a5b21
+Create Date: 2017-03-09 10:12:31.208417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '92621f3ceba3'
+down_revision = '3c0c8d7a5b21'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    from assembl.models.notification import (
+        Notification, NotificationPushMethodType, NotificationDigestFrequency)
+    with context.begin_transaction():
+        op.add_column("notification_subscription", sa.Column(
+            "digest_frequency", NotificationDigestFrequency.db_type(),
+            nullable=False,
+            server_default=NotificationDigestFrequency.IMMEDIATE.name))
+        tname = "notification"
+        cname = 'ck_%s_%s_%s_notification_push_method_type' % (
+            config.get('db_schema'), config.get('db_user'), tname)
+        op.drop_constraint(cname, tname)
+        op.create_check_constraint(
+            cname, tname, Notification.push_method.in_(
+                NotificationPushMethodType.values()))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        # Digested notifications become immediate email notifications
+        op.execute(
+            "UPDATE notification SET push_method = 'EMAIL'"
+            " WHERE push_method = 'EMAIL_DIGEST'")
+        tname = "notification"
+        cname = 'ck_%s_%s_%s_notification_push_method_type' % (
+            config.get('db_schema'), config.get('db_user'), tname)
+        op.drop_constraint(cname, tname)
+        op.create_check_constraint(
+            cname, tname, sa.column('push_method').in_(
+                ['EMAIL', 'LOGIN_NOTIFICATION']))
+        op.drop_column("notification_subscription", "digest_frequency")
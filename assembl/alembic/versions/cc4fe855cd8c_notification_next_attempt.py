@@ -0,0 +1,46 @@
+"""notification retry scheduling
+
+Revision ID: cc4fe855cd8c
+Revises: 92621f3ceba3
+Create Date: 2017-03-13 15:41:07.662094
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'cc4fe855cd8c'
+down_revision = '92621f3ceba3'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def index_name():
+    return "ix_%s_%s_notification_next_attempt" % (
+        config.get('db_schema'), config.get('db_user'))
+
+
+def upgrade(pyramid_env):
+    from assembl.models.notification import NotificationDeliveryStateType
+    with context.begin_transaction():
+        op.add_column("notification", sa.Column(
+            "delivery_attempts", sa.Integer, nullable=False,
+            server_default='0'))
+        op.add_column("notification", sa.Column(
+            "next_attempt", sa.DateTime, nullable=True))
+        states = ", ".join(
+            "'%s'" % state.value for state in
+            NotificationDeliveryStateType.getRetryableDeliveryStates())
+        op.execute("""UPDATE notification SET next_attempt = creation_date
+            WHERE delivery_state IN (%s)""" % (states,))
+        op.create_index(index_name(), "notification", ["next_attempt"])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index(index_name(), "notification")
+        op.drop_column("notification", "next_attempt")
+        op.drop_column("notification", "delivery_attempts")
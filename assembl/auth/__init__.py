@@ -1,6 +1,7 @@
 """Utility modules for permissions and authentication
 
 This module defines basic roles and permissions."""
+from threading import Lock
 
 from pyramid.security import (
     Everyone, Authenticated, ALL_PERMISSIONS)
@@ -50,6 +51,90 @@ ASSEMBL_PERMISSIONS = set((
     P_ADMIN_DISC, P_SYSADMIN, P_READ_PUBLIC_CIF,
     P_EXPORT_EXTERNAL_SOURCE, P_MODERATE, P_DISC_STATS))
 
+# Each permission is a bit in a :py:class:`PermissionSet`
+PERMISSION_BITS = {
+    name: 1 << i for (i, name) in enumerate(sorted(ASSEMBL_PERMISSIONS))}
+PERMISSION_NAMES = {bit: name for (name, bit) in PERMISSION_BITS.iteritems()}
+_permission_bits_lock = Lock()
+
+
+def permission_bit(name):
+    "The bit of a permission, allocated on demand for unknown permissions"
+    bit = PERMISSION_BITS.get(name, None)
+    if bit is None:
+        with _permission_bits_lock:
+            bit = PERMISSION_BITS.get(name, None)
+            if bit is None:
+                bit = 1 << len(PERMISSION_BITS)
+                PERMISSION_BITS[name] = bit
+                PERMISSION_NAMES[bit] = name
+    return bit
+
+
+def permission_bits(names):
+    bits = 0
+    for name in names:
+        bits |= permission_bit(name)
+    return bits
+
+
+class PermissionSet(list):
+    """A list of permission names, with the corresponding bitset.
+
+    Membership tests and merging use the bitset. It is still a list,
+    so it can be extended and serialized like the lists it replaces."""
+    __slots__ = ('_bits',)
+
+    def __init__(self, names=(), bits=None):
+        super(PermissionSet, self).__init__(names)
+        if bits is None and isinstance(names, PermissionSet):
+            bits = names._bits
+        self._bits = bits
+
+    @classmethod
+    def from_bits(cls, bits):
+        return cls([PERMISSION_NAMES[1 << i]
+                    for i in range(bits.bit_length()) if bits & (1 << i)],
+                   bits)
+
+    @property
+    def bits(self):
+        if self._bits is None:
+            self._bits = permission_bits(self)
+        return self._bits
+
+    def __contains__(self, name):
+        # Computing the bits allocates those of unknown permissions
+        bits = self.bits
+        bit = PERMISSION_BITS.get(name, None)
+        return bit is not None and bool(bits & bit)
+
+    def union(self, other):
+        "A new set with the permissions of both"
+        if not isinstance(other, PermissionSet):
+            other = PermissionSet(other)
+        return PermissionSet.from_bits(self.bits | other.bits)
+
+    __or__ = union
+
+
+def _permission_set_mutator(name):
+    method = getattr(list, name)
+
+    def mutate(self, *args):
+        result = method(self, *args)
+        self._bits = None
+        return result
+    mutate.__name__ = name
+    return mutate
+
+
+# Mutations invalidate the bitset
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', '__setitem__',
+              '__delitem__', '__iadd__', '__setslice__', '__delslice__'):
+    setattr(PermissionSet, _name, _permission_set_mutator(_name))
+del _name
+
 
 class CrudPermissions(object):
     """A set of permissions required to Create, Read, Update or Delete
@@ -60,7 +145,7 @@ class CrudPermissions(object):
     Special permissions can be defined if you *own* this
     instance, according to :py:meth:`assembl.lib.sqla.BaseOps.is_owned`"""
     __slots__ = ('create', 'read', 'update', 'delete',
-                 'read_owned', 'update_owned', 'delete_owned')
+                 'read_owned', 'update_owned', 'delete_owned', '_bits')
 
     CREATE = 1
     READ = 2
@@ -76,8 +161,23 @@ class CrudPermissions(object):
         self.read_owned = read_owned or self.read
         self.update_owned = update_owned or self.update
         self.delete_owned = delete_owned or self.delete
+        self._bits = {
+            operation: tuple(permission_bit(name) for name in
+                             self.crud_permissions(operation))
+            for operation in (
+                self.CREATE, self.READ, self.UPDATE, self.DELETE)}
 
     def can(self, operation, permissions):
+        if isinstance(permissions, PermissionSet):
+            bits = permissions.bits
+            if bits & PERMISSION_BITS[P_SYSADMIN]:
+                return True
+            needed, needed_owned = self._bits[operation]
+            if bits & needed:
+                return True
+            elif bits & needed_owned:
+                return IF_OWNED
+            return False
         if P_SYSADMIN in permissions:
             return True
         needed, needed_owned = self.crud_permissions(operation)
@@ -101,4 +201,8 @@ class CrudPermissions(object):
 
 
 def includeme(config):
+    from .util import configure_permissions_cache
+    settings = config.get_settings()
+    configure_permissions_cache(
+        int(settings.get('auth.permissions_cache_ttl', 60)))
     config.include('.social_auth')
@@ -1,19 +1,25 @@
 """Sundry utility functions having to do with users or permissions"""
+from collections import defaultdict
 from csv import reader
 from datetime import datetime, timedelta
 from os import urandom
 import base64
 
+from sqlalchemy import event
+from sqlalchemy.orm.session import Session
 from sqlalchemy.sql.expression import and_
 from pyramid.security import (
     authenticated_userid, Everyone, Authenticated)
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.threadlocal import get_current_request
+from repoze.lru import ExpiringLRUCache
 from pyisemail import is_email
 from pyramid.authentication import SessionAuthenticationPolicy
 
 from assembl.lib.locale import _
 from ..lib.sqla import get_session_maker
-from . import R_SYSADMIN, P_READ, SYSTEM_ROLES
+from . import (
+    R_SYSADMIN, P_READ, SYSTEM_ROLES, PermissionSet, permission_bit)
 from .password import verify_data_token, Validity
 from ..models.auth import (
     User, Role, UserRole, LocalUserRole, Permission,
@@ -27,7 +33,98 @@ def get_user(request):
         return User.get(logged_in)
 
 
-def get_roles(user_id, discussion_id=None):
+# Roles and permissions are memoized within a request, and cached across
+# requests for PERMISSIONS_CACHE_TTL seconds. Changes made in this process
+# invalidate the cache; other processes see them when their entries expire.
+PERMISSIONS_CACHE_TTL = 60
+_permissions_cache = ExpiringLRUCache(10000, PERMISSIONS_CACHE_TTL)
+_INVALIDATED_KEY = 'invalidated_permissions'
+
+
+def configure_permissions_cache(ttl):
+    global PERMISSIONS_CACHE_TTL, _permissions_cache
+    PERMISSIONS_CACHE_TTL = ttl
+    _permissions_cache = ExpiringLRUCache(10000, ttl)
+
+
+def _as_id(id):
+    "Database ids may be given as strings"
+    if isinstance(id, basestring) and id.isdigit():
+        return int(id)
+    return id
+
+
+def _cached(kind, compute, copy=list):
+    """Decorate a function of (user_id, discussion_id) with the caches.
+
+    Cached values are never returned, only a `copy` of them."""
+    def cached_function(user_id, discussion_id=None):
+        key = (kind, _as_id(user_id), _as_id(discussion_id))
+        request = get_current_request()
+        memo = None
+        if request is not None:
+            memo = getattr(request, '_permissions_memo', None)
+            if memo is None:
+                memo = request._permissions_memo = {}
+            elif key in memo:
+                return copy(memo[key])
+        result = None
+        if PERMISSIONS_CACHE_TTL:
+            result = _permissions_cache.get(key)
+        if result is None:
+            result = compute(user_id, discussion_id)
+            if PERMISSIONS_CACHE_TTL:
+                _permissions_cache.put(key, result)
+        if memo is not None:
+            memo[key] = result
+        return copy(result)
+    cached_function.__name__ = compute.__name__
+    cached_function.__doc__ = compute.__doc__
+    cached_function.uncached = compute
+    return cached_function
+
+
+def _invalidate(keys):
+    if keys is None:
+        _permissions_cache.clear()
+    else:
+        for (user_id, discussion_id) in keys:
+            for kind in ('roles', 'permissions'):
+                _permissions_cache.invalidate((kind, user_id, discussion_id))
+    request = get_current_request()
+    if request is not None:
+        request._permissions_memo = None
+
+
+def invalidate_permissions(session, user_id=None, discussion_id=None):
+    """Drop the cached roles and permissions of the user in the discussion,
+    or all of them if either is unknown.
+
+    Called when roles or permissions change. The invalidation is repeated
+    when the transaction ends, in case values read in the meantime
+    have been rolled back."""
+    keys = None
+    if user_id and discussion_id:
+        keys = {(_as_id(user_id), _as_id(discussion_id))}
+    _invalidate(keys)
+    # None means everything
+    invalidated = session.info.setdefault(_INVALIDATED_KEY, set())
+    if keys is None or invalidated is None:
+        session.info[_INVALIDATED_KEY] = None
+    else:
+        invalidated.update(keys)
+
+
+def _end_transaction_listener(session):
+    if _INVALIDATED_KEY in session.info:
+        _invalidate(session.info.pop(_INVALIDATED_KEY))
+
+
+event.listen(Session, 'after_commit', _end_transaction_listener)
+event.listen(Session, 'after_rollback', _end_transaction_listener)
+
+
+def _get_roles(user_id, discussion_id=None):
     if user_id in SYSTEM_ROLES:
         return [user_id]
     session = get_session_maker()()
@@ -43,45 +140,62 @@ def get_roles(user_id, discussion_id=None):
     return [x[0] for x in roles.distinct()]
 
 
-def get_permissions(user_id, discussion_id):
+get_roles = _cached('roles', _get_roles)
+
+
+def _process_cached(key, compute):
+    result = None
+    if PERMISSIONS_CACHE_TTL:
+        result = _permissions_cache.get(key)
+    if result is None:
+        result = compute()
+        if PERMISSIONS_CACHE_TTL:
+            _permissions_cache.put(key, result)
+    return result
+
+
+def _all_permissions():
+    def compute():
+        session = get_session_maker()()
+        return PermissionSet([x for (x,) in session.query(Permission.name)])
+    return _process_cached(('all_permissions',), compute)
+
+
+def discussion_role_permissions(discussion_id):
+    """The permissions of each role in the discussion, as a dictionary
+    role name -> bitset (see :py:class:`assembl.auth.PermissionSet`)"""
+    def compute():
+        session = get_session_maker()()
+        acl = defaultdict(int)
+        for (role, permission) in session.query(
+                Role.name, Permission.name).select_from(
+                DiscussionPermission).join(Role, Permission).filter(
+                DiscussionPermission.discussion_id == discussion_id):
+            acl[role] |= permission_bit(permission)
+        return dict(acl)
+    return _process_cached(('acl', _as_id(discussion_id)), compute)
+
+
+def _get_permissions(user_id, discussion_id):
     user_id = user_id or Everyone
-    session = get_session_maker()()
     if user_id == Everyone:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id)
-                & (Role.name == user_id))
+        roles = (Everyone, )
     elif user_id == Authenticated:
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role).filter(
-                (DiscussionPermission.discussion_id == discussion_id)
-                & (Role.name.in_((Authenticated, Everyone))))
+        roles = (Authenticated, Everyone)
     else:
-        sysadmin = session.query(UserRole).filter_by(
-            user_id=user_id).join(Role).filter_by(name=R_SYSADMIN).first()
-        if sysadmin:
-            return [x[0] for x in session.query(Permission.name).all()]
-        if not discussion_id:
-            return []
-        permissions = session.query(Permission.name).join(
-            DiscussionPermission, Role, UserRole).filter(
-                UserRole.user_id == user_id,
-                DiscussionPermission.discussion_id == discussion_id
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role, LocalUserRole).filter(and_(
-                    LocalUserRole.user_id == user_id,
-                    LocalUserRole.requested == False,
-                    LocalUserRole.discussion_id == discussion_id,
-                    DiscussionPermission.discussion_id == discussion_id))
-            ).union(session.query(Permission.name).join(
-                DiscussionPermission, Role).filter(and_(
-                    DiscussionPermission.discussion_id == discussion_id,
-                    Role.name.in_((Authenticated, Everyone)))))
-    return [x[0] for x in permissions.distinct()]
+        if R_SYSADMIN in get_roles(user_id):
+            return _all_permissions()
+        roles = get_roles(user_id, discussion_id) + [Authenticated, Everyone]
+    if not discussion_id:
+        return PermissionSet()
+    acl = discussion_role_permissions(discussion_id)
+    bits = 0
+    for role in roles:
+        bits |= acl.get(role, 0)
+    return PermissionSet.from_bits(bits)
+
+
+get_permissions = _cached('permissions', _get_permissions, PermissionSet)
 
 
 def discussion_from_request(request):
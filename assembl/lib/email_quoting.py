@@ -0,0 +1,356 @@
+# coding=UTF-8
+"""Strip the quoted previous messages from the body of emails.
+
+Patterns are compiled once, at import. Plain text is scanned line by line
+with a combined regex that rejects lines which cannot start a quote
+announcement; HTML is parsed once and walked once, collecting the
+candidates of every quoting style, instead of running an XPath query per
+style on the whole document.
+"""
+import re
+
+from lxml import html, etree
+
+
+#To be considered matching, each line must match successive lines, in order
+quote_announcement_lines_regexes = {
+    'generic_original_message':  {
+                'announceLinesRegexes': [re.compile("/-+\s*Original Message\s*-+/")],
+                'quotePrefixRegex': re.compile(r"^>\s|^>$")
+            },
+    'gmail_fr_circa_2012':  {
+                'announceLinesRegexes': [re.compile(r"^Le .*, .*<.*@.*> a écrit :")],# 2012 Le 6 juin 2011 15:43, <nicolas.decordes@orange-ftgroup.com> a écrit :
+                'quotePrefixRegex': re.compile(r"^>\s|^>$")
+            },
+    'gmail_en_circa_2014':  {
+                'announceLinesRegexes': [re.compile(r"^\d{4}-\d{2}-\d{2}.*<.*@.*>:")],# 2014-06-17 10:32 GMT-04:00 Benoit Grégoire <benoitg@coeus.ca>:
+                'quotePrefixRegex': re.compile(r"^>\s|^>$")
+            },
+    'outlook_fr_circa_2012':  {
+                'announceLinesRegexes': [re.compile(r"^\d{4}-\d{2}-\d{2}.*<.*@.*>:")],# 2014-06-17 10:32 GMT-04:00 Benoit Grégoire <benoitg@coeus.ca>:
+                'quotePrefixRegex': re.compile(r"^>\s|^>$")
+            },
+    'outlook_fr_multiline_circa_2012': {
+                'announceLinesRegexes': [re.compile(r"^_+$"), #________________________________
+                                        re.compile(r"^\s*$"), #Only whitespace
+                                        re.compile(r"^De :.*$"),
+                                        re.compile(r"^Envoy.+ :.*$"),
+                                        re.compile(r"^À :.*$"),
+                                        re.compile(r"^Objet :.*$"),
+                                        ],
+                'quotePrefixRegex': re.compile(r"^.*$")
+            },
+    'outlook_en_multiline_circa_2012': {
+                'announceLinesRegexes': [re.compile(r"^_+$"), #________________________________
+                                        re.compile(r"^\s*$"), #Only whitespace
+                                        re.compile(r"^From:.*$"),
+                                        re.compile(r"^Sent:.*$"),
+                                        re.compile(r"^To:.*$"),
+                                        re.compile(r"^Subject:.*$"),
+                                        ],
+                'quotePrefixRegex': re.compile(r"^.*$")
+            },
+    }
+
+# Announcement styles, in the order they are tried
+_announcement_keys = quote_announcement_lines_regexes.keys()
+_announcement_lines = [
+    quote_announcement_lines_regexes[key]['announceLinesRegexes']
+    for key in _announcement_keys]
+
+# Matches the lines that match the first line of any announcement
+_announcement_start_regex = re.compile("|".join(set(
+    "(?:%s)" % (lines[0].pattern,) for lines in _announcement_lines)))
+
+_default_quote_prefix_regex = re.compile(r"^>\s|^>$")
+_whitespace_line_regex = re.compile(r"^\s*$")
+
+
+class LineState:
+    Normal = "Normal"
+    PrefixedQuote = 'PrefixedQuote'
+    PotentialQuoteAnnounce = 'PotentialQuoteAnnounce'
+    QuoteAnnounceLastLine = 'QuoteAnnounceLastLine'
+    AllWhiteSpace = 'AllWhiteSpace'
+
+
+def _check_quote_announcement_lines_match(
+        currentQuoteAnnounce, keysStillMatching, lineToMatch):
+    """Advance the announcement styles that still match with the next line.
+
+    :returns: (the key of the announcement completed by this line, or False,
+        the indices of the styles that still match)"""
+    nextIndexToMatch = len(currentQuoteAnnounce)
+    if not keysStillMatching:
+        #Restart from scratch
+        if nextIndexToMatch == 0 and \
+                not _announcement_start_regex.match(lineToMatch):
+            # No announcement starts here: skip trying them one by one
+            return False, []
+        keysStillMatching = range(len(_announcement_lines))
+    matchComplete = False
+    stillMatching = []
+    for index in keysStillMatching:
+        lines = _announcement_lines[index]
+        if len(lines) > nextIndexToMatch:
+            if lines[nextIndexToMatch].match(lineToMatch):
+                if len(lines) - 1 == nextIndexToMatch:
+                    matchComplete = _announcement_keys[index]
+            else:
+                continue
+        stillMatching.append(index)
+    if stillMatching:
+        currentQuoteAnnounce.append(lineToMatch)
+    return matchComplete, stillMatching
+
+
+def strip_full_message_quoting_plaintext(message_body):
+    """Assumes any encoding conversions have already been done
+    """
+    #Most useful to develop this:
+    #http://www.motobit.com/util/quoted-printable-decoder.asp
+    debug = False
+    quote_prefix_regex = _default_quote_prefix_regex
+    whitespace_line_regex = _whitespace_line_regex
+    retval = []
+    currentQuoteAnnounce = []
+    keysStillMatching = []
+    currentQuote = []
+    currentWhiteSpace = []
+
+    previous_line_state = LineState.Normal
+    line_state = LineState.Normal
+    for line in message_body.splitlines():
+        previous_line_state = line_state
+
+        (matchComplete, keysStillMatching) = _check_quote_announcement_lines_match(
+            currentQuoteAnnounce, keysStillMatching, line)
+        if matchComplete:
+            line_state = LineState.QuoteAnnounceLastLine
+            quote_prefix_regex = quote_announcement_lines_regexes[
+                _announcement_keys[keysStillMatching[0]]]['quotePrefixRegex']
+        elif keysStillMatching:
+            line_state = LineState.PotentialQuoteAnnounce
+        elif quote_prefix_regex.match(line):
+            line_state = LineState.PrefixedQuote
+        elif whitespace_line_regex.match(line):
+            line_state = LineState.AllWhiteSpace
+        else:
+            line_state = LineState.Normal
+        if line_state == LineState.Normal:
+            if((previous_line_state != LineState.AllWhiteSpace) & len(currentWhiteSpace) > 0):
+                retval += currentWhiteSpace
+                currentWhiteSpace = []
+            if currentQuote:
+                retval += currentQuoteAnnounce
+                retval += currentQuote
+                currentQuote = []
+                currentQuoteAnnounce = []
+            if(previous_line_state == LineState.AllWhiteSpace):
+                retval += currentWhiteSpace
+                currentWhiteSpace = []
+            retval.append(line)
+        elif line_state == LineState.PrefixedQuote:
+            currentQuote.append(line)
+        elif line_state == LineState.QuoteAnnounceLastLine:
+            currentQuoteAnnounce = []
+        elif line_state == LineState.AllWhiteSpace:
+            currentWhiteSpace.append(line)
+        if debug:
+            print "%-30s %s" % (line_state, line)
+    #We just let trailing quotes and whitespace die...
+    return '\n'.join(retval)
+
+
+# The HTML patterns are matched like the EXSLT regular expressions
+# of lxml would: unicode, with search.
+
+##Trying to match:  Le 6 juin 2011 à 11:02, Jean-Michel Cornu a écrit :
+_old_applemail_announce_regex = re.compile(
+    r'^.*Le .*\d{4} .*:\d{2}, .* a .*crit :.*$', re.UNICODE | re.IGNORECASE)
+
+# Outlook headers, when outlook gives NO usable structure
+_outlook_header_regexes = [
+    re.compile('|'.join(patterns), re.UNICODE) for patterns in (
+        ['^From:.*$', '^De :.*$'],
+        ['^Sent:.*$', '^Envoy.+ :.*$'],
+        ['^To:.*$', '^.+:.*$'],  #Trying to match À
+        ['^Subject:.*$', '^Objet :.*$'],
+    )]
+_all_outlook_headers = (1 << len(_outlook_header_regexes)) - 1
+
+_class_space_regex = re.compile(r'[ \t\r\n]+')
+
+
+def _first_text(element):
+    "The first text node child of the element, like text() in XPath."
+    if element.text:
+        return element.text
+    for child in element:
+        if child.tail:
+            return child.tail
+    return None
+
+
+def _has_class(element, class_name):
+    "Like lxml's find_class: class_name is one of the element's classes."
+    classes = element.get('class')
+    return classes is not None and (' %s ' % class_name) in (
+        ' %s ' % _class_space_regex.sub(' ', classes))
+
+
+def _class_contains(element, substring):
+    return substring in (element.get('class') or '')
+
+
+def _add_once(elements, element):
+    "Add to a list used as an ordered node set."
+    if not any(e is element for e in elements):
+        elements.append(element)
+
+
+class _QuoteCandidates(object):
+    """The elements that each quoting style would strip, gathered in a single
+    walk of the document."""
+
+    def __init__(self, doc):
+        self.gmail = []
+        self.applemail = []
+        self.old_applemail = []
+        self.outlook = []
+        self.outlook_unstructured = []
+        self.thunderbird = []
+        in_doc = False
+        # Which outlook headers are found under each open element
+        header_masks = []
+        for (event, element) in etree.iterwalk(
+                doc.getroottree().getroot(), events=('start', 'end')):
+            if not isinstance(element.tag, basestring):
+                continue
+            if event == 'start':
+                if element is doc:
+                    in_doc = True
+                self.start(element, in_doc)
+                header_masks.append(0)
+                continue
+            if element is doc:
+                in_doc = False
+            descendant_headers = header_masks.pop()
+            if element.tag == 'div' and \
+                    descendant_headers == _all_outlook_headers:
+                self.outlook_unstructured.append(element)
+            if header_masks:
+                header_masks[-1] |= descendant_headers | self.headers(element)
+
+    def start(self, element, in_doc):
+        tag = element.tag
+        if in_doc and not self.gmail and _has_class(element, 'gmail_quote'):
+            self.gmail.append(element)
+        if tag == 'blockquote':
+            parent = element.getparent()
+            if 'cite' in (element.get('type') or ''):
+                if parent is not None and any(
+                        sibling.tag == 'br' and _class_contains(
+                            sibling, 'Apple-interchange-newline')
+                        for sibling in element.itersiblings(preceding=True)):
+                    grandparent = parent.getparent()
+                    if grandparent is not None:
+                        _add_once(self.applemail, grandparent)
+                if element.get('cite') is not None:
+                    self.thunderbird.append(element)
+            if parent is not None and parent.tag == 'body' and any(
+                    child.tag == 'div' and _class_contains(
+                        child, 'OutlookMessageHeader')
+                    for child in element):
+                self.outlook.append(element)
+        elif tag == 'div':
+            parent = element.getparent()
+            text = _first_text(element)
+            if parent is not None and text and \
+                    _old_applemail_announce_regex.search(text) and any(
+                        sibling.tag == 'br' and _class_contains(
+                            sibling, 'Apple-interchange-newline')
+                        for sibling in element.itersiblings()):
+                _add_once(self.old_applemail, parent)
+
+    @staticmethod
+    def headers(element):
+        "Which outlook headers the first text of the element matches."
+        text = _first_text(element)
+        mask = 0
+        # All headers have a colon
+        if text and ':' in text:
+            for index, regex in enumerate(_outlook_header_regexes):
+                if regex.search(text):
+                    mask |= 1 << index
+        return mask
+
+
+def strip_full_message_quoting_html(message_body):
+    """Assumes any encoding conversions have already been done
+    """
+    #Most useful to develop this:
+    #http://www.motobit.com/util/quoted-printable-decoder.asp
+    #http://www.freeformatter.com/html-formatter.html
+    #http://www.freeformatter.com/xpath-tester.html#ad-output
+
+    doc = None
+    try:
+        doc = html.fromstring(message_body)
+    except etree.ParserError: # If the parsed HTML document is empty, we get a "ParserError: Document is empty" exception. So the stripped message we return is an empty string (if we keep the exception it blocks the SourceReader)
+        return ""
+
+    candidates = _QuoteCandidates(doc)
+
+    #Strip GMail quotes
+    matches = candidates.gmail
+    if len(matches) > 0:
+        if not matches[0].text or "---------- Forwarded message ----------" not in matches[0].text:
+            matches[0].drop_tree()
+            return html.tostring(doc)
+
+    #Strip modern Apple Mail quotes
+    matches = candidates.applemail
+    if len(matches) == 1:
+        matches[0].drop_tree()
+        return html.tostring(doc)
+
+    #Strip old AppleMail quotes (french)
+    matches = candidates.old_applemail
+    if len(matches) == 1:
+        matches[0].drop_tree()
+        return html.tostring(doc)
+
+    #Strip Outlook quotes (when outlook gives usable structure)
+    matches = candidates.outlook
+    if len(matches) == 1:
+        matches[0].drop_tree()
+        return html.tostring(doc)
+
+    #Strip Outlook quotes (when outlook gives NO usable structure)
+    matches = candidates.outlook_unstructured
+    if len(matches) == 1:
+        quoteBodyElements = [
+            sibling for sibling in matches[0].itersiblings()
+            if isinstance(sibling.tag, basestring)]
+        for quoteElement in quoteBodyElements:
+            #This moves the text to the tail of matches[0]
+            quoteElement.drop_tree()
+        matches[0].tail = None
+        matches[0].drop_tree()
+        return html.tostring(doc)
+
+    #Strip Thunderbird quotes
+    matches = candidates.thunderbird
+    if len(matches) == 1:
+        matchQuoteAnnounce = [
+            sibling for sibling in matches[0].itersiblings(preceding=True)
+            if isinstance(sibling.tag, basestring)]
+        if len(matchQuoteAnnounce) > 0:
+            # The nearest preceding sibling
+            matchQuoteAnnounce[0].tail = None
+            matches[0].drop_tree()
+            return html.tostring(doc)
+
+    #Nothing was stripped...
+    return html.tostring(doc)
@@ -2,9 +2,14 @@
 
 from __future__ import absolute_import
 
+import logging
 from datetime import date, datetime
 from simplejson import dumps, JSONEncoder
 
+from .raven_client import capture_exception
+
+log = logging.getLogger('assembl')
+
 
 class DateJSONEncoder(JSONEncoder):
     """A JSONEncoder that can encode datetime objects using iso8601"""
@@ -18,6 +23,65 @@ class DateJSONEncoder(JSONEncoder):
             return super(DateJSONEncoder, self).default(obj)
 
 
+class StreamedJSONList(object):
+    """A JSON list whose items are produced and encoded one at a time.
+
+    When returned from a view using the json renderer, it becomes the
+    response's app_iter, so the list never exists in memory as a whole.
+    If a key is given, the list is wrapped in an object under that key,
+    and the entries of the dictionary returned by ``extra`` (called once
+    all items have been produced) are added after the list.
+
+    The body is produced after the response status was sent: if producing
+    it fails, the error is logged and reraised, so the server drops the
+    connection instead of ending a truncated body normally."""
+
+    # Size of the chunks handed to the WSGI server
+    chunk_size = 64 * 1024
+
+    def __init__(self, items, key=None, extra=None):
+        self.items = items
+        self.key = key
+        self.extra = extra
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks():
+                yield chunk
+        except Exception:
+            log.exception("Error while streaming a JSON list")
+            capture_exception()
+            raise
+
+    def _chunks(self):
+        buf = []
+        size = 0
+        if self.key is None:
+            buf.append('[')
+        else:
+            buf.append('{%s: [' % (dumps(self.key),))
+        first = True
+        for item in self.items:
+            encoded = dumps(item, cls=DateJSONEncoder)
+            if not first:
+                encoded = ', ' + encoded
+            first = False
+            buf.append(encoded)
+            size += len(encoded)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']')
+        if self.key is not None:
+            extra = self.extra() if self.extra else {}
+            for k, v in extra.iteritems():
+                buf.append(', %s: %s' % (
+                    dumps(k), dumps(v, cls=DateJSONEncoder)))
+            buf.append('}')
+        yield ''.join(buf)
+
+
 def json_renderer_factory(info):
     """ Same factory from pyramid.renderers, but with a custom encoder. """
     def _render(value, system):
@@ -27,5 +91,10 @@ def json_renderer_factory(info):
             ct = response.content_type
             if ct == response.default_content_type:
                 response.content_type = 'application/json'
+        if isinstance(value, StreamedJSONList):
+            if request is None:
+                return ''.join(value)
+            request.response.app_iter = value
+            return None
         return dumps(value, cls=DateJSONEncoder)
     return _render
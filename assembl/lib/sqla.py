@@ -7,12 +7,17 @@ import sys
 from datetime import datetime
 import inspect as pyinspect
 import types
-from collections import Iterable, defaultdict
+from collections import Iterable, OrderedDict, defaultdict
 import atexit
+import threading
+from time import sleep
+from traceback import print_exc
 from abc import abstractmethod
+from copy import deepcopy
 
 from enum import Enum
 from anyjson import dumps, loads
+import transaction
 from colanderalchemy import SQLAlchemySchemaNode
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
@@ -20,7 +25,8 @@ from sqlalchemy import (
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
-from sqlalchemy.orm import mapper, scoped_session, sessionmaker
+from sqlalchemy.orm import (
+    mapper, scoped_session, sessionmaker, subqueryload)
 from sqlalchemy.orm.interfaces import MANYTOONE, ONETOMANY, MANYTOMANY
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.util import has_identity
@@ -143,6 +149,191 @@ class ChainingContext(object):
         return self.context.get_instance_of_class(cls)
 
 
+# Serialization plans for generic_json, keyed by (class, view_def name).
+# Values are (view_def, plan), so a reloaded view_def invalidates the plan.
+_json_plans = {}
+
+
+class JsonPlan(list):
+    """The list of operations that serialize instances of a class
+    according to a view_def. See :py:meth:`BaseOps._compile_json_plan`.
+
+    Also remembers which relationships the plan will traverse,
+    as (relationship name, target class, view_def name) triples,
+    so they can be loaded ahead of time for a batch of instances.
+    A relationship name of None designates the instance itself."""
+    def __init__(self):
+        super(JsonPlan, self).__init__()
+        self.relations = []
+
+
+def _translate_to_json(v, view_name, user_id, permissions, base_uri):
+    if isinstance(v, Base):
+        p = getattr(v, 'user_can', None)
+        if p and not v.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            return None
+        if view_name:
+            return v.generic_json(
+                view_name, user_id, permissions, base_uri)
+        else:
+            return v.uri(base_uri)
+    elif isinstance(v, (
+            str, unicode, int, long, float, bool, types.NoneType)):
+        return v
+    elif isinstance(v, EnumSymbol):
+        return v.name
+    elif isinstance(v, datetime):
+        return v.isoformat() + "Z"
+    elif isinstance(v, dict):
+        v = {_translate_to_json(k, view_name, user_id, permissions, base_uri):
+             _translate_to_json(val, view_name, user_id, permissions, base_uri)
+             for k, val in v.items()}
+        return {k: val for (k, val) in v.items()
+                if val is not None}
+    elif isinstance(v, Iterable):
+        v = [_translate_to_json(i, view_name, user_id, permissions, base_uri)
+             for i in v]
+        return [x for x in v if x is not None]
+    else:
+        raise NotImplementedError("Cannot translate", v)
+
+
+# Operations of a serialization plan.
+# Each takes (ob, result, user_id, permissions, base_uri)
+# and sets the relevant key(s) of result.
+
+def _literal_op(name, value):
+    if isinstance(value, (list, dict)):
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = deepcopy(value)
+    else:
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = value
+    return op
+
+
+def _self_op(name, view_name):
+    if view_name:
+        def op(ob, result, user_id, permissions, base_uri):
+            r = ob.generic_json(view_name, user_id, permissions, base_uri)
+            if r is not None:
+                result[name] = r
+    else:
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = ob.uri()
+    return op
+
+
+def _method_op(name, method_name, view_name):
+    def op(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, method_name)()
+        result[name] = _translate_to_json(
+            val, view_name, user_id, permissions, base_uri)
+    return op
+
+
+def _attribute_op(name, prop_name, view_name):
+    def op(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, prop_name)
+        if val is not None:
+            val = _translate_to_json(
+                val, view_name, user_id, permissions, base_uri)
+        if val is not None:
+            result[name] = val
+    return op
+
+
+def _fkey_uri_op(name, fkey_name, target_cls):
+    def op(ob, result, user_id, permissions, base_uri):
+        result[name] = target_cls.uri_generic(getattr(ob, fkey_name))
+    return op
+
+
+def _collection_op(name, prop_name, view_name, as_dict):
+    if not view_name:
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = [
+                o.uri(base_uri) for o in getattr(ob, prop_name)
+                if o.user_can(user_id, CrudPermissions.READ, permissions)]
+    elif as_dict:
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = {
+                o.uri(base_uri):
+                o.generic_json(view_name, user_id, permissions, base_uri)
+                for o in getattr(ob, prop_name)
+                if o.user_can(user_id, CrudPermissions.READ, permissions)}
+    else:
+        def op(ob, result, user_id, permissions, base_uri):
+            result[name] = [
+                o.generic_json(view_name, user_id, permissions, base_uri)
+                for o in getattr(ob, prop_name)
+                if o.user_can(user_id, CrudPermissions.READ, permissions)]
+    return op
+
+
+def _scalar_relation_op(name, prop_name, view_name, as_list):
+    def op(ob, result, user_id, permissions, base_uri):
+        target = getattr(ob, prop_name)
+        if target and target.user_can(
+                user_id, CrudPermissions.READ, permissions):
+            val = target.generic_json(
+                view_name, user_id, permissions, base_uri)
+            if val is not None:
+                result[name] = [val] if as_list else val
+        else:
+            result[name] = [] if as_list else None
+    return op
+
+
+def _scalar_relation_fkey_op(name, fkey_name, target_cls, as_list):
+    def op(ob, result, user_id, permissions, base_uri):
+        ob_id = getattr(ob, fkey_name)
+        uri = None
+        if ob_id:
+            uri = target_cls.uri_generic(ob_id, base_uri)
+        if uri:
+            result[name] = [uri] if as_list else uri
+        else:
+            result[name] = [] if as_list else None
+    return op
+
+
+def _scalar_relation_uri_op(name, prop_name, as_list):
+    def op(ob, result, user_id, permissions, base_uri):
+        target = getattr(ob, prop_name)
+        uri = None
+        if target:
+            uri = target.uri(base_uri)
+        if uri:
+            result[name] = [uri] if as_list else uri
+        else:
+            result[name] = [] if as_list else None
+    return op
+
+
+def _default_fkey_op(name, fkey_name, target_cls):
+    def op(ob, result, user_id, permissions, base_uri):
+        ob_id = getattr(ob, fkey_name)
+        if ob_id:
+            result[name] = target_cls.uri_generic(ob_id, base_uri)
+        else:
+            result[name] = None
+    return op
+
+
+def _default_column_op(name):
+    def op(ob, result, user_id, permissions, base_uri):
+        val = getattr(ob, name)
+        if val:
+            if type(val) == datetime:
+                val = val.isoformat() + "Z"
+            result[name] = val
+        else:
+            result[name] = None
+    return op
+
+
 class BaseOps(object):
     """Base class for SQLAlchemy models in Assembl.
 
@@ -347,6 +538,13 @@ class BaseOps(object):
         connection.info['cdict'][(self.uri(), view_def)] = (
             discussion_id, self)
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        """Hook called by the ORM listeners when this object is created,
+        modified or deleted, so that data derived from it can be updated.
+
+        Does nothing by default."""
+        pass
+
     @classmethod
     def external_typename(cls):
         """What is the class name that will be sent on the API, as @type.
@@ -579,21 +777,20 @@ class BaseOps(object):
             view_def[my_typename] = local_view
         return local_view
 
-    def generic_json(
-            self, view_def_name='default', user_id=None,
-            permissions=(P_READ, ), base_uri='local:'):
-        """Return a representation of this object as a JSON object,
-        according to the given view_def and access control."""
-        user_id = user_id or Everyone
-        if not self.user_can(user_id, CrudPermissions.READ, permissions):
-            return None
-        view_def = get_view_def(view_def_name or 'default')
-        my_typename = self.external_typename()
-        result = {}
-        local_view = self.expand_view_def(view_def)
+    @classmethod
+    def _compile_json_plan(cls, view_def_name, view_def):
+        """Compile the view_def into a serialization plan for this class.
+
+        The plan is a :py:class:`JsonPlan` of operations, each taking
+        ``(instance, result, user_id, permissions, base_uri)`` and filling
+        the result dictionary. All the introspection of the class and the
+        parsing of the view_def happens here, once, instead of at every
+        :py:meth:`generic_json` call."""
+        my_typename = cls.external_typename()
+        local_view = cls.expand_view_def(view_def)
         if not local_view:
             return None
-        mapper = self.__class__.__mapper__
+        mapper = cls.__mapper__
         relns = {r.key: r for r in mapper.relationships}
         cols = {c.key: c for c in mapper.columns}
         fkeys = {c for c in mapper.columns if c.foreign_keys}
@@ -604,11 +801,12 @@ class BaseOps(object):
         fkey_of_reln = {r.key: r._calculated_foreign_keys
                         for r in mapper.relationships}
         methods = dict(pyinspect.getmembers(
-            self.__class__, lambda m: pyinspect.ismethod(m)
+            cls, lambda m: pyinspect.ismethod(m)
             and m.func_code.co_argcount == 1))
         properties = dict(pyinspect.getmembers(
-            self.__class__, lambda p: pyinspect.isdatadescriptor(p)))
+            cls, lambda p: pyinspect.isdatadescriptor(p)))
         known = set()
+        plan = JsonPlan()
         for name, spec in local_view.iteritems():
             if name == "_default":
                 continue
@@ -641,7 +839,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name)
                 if subspec[0] == "'":
                     # literals.
-                    result[name] = loads(subspec[1:])
+                    plan.append(_literal_op(name, loads(subspec[1:])))
                     continue
                 if ':' in subspec:
                     prop_name, view_name = subspec.split(':', 1)
@@ -656,48 +854,14 @@ class BaseOps(object):
                 assert get_view_def(view_name),\
                     "in viewdef %s, class %s, name %s, unknown viewdef %s" % (
                         view_def_name, my_typename, name, view_name)
-            #print prop_name, name, view_name
-
-            def translate_to_json(v):
-                if isinstance(v, Base):
-                    p = getattr(v, 'user_can', None)
-                    if p and not v.user_can(
-                            user_id, CrudPermissions.READ, permissions):
-                        return None
-                    if view_name:
-                        return v.generic_json(
-                            view_name, user_id, permissions, base_uri)
-                    else:
-                        return v.uri(base_uri)
-                elif isinstance(v, (
-                        str, unicode, int, long, float, bool, types.NoneType)):
-                    return v
-                elif isinstance(v, EnumSymbol):
-                    return v.name
-                elif isinstance(v, datetime):
-                    return v.isoformat() + "Z"
-                elif isinstance(v, dict):
-                    v = {translate_to_json(k): translate_to_json(val)
-                         for k, val in v.items()}
-                    return {k: val for (k, val) in v.items()
-                            if val is not None}
-                elif isinstance(v, Iterable):
-                    v = [translate_to_json(i) for i in v]
-                    return [x for x in v if x is not None]
-                else:
-                    raise NotImplementedError("Cannot translate", v)
 
             if prop_name == 'self':
+                plan.append(_self_op(name, view_name))
                 if view_name:
-                    r = self.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if r is not None:
-                        result[name] = r
-                else:
-                    result[name] = self.uri()
+                    plan.relations.append((None, cls, view_name))
                 continue
             elif prop_name == '@view':
-                result[name] = view_def_name
+                plan.append(_literal_op(name, view_def_name))
                 continue
             elif prop_name[0] == '&':
                 prop_name = prop_name[1:]
@@ -706,8 +870,7 @@ class BaseOps(object):
                         view_def_name, my_typename, name, prop_name)
                 # Function call. PLEASE RETURN JSON, Base objects,
                 # or list or dicts thereof
-                val = getattr(self, prop_name)()
-                result[name] = translate_to_json(val)
+                plan.append(_method_op(name, prop_name, view_name))
                 continue
             elif prop_name in cols:
                 assert not view_name,\
@@ -720,28 +883,22 @@ class BaseOps(object):
                     "in viewdef %s, class %s, dict for literal property %s" % (
                         view_def_name, my_typename, prop_name)
                 known.add(prop_name)
-                val = getattr(self, prop_name)
-                if val is not None:
-                    val = translate_to_json(val)
-                if val is not None:
-                    result[name] = val
+                plan.append(_attribute_op(name, prop_name, view_name))
                 continue
             elif prop_name in properties:
                 known.add(prop_name)
                 if view_name or (prop_name not in fkey_of_reln) or (
                         relns[prop_name].direction != MANYTOONE):
-                    val = getattr(self, prop_name)
-                    if val is not None:
-                        val = translate_to_json(val)
-                    if val is not None:
-                        result[name] = val
+                    plan.append(_attribute_op(name, prop_name, view_name))
+                    if prop_name in relns:
+                        plan.relations.append((
+                            prop_name, relns[prop_name].mapper.class_,
+                            view_name))
                 else:
                     fkeys = list(fkey_of_reln[prop_name])
                     assert(len(fkeys) == 1)
-                    fkey = fkeys[0]
-                    result[name] = relns[prop_name].mapper.class_.uri_generic(
-                        getattr(self, fkey.key))
-
+                    plan.append(_fkey_uri_op(
+                        name, fkeys[0].key, relns[prop_name].mapper.class_))
                 continue
             assert prop_name in relns,\
                     "in viewdef %s, class %s, prop_name %s not a column, property or relation" % (
@@ -749,76 +906,34 @@ class BaseOps(object):
             known.add(prop_name)
             # Add derived prop?
             reln = relns[prop_name]
+            target_cls = reln.mapper.class_
             if reln.uselist:
-                vals = getattr(self, prop_name)
-                if view_name:
-                    if isinstance(spec, dict):
-                        result[name] = {
-                            ob.uri(base_uri):
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)}
-                    else:
-                        result[name] = [
-                            ob.generic_json(
-                                view_name, user_id, permissions, base_uri)
-                            for ob in vals
-                            if ob.user_can(
-                                user_id, CrudPermissions.READ, permissions)]
-                else:
+                if not view_name:
                     assert not isinstance(spec, dict),\
                         "in viewdef %s, class %s, dict without viewname for %s" % (
                             view_def_name, my_typename, name)
-                    result[name] = [
-                        ob.uri(base_uri) for ob in vals
-                        if ob.user_can(
-                            user_id, CrudPermissions.READ, permissions)]
+                plan.append(_collection_op(
+                    name, prop_name, view_name, isinstance(spec, dict)))
+                plan.relations.append((prop_name, target_cls, view_name))
                 continue
             assert not isinstance(spec, dict),\
                 "in viewdef %s, class %s, dict for non-list relation %s" % (
                     view_def_name, my_typename, prop_name)
+            as_list = isinstance(spec, list)
             if view_name:
-                ob = getattr(self, prop_name)
-                if ob and ob.user_can(
-                        user_id, CrudPermissions.READ, permissions):
-                    val = ob.generic_json(
-                        view_name, user_id, permissions, base_uri)
-                    if val is not None:
-                        if isinstance(spec, list):
-                            result[name] = [val]
-                        else:
-                            result[name] = val
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                plan.append(_scalar_relation_op(
+                    name, prop_name, view_name, as_list))
+                plan.relations.append((prop_name, target_cls, view_name))
+            elif len(reln._calculated_foreign_keys) == 1 \
+                    and reln._calculated_foreign_keys < fkeys:
+                # shortcut, avoid fetch
+                fkey = list(reln._calculated_foreign_keys)[0]
+                plan.append(_scalar_relation_fkey_op(
+                    name, fkey.name, target_cls, as_list))
             else:
-                uri = None
-                if len(reln._calculated_foreign_keys) == 1 \
-                        and reln._calculated_foreign_keys < fkeys:
-                    # shortcut, avoid fetch
-                    fkey = list(reln._calculated_foreign_keys)[0]
-                    ob_id = getattr(self, fkey.name)
-                    if ob_id:
-                        uri = reln.mapper.class_.uri_generic(
-                            ob_id, base_uri)
-                else:
-                    ob = getattr(self, prop_name)
-                    if ob:
-                        uri = ob.uri(base_uri)
-                if uri:
-                    if isinstance(spec, list):
-                        result[name] = [uri]
-                    else:
-                        result[name] = uri
-                else:
-                    if isinstance(spec, list):
-                        result[name] = []
-                    else:
-                        result[name] = None
+                plan.append(_scalar_relation_uri_op(
+                    name, prop_name, as_list))
+                plan.relations.append((prop_name, target_cls, None))
 
         if local_view.get('_default') is not False:
             for name, col in cols.items():
@@ -830,20 +945,40 @@ class BaseOps(object):
                     if name in known:
                         continue
                     else:
-                        ob_id = getattr(self, col.key)
-                        if ob_id:
-                            result[name] = as_rel.mapper.class_.uri_generic(
-                                ob_id, base_uri)
-                        else:
-                            result[name] = None
+                        plan.append(_default_fkey_op(
+                            name, col.key, as_rel.mapper.class_))
                 else:
-                    ob = getattr(self, name)
-                    if ob:
-                        if type(ob) == datetime:
-                            ob = ob.isoformat() + "Z"
-                        result[name] = ob
-                    else:
-                        result[name] = None
+                    plan.append(_default_column_op(name))
+        return plan
+
+    @classmethod
+    def _get_json_plan(cls, view_def_name):
+        """Return the cached serialization plan for this class
+        and view_def, compiling it if necessary."""
+        view_def = get_view_def(view_def_name or 'default')
+        key = (cls, view_def_name)
+        cached = _json_plans.get(key, None)
+        # The view_def identity changes if view_defs are not cached.
+        if cached is not None and cached[0] is view_def:
+            return cached[1]
+        plan = cls._compile_json_plan(view_def_name, view_def)
+        _json_plans[key] = (view_def, plan)
+        return plan
+
+    def generic_json(
+            self, view_def_name='default', user_id=None,
+            permissions=(P_READ, ), base_uri='local:'):
+        """Return a representation of this object as a JSON object,
+        according to the given view_def and access control."""
+        user_id = user_id or Everyone
+        if not self.user_can(user_id, CrudPermissions.READ, permissions):
+            return None
+        plan = self._get_json_plan(view_def_name)
+        if plan is None:
+            return None
+        result = {}
+        for op in plan:
+            op(self, result, user_id, permissions, base_uri)
         return result
 
     dummy_context = DummyContext()
@@ -1630,12 +1765,14 @@ def orm_update_listener(mapper, connection, target):
     session = object_session(target)
     if session.is_modified(target, include_collections=False):
         target.send_to_changes(connection, CrudOperation.UPDATE)
+        target.update_derived_data(CrudOperation.UPDATE)
 
 
 def orm_insert_listener(mapper, connection, target):
     if getattr(target, '__history_table__', None):
         return
     target.send_to_changes(connection, CrudOperation.CREATE)
+    target.update_derived_data(CrudOperation.CREATE)
 
 
 def orm_delete_listener(mapper, connection, target):
@@ -1644,25 +1781,169 @@ def orm_delete_listener(mapper, connection, target):
     if getattr(target, '__history_table__', None):
         return
     target.tombstone().send_to_changes(connection, CrudOperation.DELETE)
+    target.update_derived_data(CrudOperation.DELETE)
+
+
+class ChangesAggregator(object):
+    """Sends the Json representation of objects changed by committed
+    transactions to the :py:mod:`assembl.tasks.changes_router`.
+
+    Changes are coalesced over a short window, in a background thread:
+    an object changed by many transactions is serialized once, in its
+    latest state, and each discussion gets one changeset per window.
+    Without a window, changes are sent right away."""
+
+    def __init__(self, window=0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (discussion, uri, view_def) -> Json, or (class, identity)
+        # of an object to serialize
+        self.pending = OrderedDict()
+        self.thread = None
+
+    def add(self, changes):
+        """Add changes, as ((discussion, uri, view_def), change) pairs."""
+        with self.lock:
+            for key, change in changes:
+                # The latest change wins, but keeps the position
+                # of the first one, so creations stay in order
+                self.pending[key] = change
+            if self.window and (
+                    self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(
+                    target=self.run, name="changes_aggregator")
+                self.thread.daemon = True
+                self.thread.start()
+        if self.window:
+            self.wakeup.set()
+        else:
+            self.flush()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            sleep(self.window)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                print_exc()
+
+    @staticmethod
+    def load_objects(db, pending):
+        """Load the objects to serialize, with one query per class,
+        and prefetch the relationships of their view_defs.
+
+        Returns a (class, identity) -> object dictionary."""
+        identities = defaultdict(set)
+        view_defs = defaultdict(set)
+        for (discussion, uri, view_def), change in pending.iteritems():
+            if isinstance(change, tuple):
+                identities[change[0]].add(change[1])
+                view_defs[view_def].add(change)
+        objects = {}
+        for cls, cls_identities in identities.iteritems():
+            pk = inspect(cls).primary_key
+            if len(pk) == 1:
+                for ob in db.query(cls).filter(pk[0].in_(
+                        [identity[0] for identity in cls_identities])):
+                    objects[(cls, inspect(ob).identity)] = ob
+            else:
+                for identity in cls_identities:
+                    ob = db.query(cls).get(identity)
+                    if ob is not None:
+                        objects[(cls, identity)] = ob
+        for view_def, keys in view_defs.iteritems():
+            prefetch_json_relations(
+                [objects[key] for key in keys if key in objects], view_def)
+        return objects
+
+    def flush(self):
+        """Serialize and send the pending changes."""
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+        if not pending:
+            return
+        changes = defaultdict(list)
+        db = None
+        try:
+            if any(isinstance(change, tuple)
+                   for change in pending.itervalues()):
+                db = get_session_maker()()
+                objects = self.load_objects(db, pending)
+            for (discussion, uri, view_def), change in pending.iteritems():
+                if isinstance(change, tuple):
+                    # The object may have been deleted since
+                    ob = objects.get(change)
+                    change = ob.generic_json(view_def) if ob else None
+                if change:
+                    changes[discussion].append(change)
+        finally:
+            if db is not None:
+                # Read-only
+                if is_zopish():
+                    transaction.abort()
+                else:
+                    db.rollback()
+        socket = get_pub_socket()
+        for discussion, changeset in changes.iteritems():
+            send_changes(socket, discussion, changeset)
+
+
+# How long changes are coalesced before being sent, in seconds.
+CHANGES_AGGREGATION_WINDOW = 0
+_changes_aggregator = None
+
+
+_changes_aggregator_lock = threading.Lock()
+
+
+def get_changes_aggregator():
+    global _changes_aggregator
+    if _changes_aggregator is None:
+        with _changes_aggregator_lock:
+            if _changes_aggregator is None:
+                _changes_aggregator = ChangesAggregator(
+                    CHANGES_AGGREGATION_WINDOW)
+    return _changes_aggregator
+
+
+@atexit.register
+def flush_changes_aggregator():
+    if _changes_aggregator is not None:
+        try:
+            _changes_aggregator.flush()
+        except Exception:
+            print_exc()
 
 
 def before_commit_listener(session):
-    """Create the Json representation of changed objects which will be
+    """Collect the objects changed in this transaction, which will be
     sent to the :py:mod:`assembl.tasks.changes_router`
 
-    We have to do this before commit, while objects are still attached."""
+    Without an aggregation window, we have to create their Json
+    representation before commit, while objects are still attached.
+    Otherwise, only deleted objects are serialized now, and the others
+    later by the :py:class:`ChangesAggregator`."""
     # If there hasn't been a flush yet, make sure any sql error occur BEFORE
     # we send changes to the socket.
     session.flush()
     info = session.connection().info
     if 'cdict' in info:
-        changes = defaultdict(list)
+        changes = []
         for ((uri, view_def), (discussion, target)) in \
                 info['cdict'].iteritems():
             discussion = bytes(discussion or "*")
-            json = target.generic_json(view_def)
-            if json:
-                changes[discussion].append(json)
+            identity = None
+            if CHANGES_AGGREGATION_WINDOW and not isinstance(
+                    target, Tombstone):
+                identity = inspect(target).identity
+            if identity:
+                change = (target.__class__, identity)
+            else:
+                change = target.generic_json(view_def)
+            changes.append(((discussion, uri, view_def), change))
         del info['cdict']
         session.cdict2 = changes
     else:
@@ -1670,13 +1951,11 @@ def before_commit_listener(session):
 
 
 def after_commit_listener(session):
-    """After commit, actually send the Json representation of changed objects
+    """After commit, hand the changed objects to the
+    :py:class:`ChangesAggregator`, which sends them
     to the :py:mod:`assembl.tasks.changes_router`, through 0MQ."""
-    if not getattr(session, 'zsocket', None):
-        session.zsocket = get_pub_socket()
     if getattr(session, 'cdict2', None):
-        for discussion, changes in session.cdict2.iteritems():
-            send_changes(session.zsocket, discussion, changes)
+        get_changes_aggregator().add(session.cdict2)
         del session.cdict2
 
 
@@ -1701,6 +1980,9 @@ event.listen(BaseOps, 'after_delete', orm_delete_listener, propagate=True)
 def configure_engine(settings, zope_tr=True, autoflush=True, session_maker=None,
                      **engine_kwargs):
     """Return an SQLAlchemy engine configured as per the provided config."""
+    global CHANGES_AGGREGATION_WINDOW
+    CHANGES_AGGREGATION_WINDOW = float(
+        settings.get('changes.aggregation_window', 0))
     if session_maker is None:
         if session_maker_is_initialized():
             print "ERROR: Initialized twice."
@@ -1784,6 +2066,95 @@ def get_database_id(typename, identifier):
             return cls.get_database_id(identifier)
 
 
+# How deep to follow nested view_defs when prefetching relationships.
+# Deeper relationships will be lazy-loaded as usual.
+JSON_PREFETCH_DEPTH = 3
+
+
+def _json_prefetch_options(cls, view_def_name, path=None, depth=0, seen=None):
+    """The subqueryload options that will load the relationships
+    traversed by the serialization plan of this class and view_def."""
+    seen = seen or frozenset()
+    if depth >= JSON_PREFETCH_DEPTH or (cls, view_def_name) in seen:
+        return []
+    seen = seen | {(cls, view_def_name)}
+    plan = cls._get_json_plan(view_def_name)
+    if not plan:
+        return []
+    options = []
+    for prop_name, target_cls, view_name in plan.relations:
+        if prop_name is None:
+            # same instances, other view
+            options.extend(_json_prefetch_options(
+                cls, view_name, path, depth, seen))
+            continue
+        attribute = getattr(cls, prop_name)
+        loader = (path.subqueryload(attribute) if path is not None
+                  else subqueryload(attribute))
+        options.append(loader)
+        if view_name:
+            options.extend(_json_prefetch_options(
+                target_cls, view_name, loader, depth + 1, seen))
+    return options
+
+
+def prefetch_json_relations(instances, view_def_name='default'):
+    """Bulk-load the relationships that :py:meth:`BaseOps.generic_json`
+    will need to serialize these instances with that view_def.
+
+    Uses one query per class and relationship (through subqueryload) instead
+    of one lazy load per instance and relationship."""
+    by_class = defaultdict(list)
+    for instance in instances:
+        if instance is not None and has_identity(instance):
+            by_class[instance.__class__].append(instance)
+    for cls, cls_instances in by_class.iteritems():
+        pk = inspect(cls).primary_key
+        if len(pk) != 1:
+            continue
+        options = _json_prefetch_options(cls, view_def_name)
+        if not options:
+            continue
+        session = object_session(cls_instances[0])
+        if session is None:
+            continue
+        ids = [inspect(i).identity[0] for i in cls_instances]
+        # The instances are in the identity map: this only
+        # populates their unloaded relationships.
+        session.query(cls).filter(pk[0].in_(ids)).options(*options).all()
+
+
+def generic_json_many(
+        instances, view_def_name='default', user_id=None,
+        permissions=(P_READ, ), base_uri='local:'):
+    """Return the JSON representation of many instances, as per
+    :py:meth:`BaseOps.generic_json`, with the relationships used by
+    the view_def loaded in bulk beforehand.
+
+    The result list is aligned with the instances; it will contain None
+    for instances the user cannot read."""
+    instances = list(instances)
+    prefetch_json_relations(instances, view_def_name)
+    return [i.generic_json(view_def_name, user_id, permissions, base_uri)
+            for i in instances]
+
+
+def iter_query_chunks(query, chunk_size=500):
+    """Iterate on the results of a query in lists of chunk_size,
+    without loading the whole result set in memory.
+
+    Not compatible with joined or subquery eager loading of collections;
+    use :py:func:`prefetch_json_relations` on each chunk instead."""
+    chunk = []
+    for row in query.yield_per(chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def includeme(config):
     """Initialize SQLAlchemy at app start-up time."""
     configure_engine(config.registry.settings)
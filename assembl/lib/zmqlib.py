@@ -1,9 +1,11 @@
 """ZMQ setup for the changes socket"""
 import atexit
+import threading
 from itertools import count
 
 import zmq
 import zmq.devices
+from zmq.utils import jsonapi
 from time import sleep
 
 context = zmq.Context.instance()
@@ -14,8 +16,12 @@ MULTIPLEX = True
 INITED = False
 DISPATCHER = None
 
+# How long a new publisher socket waits for subscribers, in ms
+READY_TIMEOUT = 200
+
 _counter = count()
 _active_sockets = []
+_thread_sockets = threading.local()
 
 
 def start_dispatch_thread():
@@ -42,28 +48,73 @@ def stop_sockets():
     INITED = False
 
 
+def _receive_subscriptions(socket, timeout=0):
+    """Consume the subscription messages received by a XPUB socket,
+    waiting at most timeout (in ms) for the first one.
+
+    Returns whether there was any."""
+    received = False
+    while socket.poll(0 if received else timeout, zmq.POLLIN):
+        socket.recv_multipart(zmq.NOBLOCK)
+        received = True
+    return received
+
+
 def get_pub_socket():
+    """Get the publisher socket of the current thread.
+
+    Sockets are created once per thread and reused across sessions.
+    To avoid the "slow joiner" symptom, where messages are dropped until
+    subscriptions reach the publisher,
+    http://zguide.zeromq.org/page:all#Getting-the-Message-Out
+    a new socket waits until it receives its first subscription, which
+    XPUB sockets expose, instead of sleeping for a fixed time.
+    If no subscriber shows up within READY_TIMEOUT, messages would
+    be dropped anyway."""
+    socket = getattr(_thread_sockets, 'socket', None)
+    if socket is not None and not socket.closed:
+        # Do not let subscription messages accumulate
+        _receive_subscriptions(socket)
+        return socket
     if MULTIPLEX:
         start_dispatch_thread()
-    socket = context.socket(zmq.PUB)
+    socket = context.socket(zmq.XPUB)
     if MULTIPLEX:
         socket.connect(INTERNAL_SOCKET)
     else:
         socket.connect(CHANGES_SOCKET)
     _active_sockets.append(socket)
-    # Related to "slow joiner" symptom
-    # http://zguide.zeromq.org/page:all#Getting-the-Message-Out
-    # It would be better to get the "ready" signal back but this is
-    # adequate for now.
-    sleep(0.2)
+    _receive_subscriptions(socket, READY_TIMEOUT)
+    _thread_sockets.socket = socket
     return socket
 
 
+def partition_changes(changeset):
+    """Split a changeset into the changes that everyone can see, and the
+    complete changeset of each user who has private changes in it.
+
+    Changes are kept in their original order."""
+    users = {change['@private'] for change in changeset
+             if '@private' in change}
+    public = [change for change in changeset if '@private' not in change]
+    by_user = {
+        user: [change for change in changeset
+               if change.get('@private', user) == user]
+        for user in users}
+    return public, by_user
+
+
 def send_changes(socket, discussion, changeset):
+    """Send a changeset as a multipart message:
+    discussion, order, public changes (or empty), and then pairs of
+    user uri, changes as seen by that user. All changes are serialized
+    here, so subscribers can forward them without parsing."""
     order = _counter.next()
-    socket.send(discussion, zmq.SNDMORE)
-    socket.send(str(order), zmq.SNDMORE)
-    socket.send_json(changeset)
+    public, by_user = partition_changes(changeset)
+    frames = [discussion, str(order), jsonapi.dumps(public) if public else '']
+    for user, changes in by_user.iteritems():
+        frames.extend((str(user), jsonapi.dumps(changes)))
+    socket.send_multipart(frames)
     print "sent", order, discussion, changeset
 
 
@@ -162,6 +162,7 @@ from .mail import (
     AbstractFilesystemMailbox,
     AbstractMailbox,
     Email,
+    EmailReference,
     IMAPMailbox,
     MaildirMailbox,
     MailingList,
@@ -200,6 +201,10 @@ from .idea_content_link import (
     IdeaThreadContextBreakLink,
     TextFragmentIdentifier,
 )
+from .idea_post_counts import (
+    IdeaPostCount,
+    IdeaReadPostCount,
+)
 from .idea_graph_view import (
     ExplicitSubGraphView,
     IdeaGraphView,
@@ -18,12 +18,13 @@ from sqlalchemy import (
     event,
 )
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import relationship, backref, column_property
+from sqlalchemy.orm import (
+    relationship, backref, column_property, object_session)
 from virtuoso.vmapping import IriClass
 from abc import abstractproperty
 
 from . import DiscussionBoundBase, DiscussionBoundTombstone, TombstonableMixin, Post
-from ..lib.sqla import DuplicateHandling
+from ..lib.sqla import DuplicateHandling, CrudOperation
 from ..semantic.namespaces import (
     ASSEMBL, QUADNAMES, VERSION, RDF, VirtRDF)
 from ..semantic.virtuoso_mapping import QuadMapPatternS
@@ -186,6 +187,22 @@ class ViewPost(UniqueActionOnPost):
 
     verb = 'viewed'
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from .idea_post_counts import post_read_changed
+        is_live = self.tombstone_date is None
+        if operation == CrudOperation.CREATE:
+            delta = int(is_live)
+        elif operation == CrudOperation.DELETE:
+            delta = -int(is_live)
+        else:
+            history = inspect(self).attrs.tombstone_date.history
+            if not history.has_changes():
+                return
+            was_live = not any(d is not None for d in history.deleted)
+            delta = int(is_live) - int(was_live)
+        post_read_changed(
+            object_session(self), self.post_id, self.actor_id, delta)
+
 
 class SentimentOfPost(UniqueActionOnPost):
     """
@@ -1145,6 +1145,11 @@ class UserRole(Base, PrivateObjectMixin):
     def get_role_name(self):
         return self.role.name
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from ..auth.util import invalidate_permissions
+        # Global roles apply to all discussions
+        invalidate_permissions(self.db)
+
     @classmethod
     def special_quad_patterns(cls, alias_maker, discussion_id):
         role_alias = alias_maker.alias_from_relns(cls.role)
@@ -1216,6 +1221,15 @@ class LocalUserRole(DiscussionBoundBase, PrivateObjectMixin):
     def get_role_name(self):
         return self.role.name
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from ..auth.util import invalidate_permissions
+        if operation == CrudOperation.UPDATE:
+            # The user or discussion may have changed
+            invalidate_permissions(self.db)
+        else:
+            invalidate_permissions(
+                self.db, self.user_id, self.discussion_id)
+
     def unique_query(self):
         query, _ = super(LocalUserRole, self).unique_query()
         user_id = self.user_id or self.user.id
@@ -1357,6 +1371,10 @@ class DiscussionPermission(DiscussionBoundBase):
     def permission_name(self):
         return self.permission.name
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from ..auth.util import invalidate_permissions
+        invalidate_permissions(self.db)
+
     def get_discussion_id(self):
         return self.discussion_id or self.discussion.id
 
@@ -1630,15 +1648,16 @@ class LanguagePreferenceCollection(object):
         pass
 
     @classmethod
-    def getCurrent(cls, req=None):
+    def getCurrent(cls, req=None, refresh=False):
         from pyramid.threadlocal import get_current_request
         from pyramid.security import Everyone
         # Very very hackish, but this call is costly and frequent.
         # Let's cache it in the request. Useful for view_def use.
+        # Use refresh if the request's transaction is over.
         if req is None:
             req = get_current_request()
         assert req
-        if getattr(req, "lang_prefs", 0) is 0:
+        if refresh or getattr(req, "lang_prefs", 0) is 0:
             user_id = req.authenticated_userid
             if user_id and user_id != Everyone:
                 try:
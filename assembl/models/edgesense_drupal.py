@@ -592,12 +592,12 @@ class EdgeSenseParser(object):
 
 
 class EdgeSenseReader(PullSourceReader):
-    def setup(self):
-        super(EdgeSenseReader, self).setup()
-        self.parser = EdgeSenseParser(self.source)
+    def get_host(self, source):
+        return urlparse(source.node_source).hostname
 
     def do_read(self):
-        self.parser.parse()
+        # The source may be reloaded between reads, do not keep the parser
+        EdgeSenseParser(self.source).parse()
 
     def re_import(self):
-        self.parser.re_import()
+        EdgeSenseParser(self.source).re_import()
@@ -1330,6 +1330,9 @@ class FacebookReader(PullSourceReader):
         super(FacebookReader, self).__init__(source_id)
         self.api = api
 
+    def get_host(self, source):
+        return 'graph.facebook.com'
+
     def do_read(self):
         upper = self.extra_args.get('upper_bound', None)
         lower = self.extra_args.get('lower_bound', None)
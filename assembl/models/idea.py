@@ -11,7 +11,7 @@ from bs4 import BeautifulSoup
 from rdflib import URIRef
 from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload, deferred,
-    column_property, with_polymorphic)
+    column_property, with_polymorphic, object_session)
 from sqlalchemy.orm.attributes import NO_VALUE
 from sqlalchemy.sql import text, column
 from sqlalchemy.sql.expression import union, bindparam, literal_column
@@ -417,11 +417,13 @@ class Idea(HistoryMixin, DiscussionBoundBase):
         counters = cls.prepare_counters(discussion_id)
         if partial:
             return counters.paths[root_idea_id].as_clause_base(
-                cls.default_db(), include_deleted=include_deleted)
+                cls.default_db(), include_deleted=include_deleted,
+                post_tree=counters.post_tree)
         else:
             return counters.paths[root_idea_id].as_clause(
                 cls.default_db(), discussion_id, counters.user_id, Content,
-                include_deleted=include_deleted)
+                include_deleted=include_deleted,
+                post_tree=counters.post_tree)
 
     @classmethod
     def get_discussion_data(cls, discussion_id):
@@ -464,16 +466,19 @@ class Idea(HistoryMixin, DiscussionBoundBase):
 
     @property
     def num_posts(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[0]
+        return self.num_total_and_read_posts[0]
 
     @property
     def num_read_posts(self):
-        counters = self.prepare_counters(self.discussion_id)
-        return counters.get_counts(self.id)[1]
+        return self.num_total_and_read_posts[1]
 
     @property
     def num_total_and_read_posts(self):
+        counts = self.get_discussion_data(
+            self.discussion_id).idea_post_counts()
+        if self.id in counts:
+            return counts[self.id]
+        # Idea outside of the hierarchy
         counters = self.prepare_counters(self.discussion_id)
         return counters.get_counts(self.id)
 
@@ -1185,6 +1190,14 @@ class IdeaLink(HistoryMixin, DiscussionBoundBase):
         source = self.source_ts or Idea.get(self.source_id)
         return source.get_discussion_id()
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from .idea_post_counts import (
+            attributes_changed, invalidate_idea_post_counts)
+        if (operation != CrudOperation.UPDATE or attributes_changed(
+                self, ('source_id', 'target_id', 'tombstone_date'))):
+            invalidate_idea_post_counts(
+                object_session(self), self.get_discussion_id())
+
     def send_to_changes(self, connection=None, operation=CrudOperation.UPDATE,
                         discussion_id=None, view_def="changes"):
         connection = connection or self.db.connection()
@@ -3,7 +3,7 @@ import re
 import quopri
 from datetime import datetime
 
-from sqlalchemy.orm import (relationship, backref)
+from sqlalchemy.orm import (relationship, backref, object_session)
 from sqlalchemy import (
     Column,
     Boolean,
@@ -90,6 +90,14 @@ class IdeaContentLink(DiscussionBoundBase):
         return ((cls.content_id == Content.id),
                 (Content.discussion_id == discussion_id))
 
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from .idea_post_counts import (
+            attributes_changed, invalidate_idea_post_counts)
+        if (operation != CrudOperation.UPDATE or attributes_changed(
+                self, ('idea_id', 'content_id', 'type'))):
+            invalidate_idea_post_counts(
+                object_session(self), self.get_discussion_id())
+
     discussion = relationship(
         Discussion, viewonly=True, uselist=False, secondary=Content.__table__,
         info={'rdf': QuadMapPatternS(None, ASSEMBL.in_conversation)})
@@ -0,0 +1,314 @@
+"""Persistent cache of the number of posts, and of read posts, under each idea.
+
+Computing those counts with :py:class:`assembl.models.path_utils.PostPathCounter`
+takes one query per idea, so the results are stored in the tables below and
+maintained incrementally when posts are created or read.
+Changes to the structure of the discussion (threading or state of existing
+posts, idea links, idea-content links) simply drop the cached counts of the
+discussion; they will be recomputed on the next read.
+``assembl/scripts/rebuild_idea_counts.py`` recomputes them from scratch."""
+from collections import defaultdict
+
+from sqlalchemy import Column, Integer, ForeignKey, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import inspect, with_polymorphic
+from sqlalchemy.orm.session import Session
+
+from ..lib.sqla import Base, mark_changed
+from .auth import User
+from .discussion import Discussion
+from .idea import Idea
+from .idea_content_link import IdeaContentLink
+from .post import Post, Content, countable_publication_states
+
+
+class IdeaPostCount(Base):
+    """The number of countable posts shown under an idea.
+
+    Only written through core SQL, by the functions of this module."""
+    __tablename__ = "idea_post_count"
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete="CASCADE", onupdate="CASCADE"),
+        nullable=False, index=True)
+    num_posts = Column(Integer, nullable=False, default=0)
+
+
+class IdeaReadPostCount(Base):
+    """The number of countable posts shown under an idea that a user has read.
+
+    Only written through core SQL, by the functions of this module."""
+    __tablename__ = "idea_read_post_count"
+    idea_id = Column(Integer, ForeignKey(
+        Idea.id, ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        User.id, ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+        Discussion.id, ondelete="CASCADE", onupdate="CASCADE"),
+        nullable=False, index=True)
+    num_read_posts = Column(Integer, nullable=False, default=0)
+
+
+_PENDING_KEY = 'idea_post_counts'
+
+
+def _pending_changes(session, create=True):
+    if create and _PENDING_KEY not in session.info:
+        session.info[_PENDING_KEY] = dict(
+            invalid=set(), new_posts=set(), reads=[])
+    return session.info.get(_PENDING_KEY, None)
+
+
+def attributes_changed(ob, attribute_names):
+    "Were any of those attributes changed in the current flush?"
+    attrs = inspect(ob).attrs
+    return any(attrs[name].history.has_changes()
+               for name in attribute_names)
+
+
+def invalidate_idea_post_counts(session, discussion_id):
+    "Drop the cached counts of the discussion at commit time."
+    _pending_changes(session)['invalid'].add(discussion_id)
+
+
+def post_created(session, post_id):
+    "Add the post to the counts of the ideas that show it at commit time."
+    _pending_changes(session)['new_posts'].add(post_id)
+
+
+def post_changed(session, discussion_id, post_id):
+    """The post was moved, deleted, hidden or changed publication state.
+
+    Posts created in the current transaction are handled at commit time,
+    otherwise the discussion's counts are invalidated."""
+    if post_id not in _pending_changes(session)['new_posts']:
+        invalidate_idea_post_counts(session, discussion_id)
+
+
+def post_read_changed(session, post_id, user_id, delta):
+    "Change the user's read counts of the ideas that show the post."
+    if delta:
+        _pending_changes(session)['reads'].append((post_id, user_id, delta))
+
+
+def _ideas_showing_posts(session, post_ids):
+    """dictionary post_id -> ids of the ideas that count it, for posts
+    whose discussion has cached counts.
+
+    Only the idea-content links to a post or its ancestors can decide
+    whether an idea shows it, so those are loaded in a single query and
+    combined along the idea hierarchy as in
+    :py:class:`assembl.models.path_utils.PostPathCombiner`, instead of
+    loading the post paths of the whole discussion."""
+    from .path_utils import (
+        DiscussionGlobalData, PostPathGlobalCollection,
+        PostPathLocalCollection, PostPathData)
+    posts = session.query(
+        Post.id, Post.discussion_id, Post.ancestry).filter(
+        Post.id.in_(post_ids),
+        Post.hidden == False,
+        Post.publication_state.in_(countable_publication_states)).all()
+    discussion_ids = {discussion_id for (_, discussion_id, _) in posts}
+    if discussion_ids:
+        discussion_ids = {discussion_id for (discussion_id,) in session.query(
+            IdeaPostCount.discussion_id.distinct()).filter(
+            IdeaPostCount.discussion_id.in_(discussion_ids))}
+    posts = [(post_id, discussion_id, "%s%d," % (ancestry or '', post_id))
+             for (post_id, discussion_id, ancestry) in posts
+             if discussion_id in discussion_ids]
+    result = {post_id: [] for (post_id, _, _) in posts}
+    if not posts:
+        return result
+    path_ids = set()
+    for (_, _, post_path) in posts:
+        path_ids.update(int(id) for id in post_path.split(',') if id)
+    icl = with_polymorphic(
+        IdeaContentLink, [], IdeaContentLink.__table__,
+        aliased=False, flat=True)
+    post = with_polymorphic(
+        Post, [], Post.__table__, aliased=False, flat=True)
+    content = with_polymorphic(
+        Content, [], Content.__table__, aliased=False, flat=True)
+    links = session.query(
+        icl.idea_id, icl.type, content.discussion_id,
+        post.id, post.ancestry
+        ).join(post, post.id == icl.content_id
+        ).join(content, content.id == post.id
+        ).filter(
+            icl.content_id.in_(path_ids),
+            icl.idea_id != None,
+            content.hidden == False)
+    # discussion_id -> list of (idea_id, PostPathData)
+    links_by_discussion = defaultdict(list)
+    for (idea_id, typename, discussion_id, content_id, ancestry) in links:
+        if typename in PostPathGlobalCollection.positives:
+            positive = True
+        elif typename in PostPathGlobalCollection.negatives:
+            positive = False
+        else:
+            continue
+        links_by_discussion[discussion_id].append((idea_id, PostPathData(
+            "%s%d," % (ancestry or '', content_id), positive)))
+    for discussion_id, discussion_links in links_by_discussion.iteritems():
+        data = DiscussionGlobalData(session, discussion_id)
+        # The linked ideas and their ancestors, deepest first
+        depths = {}
+        for (idea_id, _) in discussion_links:
+            for (depth, ancestor_id) in enumerate(
+                    reversed(list(data.idea_ancestry(idea_id)))):
+                depths[ancestor_id] = depth
+        ideas = sorted(depths, key=depths.get, reverse=True)
+        not_propagating = {id for (id,) in session.query(Idea.id).filter(
+            Idea.id.in_(ideas), Idea.messages_in_parent == False)}
+        for (post_id, post_discussion_id, post_path) in posts:
+            if post_discussion_id != discussion_id:
+                continue
+            collections = defaultdict(PostPathLocalCollection)
+            for (idea_id, path) in discussion_links:
+                if post_path.startswith(path.post_path):
+                    collections[idea_id].add_path(path)
+            if not collections:
+                continue
+            for collection in collections.itervalues():
+                collection.reduce()
+            for idea_id in ideas:
+                parent_id = data.parent_dict.get(idea_id, None)
+                collection = collections.get(idea_id, None)
+                if (parent_id is None or not collection
+                        or idea_id in not_propagating):
+                    continue
+                collections[parent_id].combine(collection)
+            result[post_id] = [
+                idea_id for (idea_id, idea_paths) in collections.iteritems()
+                if idea_paths.includes_post(post_path)]
+    return result
+
+
+def _apply_pending_changes(session, pending):
+    post_count_t = IdeaPostCount.__table__
+    read_count_t = IdeaReadPostCount.__table__
+    for discussion_id in pending['invalid']:
+        session.execute(post_count_t.delete().where(
+            post_count_t.c.discussion_id == discussion_id))
+        session.execute(read_count_t.delete().where(
+            read_count_t.c.discussion_id == discussion_id))
+    post_ids = pending['new_posts'].union(
+        post_id for (post_id, _, _) in pending['reads'])
+    ideas_of_post = _ideas_showing_posts(session, post_ids) if post_ids else {}
+    # idea_id -> delta
+    post_deltas = defaultdict(int)
+    for post_id in pending['new_posts']:
+        for idea_id in ideas_of_post.get(post_id, ()):
+            post_deltas[idea_id] += 1
+    # (user_id, idea_id) -> delta
+    read_deltas = defaultdict(int)
+    for (post_id, user_id, delta) in pending['reads']:
+        for idea_id in ideas_of_post.get(post_id, ()):
+            read_deltas[(user_id, idea_id)] += delta
+    # One UPDATE per distinct delta (and user)
+    ideas_by_delta = defaultdict(list)
+    for idea_id, delta in post_deltas.iteritems():
+        if delta:
+            ideas_by_delta[delta].append(idea_id)
+    for delta, idea_ids in ideas_by_delta.iteritems():
+        session.execute(post_count_t.update().where(
+            post_count_t.c.idea_id.in_(idea_ids)).values(
+            num_posts=post_count_t.c.num_posts + delta))
+    ideas_by_delta = defaultdict(list)
+    for (user_id, idea_id), delta in read_deltas.iteritems():
+        if delta:
+            ideas_by_delta[(user_id, delta)].append(idea_id)
+    for (user_id, delta), idea_ids in ideas_by_delta.iteritems():
+        session.execute(read_count_t.update().where(
+            (read_count_t.c.user_id == user_id)
+            & read_count_t.c.idea_id.in_(idea_ids)).values(
+            num_read_posts=read_count_t.c.num_read_posts + delta))
+
+
+def before_commit_listener(session):
+    "Apply the pending count changes in the committing transaction."
+    # Pending changes are recorded at flush time
+    session.flush()
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        _apply_pending_changes(session, pending)
+
+
+def after_rollback_listener(session):
+    "In case of rollback, forget about pending count changes."
+    session.info.pop(_PENDING_KEY, None)
+
+
+event.listen(Session, 'before_commit', before_commit_listener)
+event.listen(Session, 'after_rollback', after_rollback_listener)
+
+
+def get_idea_post_counts(discussion_data):
+    """Get the counts of the discussion, computing and storing them if needed.
+
+    :param discussion_data: a :py:class:`assembl.models.path_utils.DiscussionGlobalData`
+    :returns: a dictionary idea_id -> (num_posts, num_read_posts),
+        read counts are those of `discussion_data.user_id`.
+    """
+    from .path_utils import PostPathCounter
+    db = discussion_data.db
+    discussion_id = discussion_data.discussion_id
+    user_id = discussion_data.user_id
+    totals = dict(db.query(
+        IdeaPostCount.idea_id, IdeaPostCount.num_posts).filter_by(
+        discussion_id=discussion_id))
+    reads = {}
+    if user_id:
+        reads = dict(db.query(
+            IdeaReadPostCount.idea_id,
+            IdeaReadPostCount.num_read_posts).filter_by(
+            discussion_id=discussion_id, user_id=user_id))
+    if totals and (reads or not user_id):
+        return {idea_id: (num_posts, reads.get(idea_id, 0))
+                for (idea_id, num_posts) in totals.iteritems()}
+    counter = PostPathCounter(discussion_data.discussion, user_id)
+    counter.init_from(discussion_data.post_path_collection_raw)
+    discussion_data.discussion.root_idea.visit_ideas_depth_first(counter)
+    # Counts that include changes of the current transaction
+    # cannot be stored before those changes are applied.
+    if _pending_changes(db, False) is None:
+        connection = db.connection()
+        savepoint = connection.begin_nested()
+        try:
+            if not totals:
+                connection.execute(IdeaPostCount.__table__.insert(), [
+                    dict(idea_id=idea_id, discussion_id=discussion_id,
+                         num_posts=num_posts)
+                    for (idea_id, num_posts) in counter.counts.iteritems()])
+            if user_id and not reads:
+                connection.execute(IdeaReadPostCount.__table__.insert(), [
+                    dict(idea_id=idea_id, user_id=user_id,
+                         discussion_id=discussion_id, num_read_posts=num_read)
+                    for (idea_id, num_read)
+                    in counter.viewed_counts.iteritems()])
+            savepoint.commit()
+            mark_changed(db)
+        except IntegrityError:
+            # Another transaction stored them concurrently
+            savepoint.rollback()
+    return {idea_id: (num_posts, counter.viewed_counts[idea_id])
+            for (idea_id, num_posts) in counter.counts.iteritems()}
+
+
+def rebuild_idea_post_counts(db, discussion_id=None):
+    """Recompute the stored post counts of one or all discussions.
+
+    Per-user read counts are dropped, and recomputed on the next read."""
+    from .path_utils import DiscussionGlobalData
+    if discussion_id:
+        discussion_ids = [discussion_id]
+    else:
+        discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        db.query(IdeaPostCount).filter_by(
+            discussion_id=discussion_id).delete(False)
+        db.query(IdeaReadPostCount).filter_by(
+            discussion_id=discussion_id).delete(False)
+        DiscussionGlobalData(db, discussion_id).idea_post_counts()
+    mark_changed(db)
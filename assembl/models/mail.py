@@ -2,25 +2,30 @@
 """:py:class:`assembl.models.post.Post` that came as email, and utility code for handling email."""
 import email
 import mailbox
+import multiprocessing
 import re
 import smtplib
 import os
+import threading
+import time
 from cgi import escape as html_escape
 from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
 from email.header import decode_header as decode_email_header, Header
+from email.parser import HeaderParser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import parseaddr, mktime_tz, parsedate_tz
+from multiprocessing.pool import ThreadPool
 
-import jwzthreading
 from bs4 import BeautifulSoup, Comment
 from pyramid.threadlocal import get_current_registry
 from datetime import datetime
 from imaplib2 import IMAP4_SSL, IMAP4
 import transaction
 from pyisemail import is_email
-from sqlalchemy.orm import deferred
-from sqlalchemy.orm import joinedload_all
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from sqlalchemy import (
     Column,
@@ -30,9 +35,13 @@ from sqlalchemy import (
     Binary,
     UnicodeText,
     Boolean,
+    SmallInteger,
 )
 from ..lib.sqla_types import (CoerceUnicode, EmailString)
+from ..lib.email_quoting import (
+    strip_full_message_quoting_html, strip_full_message_quoting_plaintext)
 
+from . import Base
 from .langstrings import LangString
 from .generic import PostSource
 from .post import ImportedPost
@@ -151,309 +160,53 @@ class AbstractMailbox(PostSource):
     @staticmethod
     def strip_full_message_quoting_plaintext(message_body):
         """Assumes any encoding conversions have already been done
-        """
-        #Most useful to develop this:
-        #http://www.motobit.com/util/quoted-printable-decoder.asp
-        debug = False;
-        #To be considered matching, each line must match successive lines, in order
-        quote_announcement_lines_regexes = {
-            'generic_original_message':  {
-                        'announceLinesRegexes': [re.compile("/-+\s*Original Message\s*-+/")],
-                        'quotePrefixRegex': re.compile(r"^>\s|^>$")
-                    },
-            'gmail_fr_circa_2012':  {
-                        'announceLinesRegexes': [re.compile(r"^Le .*, .*<.*@.*> a écrit :")],# 2012 Le 6 juin 2011 15:43, <nicolas.decordes@orange-ftgroup.com> a écrit :
-                        'quotePrefixRegex': re.compile(r"^>\s|^>$")
-                    },
-            'gmail_en_circa_2014':  {
-                        'announceLinesRegexes': [re.compile(r"^\d{4}-\d{2}-\d{2}.*<.*@.*>:")],# 2014-06-17 10:32 GMT-04:00 Benoit Grégoire <benoitg@coeus.ca>:
-                        'quotePrefixRegex': re.compile(r"^>\s|^>$")
-                    },
-            'outlook_fr_circa_2012':  {
-                        'announceLinesRegexes': [re.compile(r"^\d{4}-\d{2}-\d{2}.*<.*@.*>:")],# 2014-06-17 10:32 GMT-04:00 Benoit Grégoire <benoitg@coeus.ca>:
-                        'quotePrefixRegex': re.compile(r"^>\s|^>$")
-                    },
-            'outlook_fr_multiline_circa_2012': {
-                        'announceLinesRegexes': [re.compile(r"^_+$"), #________________________________
-                                                re.compile(r"^\s*$"), #Only whitespace
-                                                re.compile(r"^De :.*$"),
-                                                re.compile(r"^Envoy.+ :.*$"),
-                                                re.compile(r"^À :.*$"),
-                                                re.compile(r"^Objet :.*$"),
-                                                ],
-                        'quotePrefixRegex': re.compile(r"^.*$")
-                    },
-            'outlook_en_multiline_circa_2012': {
-                        'announceLinesRegexes': [re.compile(r"^_+$"), #________________________________
-                                                re.compile(r"^\s*$"), #Only whitespace
-                                                re.compile(r"^From:.*$"),
-                                                re.compile(r"^Sent:.*$"),
-                                                re.compile(r"^To:.*$"),
-                                                re.compile(r"^Subject:.*$"),
-                                                ],
-                        'quotePrefixRegex': re.compile(r"^.*$")
-                    },
-            }
-        def check_quote_announcement_lines_match(currentQuoteAnnounce, keysStillMatching, lineToMatch):
-
-            if len(keysStillMatching) == 0:
-                #Restart from scratch
-                keysStillMatching = quote_announcement_lines_regexes.keys()
-            nextIndexToMatch = len(currentQuoteAnnounce)
-            keys = list(keysStillMatching)
-            matchComplete = False
-            for key in keys:
-                if len(quote_announcement_lines_regexes[key]['announceLinesRegexes']) > nextIndexToMatch:
-                    if quote_announcement_lines_regexes[key]['announceLinesRegexes'][nextIndexToMatch].match(lineToMatch):
-                        if len(quote_announcement_lines_regexes[key]['announceLinesRegexes']) -1 == nextIndexToMatch:
-                            matchComplete = key
-                    else:
-                        keysStillMatching.remove(key)
-            if len(keysStillMatching)>0:
-                currentQuoteAnnounce.append(lineToMatch)
-            return matchComplete, keysStillMatching
-
-
-        defaultQuotePrefixRegex=re.compile(r"^>\s|^>$")
-        quote_prefix_regex=defaultQuotePrefixRegex
-        whitespace_line_regex=re.compile(r"^\s*$")
-        retval = []
-        currentQuoteAnnounce = []
-        keysStillMatching = []
-        currentQuote = []
-        currentWhiteSpace = []
-        class LineState:
-            Normal="Normal"
-            PrefixedQuote='PrefixedQuote'
-            PotentialQuoteAnnounce='PotentialQuoteAnnounce'
-            QuoteAnnounceLastLine='QuoteAnnounceLastLine'
-            AllWhiteSpace='AllWhiteSpace'
-
-        line_state_before_transition = LineState.Normal
-        previous_line_state = LineState.Normal
-        line_state = LineState.Normal
-        for line in message_body.splitlines():
-            if line_state != previous_line_state:
-                line_state_before_transition = previous_line_state
-            previous_line_state = line_state
-
-            (matchComplete, keysStillMatching) = check_quote_announcement_lines_match(currentQuoteAnnounce, keysStillMatching, line)
-            if matchComplete:
-                line_state = LineState.QuoteAnnounceLastLine
-                quote_prefix_regex = quote_announcement_lines_regexes[keysStillMatching[0]]['quotePrefixRegex']
-            elif len(keysStillMatching) > 0:
-                line_state = LineState.PotentialQuoteAnnounce
-            elif quote_prefix_regex.match(line):
-                line_state = LineState.PrefixedQuote
-            elif whitespace_line_regex.match(line):
-                line_state = LineState.AllWhiteSpace
-            else:
-                line_state = LineState.Normal
-            if line_state == LineState.Normal:
-                if((previous_line_state != LineState.AllWhiteSpace) & len(currentWhiteSpace) > 0):
-                    retval += currentWhiteSpace
-                    currentWhiteSpace = []
-                if(len(currentQuote) > 0):
-                    retval += currentQuoteAnnounce
-                    retval += currentQuote
-                    currentQuote = []
-                    currentQuoteAnnounce = []
-                if(previous_line_state == LineState.AllWhiteSpace):
-                    retval += currentWhiteSpace
-                    currentWhiteSpace = []
-                retval.append(line)
-            elif line_state == LineState.PrefixedQuote:
-                currentQuote.append(line)
-            elif line_state == LineState.QuoteAnnounceLastLine:
-                currentQuoteAnnounce = []
-            elif line_state == LineState.AllWhiteSpace:
-                currentWhiteSpace.append(line)
-            if debug:
-                print "%-30s %s" % (line_state, line)
-        #if line_state == LineState.PrefixedQuote | (line_state == LineState.AllWhiteSpace & line_state_before_transition == LineState.PrefixedQuote)
-            #We just let trailing quotes and whitespace die...
-        return '\n'.join(retval)
+
+        See :py:mod:`assembl.lib.email_quoting`"""
+        return strip_full_message_quoting_plaintext(message_body)
 
     @staticmethod
     def strip_full_message_quoting_html(message_body):
         """Assumes any encoding conversions have already been done
-        """
-        #Most useful to develop this:
-        #http://www.motobit.com/util/quoted-printable-decoder.asp
-        #http://www.freeformatter.com/html-formatter.html
-        #http://www.freeformatter.com/xpath-tester.html#ad-output
-
-        debug = True;
-        from lxml import html, etree
-
-        doc = None
-        try:
-            doc = html.fromstring(message_body)
-        except etree.ParserError: # If the parsed HTML document is empty, we get a "ParserError: Document is empty" exception. So the stripped message we return is an empty string (if we keep the exception it blocks the SourceReader)
-            return ""
-
-        #Strip GMail quotes
-        matches = doc.find_class('gmail_quote')
-        if len(matches) > 0:
-            if not matches[0].text or "---------- Forwarded message ----------" not in matches[0].text:
-                matches[0].drop_tree()
-                return html.tostring(doc)
-
-        #Strip modern Apple Mail quotes
-        find = etree.XPath(r"//child::blockquote[contains(@type,'cite')]/preceding-sibling::br[contains(@class,'Apple-interchange-newline')]/parent::node()/parent::node()")
-        matches = find(doc)
-        #print len(matches)
-        #for index,match in enumerate(matches):
-        #    print "Match: %d: %s " % (index, html.tostring(match))
-        if len(matches) == 1:
-            matches[0].drop_tree()
-            return html.tostring(doc)
-
-
-        #Strip old AppleMail quotes (french)
-        regexpNS = "http://exslt.org/regular-expressions"
-        ##Trying to match:  Le 6 juin 2011 à 11:02, Jean-Michel Cornu a écrit :
-        find = etree.XPath(r"//child::div[re:test(text(), '^.*Le .*\d{4} .*:\d{2}, .* a .*crit :.*$', 'i')]/following-sibling::br[contains(@class,'Apple-interchange-newline')]/parent::node()",
-                    namespaces={'re':regexpNS})
-        matches = find(doc)
-        if len(matches) == 1:
-            matches[0].drop_tree()
-            return html.tostring(doc)
-
-        #Strip Outlook quotes (when outlook gives usable structure)
-        find = etree.XPath(r"//body/child::blockquote/child::div[contains(@class,'OutlookMessageHeader')]/parent::node()")
-        matches = find(doc)
-        if len(matches) == 1:
-            matches[0].drop_tree()
-            return html.tostring(doc)
-
-        #Strip Outlook quotes (when outlook gives NO usable structure)
-        successiveStringsToMatch = [
-                                        '|'.join(['^From:.*$','^De :.*$']),
-                                        '|'.join(['^Sent:.*$','^Envoy.+ :.*$']),
-                                        '|'.join(['^To:.*$','^.+:.*$']), #Trying to match À, but unicode is really problematic in lxml regex
-                                        '|'.join(['^Subject:.*$','^Objet :.*$']),
-                                    ]
-        regexpNS = "http://exslt.org/regular-expressions"
-        successiveStringsToMatchRegex = []
-        for singleHeaderLanguageRegex in successiveStringsToMatch:
-            successiveStringsToMatchRegex.append(r"descendant::*[re:test(text(), '"+singleHeaderLanguageRegex+"')]")
-
-        regex = " and ".join(successiveStringsToMatchRegex)
-        find = etree.XPath(r"//descendant::div["+regex+"]",
-                            namespaces={'re':regexpNS})
-        matches = find(doc)
-        if len(matches) == 1:
-            findQuoteBody = etree.XPath(r"//descendant::div["+regex+"]/following-sibling::*",
-                            namespaces={'re':regexpNS})
-            quoteBodyElements = findQuoteBody(doc)
-            for quoteElement in quoteBodyElements:
-                #This moves the text to the tail of matches[0]
-                quoteElement.drop_tree()
-            matches[0].tail = None
-            matches[0].drop_tree()
-            return html.tostring(doc)
-
-        #Strip Thunderbird quotes
-        mainXpathFragment = "//child::blockquote[contains(@type,'cite') and boolean(@cite)]"
-        find = etree.XPath(mainXpathFragment+"/self::blockquote")
-        matches = find(doc)
-        if len(matches) == 1:
-            matchQuoteAnnounce = doc.xpath(mainXpathFragment+"/preceding-sibling::*")
-            if len(matchQuoteAnnounce) > 0:
-                matchQuoteAnnounce[-1].tail = None
-                matches[0].drop_tree()
-                return html.tostring(doc)
-
-        #Nothing was stripped...
-        return html.tostring(doc)
-
-    def parse_email(self, message_string, existing_email=None):
-        """ Creates or replace a email from a string """
-        parsed_email = email.message_from_string(message_string)
-        body = None
-        error_description = None
-
-        def get_payload(message):
-            """ Returns the first text/html body, and falls back to text/plain body """
-
-            def process_part(part, default_charset, text_part, html_part):
-                """ Returns the first text/plain body as a unicode object, and the first text/html body """
-                if part.is_multipart():
-                    for part in part.get_payload():
-                        charset = part.get_content_charset(default_charset)
-                        (text_part, html_part) = process_part(
-                            part, charset, text_part, html_part)
-                else:
-                    charset = part.get_content_charset(default_charset)
-                    decoded_part = part.get_payload(decode=True)
-                    decoded_part = decoded_part.decode(charset, 'replace')
-                    if part.get_content_type() == 'text/plain' and text_part is None:
-                        text_part = decoded_part
-                    elif part.get_content_type() == 'text/html' and html_part is None:
-                        html_part = decoded_part
-                return (text_part, html_part)
-
-            html_part = None
-            text_part = None
-            default_charset = message.get_charset() or 'ISO-8859-1'
-            (text_part, html_part) = process_part(message, default_charset, text_part, html_part)
-            if html_part:
-                return ('text/html',self.sanitize_html(AbstractMailbox.strip_full_message_quoting_html(html_part)))
-            elif text_part:
-                return ('text/plain', AbstractMailbox.strip_full_message_quoting_plaintext(text_part))
-            else:
-                return ('text/plain',u"Sorry, no assembl-supported mime type found in message parts")
-
-        (mimeType, body) = get_payload(parsed_email)
 
-        def email_header_to_unicode(header_string, join_crlf=True):
-            decoded_header = decode_email_header(header_string)
-            default_charset = 'ASCII'
+        See :py:mod:`assembl.lib.email_quoting`"""
+        return strip_full_message_quoting_html(message_body)
 
-            text = ''.join(
-                [
-                    unicode(t[0], t[1] or default_charset) for t in
-                    decoded_header
-                ]
-            )
-            if join_crlf:
-                text = u''.join(text.split('\r\n'))
+    def parse_email(self, message_string, existing_email=None, email_data=None):
+        """ Creates or replace a email from a string
 
-            return text
-
-        new_message_id = parsed_email.get('Message-ID', None)
-        if new_message_id:
-            new_message_id = self.clean_angle_brackets(
-                email_header_to_unicode(new_message_id))
-        else:
-            error_description = "Unable to parse the Message-ID for message string: \n%s" % message_string
+        :param email_data: the result of :py:func:`extract_email_data`
+            on the message string, if already computed.
+        :returns: (email object, None, error description)"""
+        if email_data is None:
+            email_data = extract_email_data(message_string)
+        (data, error_description) = email_data
+        if error_description:
             return (None, None, error_description)
-
-        assert new_message_id
-
-        new_in_reply_to = parsed_email.get('In-Reply-To', None)
-        if new_in_reply_to:
-            new_in_reply_to = self.clean_angle_brackets(
-                email_header_to_unicode(new_in_reply_to))
-
-        sender = email_header_to_unicode(parsed_email.get('From'))
-        sender_name, sender_email = parseaddr(sender)
-        sender_email_account = EmailAccount.get_or_make_profile(self.db, sender_email, sender_name)
-        creation_date = datetime.utcfromtimestamp(
-            mktime_tz(parsedate_tz(parsed_email['Date'])))
-        subject = email_header_to_unicode(parsed_email['Subject'], False)
-        recipients = email_header_to_unicode(parsed_email['To'])
-        body = body.strip()
+        new_message_id = data['message_id']
+        new_in_reply_to = data['in_reply_to']
+        sender = data['sender']
+        sender_email_account = EmailAccount.get_or_make_profile(
+            self.db, data['sender_email'], data['sender_name'])
+        creation_date = data['creation_date']
+        subject = data['subject']
+        recipients = data['recipients']
+        body = data['body']
+        mimeType = data['mime_type']
         # Try/except for a normal situation is an anti-pattern,
         # but sqlalchemy doesn't have a function that returns
         # 0, 1 result or an exception
         try:
-            email_object = self.db.query(Email).filter(
-                Email.source_post_id == new_message_id,
-                Email.discussion_id == self.discussion_id,
-                Email.source == self
-            ).one()
+            if (existing_email is not None
+                    and existing_email.source_post_id == new_message_id
+                    and existing_email.source_id == self.id):
+                # Reprocessing: no need to look it up
+                email_object = existing_email
+            else:
+                email_object = self.db.query(Email).filter(
+                    Email.source_post_id == new_message_id,
+                    Email.discussion_id == self.discussion_id,
+                    Email.source == self
+                ).one()
             if existing_email and existing_email != email_object:
                 raise ValueError("The existing object isn't the same as the one found by message id")
             email_object.recipients = recipients
@@ -463,6 +216,7 @@ class AbstractMailbox(PostSource):
             email_object.in_reply_to = new_in_reply_to
             email_object.body_mime_type = mimeType
             email_object.imported_blob = message_string
+            email_object.set_references(data['references'])
             # TODO MAP: Make this nilpotent.
             email_object.subject = LangString.create(subject)
             email_object.body = LangString.create(body)
@@ -480,6 +234,7 @@ class AbstractMailbox(PostSource):
                 body_mime_type = mimeType,
                 imported_blob=message_string
             )
+            email_object.set_references(data['references'])
         except MultipleResultsFound:
             """ TO find duplicates (this should no longer happen, but in case it ever does...
 
@@ -513,108 +268,108 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
             raise MultipleResultsFound("ID %s has duplicates in source %d"%(new_message_id,self.id))
         email_object.creator = sender_email_account.profile
         # email_object = self.db.merge(email_object)
-        return (email_object, parsed_email, error_description)
+        return (email_object, None, error_description)
 
-    """
-    emails have to be a complete set
-    """
     @staticmethod
     def thread_mails(emails):
-        #print('Threading...')
-        emails_for_threading = []
-        for mail in emails:
-            email_for_threading = jwzthreading.make_message(email.message_from_string(mail.imported_blob))
-            #Store our emailsubject, jwzthreading does not decode subject itself
-            email_for_threading.subject = mail.subject.first_original().value
-            #Store our email object pointer instead of the raw message text
-            email_for_threading.message = mail
-            emails_for_threading.append(email_for_threading)
-
-        threaded_emails = jwzthreading.thread(emails_for_threading)
-
-        # Output
-        L = threaded_emails.items()
-        L.sort()
-        for subj, container in L:
-            jwzthreading.print_container(container, 0, True)
-
-        def update_threading(threaded_emails, parent=None, debug=False):
-            if debug:
-                print "\n\nEntering update_threading() for %s mails:" % len(threaded_emails)
-            for container in threaded_emails:
-                if debug:
-                    #jwzthreading.print_container(container)
-                    print("\nProcessing:  " + repr(container.message.subject.first_original().value) + " " + repr(container.message.message_id)+ " " + repr(container.message.message.id))
-                    print "container: " + (repr(container))
-                    print "parent: " + repr(container.parent)
-                    print "children: " + repr(container.children)
-
-
-
-                if(container.message):
-                    current_parent = container.message.message.parent
-                    if(current_parent):
-                        db_parent_message_id = current_parent.message_id
-                    else:
-                        db_parent_message_id = None
-
-                    if parent:
-                        if parent.message:
-                            #jwzthreading strips the <>, re-add them
-                            algorithm_parent_message_id = unicode("<"+parent.message.message_id+">")
-                        else:
-                            if debug:
-                                print "Parent was a dummy container, we may need \
-                                     to handle this case better, as we just \
-                                     potentially lost sibbling relationships"
-                            algorithm_parent_message_id = None
-                    else:
-                        algorithm_parent_message_id = None
-                    if debug:
-                        print("Current parent from database: " + repr(db_parent_message_id))
-                        print("Current parent from algorithm: " + repr(algorithm_parent_message_id))
-                        print("References: " + repr(container.message.references))
-                    if algorithm_parent_message_id != db_parent_message_id:
-                        if current_parent == None or isinstance(current_parent, Email):
-                            if debug:
-                                print("UPDATING PARENT for :" + repr(container.message.message.message_id))
-                            new_parent = parent.message.message if algorithm_parent_message_id else None
-                            if debug:
-                                print repr(new_parent)
-                            container.message.message.set_parent(new_parent)
-                        else:
-                            if debug:
-                                print "Skipped reparenting:  the current parent \
-                                isn't an email, the threading algorithm only \
-                                considers mails"
-                    update_threading(container.children, container, debug=debug)
-                else:
-                    if debug:
-                        print "Current message ID: None, was a dummy container"
-                    update_threading(container.children, parent, debug=debug)
-
-        update_threading(threaded_emails.values(), debug=False)
+        """Thread new or changed emails, with the index of their references.
+
+        Each email goes under the nearest email of the discussion it refers
+        to, as jwz threading does once missing messages are pruned.
+        Only the given emails and the emails that refer to them are
+        re-parented, so the cost depends on the number of new emails,
+        not on the size of the discussion. Emails that do not refer to any
+        known email, or whose parent is not an email, are left as they are.
+
+        :param emails: emails of a single discussion"""
+        emails = [e for e in emails if e is not None]
+        if not emails:
+            return
+        db = emails[0].db
+        db.flush()
+        discussion_id = emails[0].discussion_id
+        affected = {e.id: e for e in emails}
+        # Existing emails that refer to the new ones may need a closer parent
+        referring = db.query(Email).join(
+            EmailReference, EmailReference.email_id == Email.id).filter(
+            Email.discussion_id == discussion_id,
+            EmailReference.message_id.in_({e.message_id for e in emails}))
+        for email_object in referring:
+            affected.setdefault(email_object.id, email_object)
+        references = defaultdict(list)
+        for (email_id, message_id) in db.query(
+                EmailReference.email_id, EmailReference.message_id).filter(
+                EmailReference.email_id.in_(affected.keys())).order_by(
+                EmailReference.email_id, EmailReference.position):
+            references[email_id].append(message_id)
+        referenced = set()
+        for message_ids in references.itervalues():
+            referenced.update(message_ids)
+        emails_by_message_id = {}
+        if referenced:
+            emails_by_message_id = {e.message_id: e for e in db.query(
+                Email).filter(Email.discussion_id == discussion_id,
+                              Email.message_id.in_(referenced))}
+
+        for email_object in sorted(
+                affected.itervalues(), key=lambda e: e.creation_date):
+            new_parent = None
+            for message_id in reversed(references[email_object.id]):
+                candidate = emails_by_message_id.get(message_id, None)
+                # Avoid cycles from inconsistent references
+                if candidate is not None and candidate != email_object and \
+                        email_object.id not in candidate.ancestor_ids():
+                    new_parent = candidate
+                    break
+            current_parent = email_object.parent
+            if new_parent is None or new_parent == current_parent:
+                continue
+            if current_parent is not None and not isinstance(
+                    current_parent, Email):
+                # The threading algorithm only considers mails
+                continue
+            email_object.set_parent(new_parent)
 
     def reprocess_content(self):
         """ Allows re-parsing all content as if it were imported for the first time
             but without re-hitting the source, or changing the object ids.
             Call when a code change would change the representation in the database
+
+            Emails are parsed in a pool (see :py:func:`parsing_pool`),
+            and written by batches of mail_import.commit_batch_size,
+            one commit per batch.
             """
+        from assembl.lib.config import get_config
+        batch_size = int(get_config().get(
+            'mail_import.commit_batch_size', 100))
         session = self.db
-        emails = session.query(Email).filter(
-                Email.source_id == self.id,
-                ).options(joinedload_all(Email.parent))
-        for email in emails:
-            #session = self.db
-            #session.add(email)
-            (email_object, dummy, error) = self.parse_email(
-                email.imported_blob, email)
-            #session.add(email_object)
-            session.commit()
-            #session.remove()
-
-        with transaction.manager:
-            self.thread_mails(emails)
+        mailbox_id = self.id
+        email_ids = [id for (id,) in session.query(Email.id).filter(
+            Email.source_id == mailbox_id).order_by(Email.id)]
+        progress = MailProgress("Reprocessed", len(email_ids))
+
+        def batches():
+            for start in range(0, len(email_ids), batch_size):
+                yield session.query(Email.id, Email.imported_blob).filter(
+                    Email.id.in_(email_ids[start:start + batch_size])).all()
+
+        mbox = self
+        with parsing_pool() as pool:
+            for parsed in parse_batches(batches(), pool):
+                emails = {e.id: e for e in session.query(Email).filter(
+                    Email.id.in_([email_id for (email_id, _, _) in parsed]))}
+                for (email_id, blob, email_data) in parsed:
+                    (email_object, dummy, error) = mbox.parse_email(
+                        blob, emails[email_id], email_data)
+                    if error:
+                        print "Could not reprocess email %d: %s" % (
+                            email_id, error)
+                mbox.thread_mails(emails.values())
+                mark_changed()
+                transaction.commit()
+                progress.update(len(parsed))
+                mbox = AbstractMailbox.get(mailbox_id)
+        progress.report()
 
     def import_content(self, only_new=True):
         from assembl.lib.config import get_config
@@ -666,8 +421,7 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
 
         The reference is La référence est http://tools.ietf.org/html/rfc3834
         """
-        #TODO:  This is a double-parse, refactor parse_message so we can reuse it
-        parsed_email = email.message_from_string(message_string)
+        parsed_email = HeaderParser().parsestr(message_string)
         if parsed_email.get('Return-Path', None) == '<>':
             #TODO:  Check if a report-type=delivery-status; is present,
             # and process the bounce
@@ -689,6 +443,216 @@ FROM post WHERE post.id IN (SELECT MAX(post.id) as max_post_id FROM imported_pos
         return source_post_id
 
 
+def email_header_to_unicode(header_string, join_crlf=True):
+    decoded_header = decode_email_header(header_string)
+    default_charset = 'ASCII'
+
+    text = ''.join(
+        [
+            unicode(t[0], t[1] or default_charset) for t in
+            decoded_header
+        ]
+    )
+    if join_crlf:
+        text = u''.join(text.split('\r\n'))
+
+    return text
+
+
+_message_id_re = re.compile(r'<([^<>\s]+)>')
+
+
+def email_references(parsed_email):
+    """The Message-IDs an email refers to, nearest last, as in jwz threading:
+    those of the References header, then the first one of In-Reply-To.
+
+    :param parsed_email: a :py:class:`email.message.Message`, headers suffice
+    """
+    def message_ids(header_name):
+        header = parsed_email.get(header_name, None)
+        if not header:
+            return []
+        return _message_id_re.findall(email_header_to_unicode(header))
+    references = message_ids('References')
+    in_reply_to = message_ids('In-Reply-To')
+    if in_reply_to and in_reply_to[0] not in references:
+        references.append(in_reply_to[0])
+    own_ids = message_ids('Message-ID')
+    return [message_id for message_id in references
+            if message_id not in own_ids]
+
+
+def extract_email_data(message_string):
+    """Parse an email into the values of an :py:class:`Email`.
+
+    This does not use the database, so it can run in another process.
+
+    :returns: (a dictionary of values, None), or (None, error description)
+    """
+    parsed_email = email.message_from_string(message_string)
+
+    def get_payload(message):
+        """ Returns the first text/html body, and falls back to text/plain body """
+
+        def process_part(part, default_charset, text_part, html_part):
+            """ Returns the first text/plain body as a unicode object, and the first text/html body """
+            if part.is_multipart():
+                for part in part.get_payload():
+                    charset = part.get_content_charset(default_charset)
+                    (text_part, html_part) = process_part(
+                        part, charset, text_part, html_part)
+            else:
+                charset = part.get_content_charset(default_charset)
+                decoded_part = part.get_payload(decode=True)
+                decoded_part = decoded_part.decode(charset, 'replace')
+                if part.get_content_type() == 'text/plain' and text_part is None:
+                    text_part = decoded_part
+                elif part.get_content_type() == 'text/html' and html_part is None:
+                    html_part = decoded_part
+            return (text_part, html_part)
+
+        html_part = None
+        text_part = None
+        default_charset = message.get_charset() or 'ISO-8859-1'
+        (text_part, html_part) = process_part(message, default_charset, text_part, html_part)
+        if html_part:
+            return ('text/html', AbstractMailbox.sanitize_html(AbstractMailbox.strip_full_message_quoting_html(html_part)))
+        elif text_part:
+            return ('text/plain', AbstractMailbox.strip_full_message_quoting_plaintext(text_part))
+        else:
+            return ('text/plain',u"Sorry, no assembl-supported mime type found in message parts")
+
+    new_message_id = parsed_email.get('Message-ID', None)
+    if new_message_id:
+        new_message_id = AbstractMailbox.clean_angle_brackets(
+            email_header_to_unicode(new_message_id))
+    else:
+        error_description = "Unable to parse the Message-ID for message string: \n%s" % message_string
+        return (None, error_description)
+
+    assert new_message_id
+
+    (mimeType, body) = get_payload(parsed_email)
+
+    new_in_reply_to = parsed_email.get('In-Reply-To', None)
+    if new_in_reply_to:
+        new_in_reply_to = AbstractMailbox.clean_angle_brackets(
+            email_header_to_unicode(new_in_reply_to))
+
+    sender = email_header_to_unicode(parsed_email.get('From'))
+    sender_name, sender_email = parseaddr(sender)
+    return (dict(
+        message_id=new_message_id,
+        in_reply_to=new_in_reply_to,
+        references=email_references(parsed_email),
+        sender=sender,
+        sender_name=sender_name,
+        sender_email=sender_email,
+        creation_date=datetime.utcfromtimestamp(
+            mktime_tz(parsedate_tz(parsed_email['Date']))),
+        subject=email_header_to_unicode(parsed_email['Subject'], False),
+        recipients=email_header_to_unicode(parsed_email['To']),
+        body=body.strip(),
+        mime_type=mimeType), None)
+
+
+_parsing_pool = None
+_parsing_pool_lock = threading.Lock()
+
+
+def init_parsing_pool():
+    """Create the process pool shared by all email imports, with
+    mail_import.parsing_processes processes, if allowed.
+
+    Forking is only safe before other threads are started: multithreaded
+    programs, like the :py:mod:`assembl.tasks.source_reader`, must call
+    this at startup."""
+    global _parsing_pool
+    from assembl.lib.config import get_config
+    processes = int(get_config().get('mail_import.parsing_processes', 0))
+    with _parsing_pool_lock:
+        if (_parsing_pool is None and processes > 1
+                and not multiprocessing.current_process().daemon):
+            _parsing_pool = multiprocessing.Pool(processes)
+    return _parsing_pool
+
+
+@contextmanager
+def parsing_pool():
+    """A pool to run :py:func:`extract_email_data` on many emails.
+
+    This is the shared process pool, if :py:func:`init_parsing_pool` was
+    called. Otherwise, a pool is created for this use only, with
+    mail_import.parsing_processes processes, if allowed and if no other
+    thread runs; a single thread still parses while the caller does I/O."""
+    if _parsing_pool is not None:
+        yield _parsing_pool
+        return
+    pool = None
+    if threading.active_count() == 1 and \
+            not multiprocessing.current_process().daemon:
+        from assembl.lib.config import get_config
+        processes = int(get_config().get(
+            'mail_import.parsing_processes', 0))
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+    if pool is None:
+        pool = ThreadPool(1)
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+
+
+def parse_batches(batches, pool):
+    """Run :py:func:`extract_email_data` on batches of messages in the pool.
+
+    Each batch is parsed while the caller handles the previous one, and
+    the next batch is only read from `batches` after that, so reading
+    messages, parsing them and writing emails overlap.
+
+    :param batches: an iterable of lists of (key, message string)
+    :returns: an iterator of lists of (key, message string, email data)"""
+    parsing = None
+    for batch in chain(batches, [None]):
+        next_parsing = None
+        if batch:
+            next_parsing = (batch, pool.map_async(
+                extract_email_data,
+                [message_string for (key, message_string) in batch]))
+        if parsing is not None:
+            (previous_batch, results) = parsing
+            yield [(key, message_string, email_data)
+                   for ((key, message_string), email_data)
+                   in zip(previous_batch, results.get())]
+        parsing = next_parsing
+
+
+class MailProgress(object):
+    """Reports the progress and throughput of a bulk email operation."""
+
+    def __init__(self, action, total=None, every=1000):
+        self.action = action
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.reported = 0
+        self.start = time.time()
+
+    def update(self, count):
+        self.done += count
+        if self.done - self.reported >= self.every:
+            self.report()
+
+    def report(self):
+        self.reported = self.done
+        elapsed = max(time.time() - self.start, 0.001)
+        print "%s %d%s emails in %.1fs (%.1f emails/s)" % (
+            self.action, self.done,
+            "/%d" % self.total if self.total is not None else "",
+            elapsed, self.done / elapsed)
+
+
 class IMAPMailbox(AbstractMailbox):
     """
     A IMAPMailbox refers to an Email inbox that can be accessed with IMAP.
@@ -760,51 +724,123 @@ class IMAPMailbox(AbstractMailbox):
             assert search_status == 'OK'
             email_ids = search_result[0].split()
 
-        def import_email(mailbox_obj, email_id):
-            session = mailbox_obj.db
-            #print "running fetch for message: "+email_id
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            assert status == 'OK'
-
-            #print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            assert message_string
-            if mailbox_obj.message_ok_to_import(message_string):
-                (email_object, dummy, error) = mailbox_obj.parse_email(message_string)
-                if error:
-                    raise Exception(error)
-                session.add(email_object)
-                translate_content(email_object)  # should delay
-            else:
-                print "Skipped message with imap id %s (bounce or vacation message)"% (email_id)
-            #print "Setting mailbox_obj.last_imported_email_uid to "+email_id
-            mailbox_obj.last_imported_email_uid = email_id
-            transaction.commit()
-            mailbox_obj = AbstractMailbox.get(mailbox_obj.id)
-
         if len(email_ids):
             print "Processing messages from IMAP: %d "% (len(email_ids))
-            new_emails = [import_email(mbox, email_id) for email_id in email_ids]
+            mbox = mbox.import_imap_messages(mailbox, email_ids)
         else:
             print "No IMAP messages to process"
 
-        discussion_id = mbox.discussion_id
         mailbox.close()
         mailbox.logout()
         mark_changed()
         transaction.commit()
 
-        with transaction.manager:
-            if len(email_ids):
-                #We imported mails, we need to re-thread
-                emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-                AbstractMailbox.thread_mails(emails)
-                mark_changed()
+    _fetch_uid_re = re.compile(r'\bUID (\d+)')
+
+    @classmethod
+    def fetch_messages(cls, mailbox, email_ids):
+        """Fetch messages by UID with a single FETCH command.
+
+        :returns: a list of (uid, message string), in UID order"""
+        status, message_data = mailbox.uid(
+            'fetch', ','.join(email_ids), "(UID RFC822)")
+        if status != 'OK':
+            raise IMAP4.error(message_data)
+        messages = []
+        for response_part in message_data:
+            if isinstance(response_part, tuple):
+                match = cls._fetch_uid_re.search(response_part[0])
+                messages.append(
+                    [match.group(1) if match else None, response_part[1]])
+            elif messages and messages[-1][0] is None:
+                # Some servers send the UID after the message literal
+                match = cls._fetch_uid_re.search(response_part or '')
+                if match:
+                    messages[-1][0] = match.group(1)
+        if not all(uid for (uid, message_string) in messages):
+            raise IMAP4.error("Missing UID in FETCH response")
+        messages.sort(key=lambda (uid, message_string): int(uid))
+        return [tuple(message) for message in messages]
+
+    def import_imap_messages(self, mailbox, email_ids, stop=None, commit=None):
+        """Import the messages with those UIDs, in order.
+
+        Messages are fetched with one FETCH command per
+        mail_import.fetch_batch_size messages. The next batch is fetched
+        while the current one is parsed by a pool of processes (see
+        :py:func:`parsing_pool`), and emails are committed by
+        mail_import.commit_batch_size, with last_imported_email_uid,
+        after threading them.
+
+        :param stop: a function that tells whether to stop importing,
+            checked after each commit
+        :param commit: the function that commits the session,
+            if it is not managed by the transaction manager
+        :returns: the mailbox, as reloaded after the last commit"""
+        from assembl.lib.config import get_config
+        config = get_config()
+        fetch_size = int(config.get('mail_import.fetch_batch_size', 200))
+        commit_size = int(config.get('mail_import.commit_batch_size', 100))
+        progress = MailProgress("Imported", len(email_ids))
+
+        def batches():
+            for start in range(0, len(email_ids), fetch_size):
+                yield self.fetch_messages(
+                    mailbox, email_ids[start:start + fetch_size])
+
+        mbox = self
+        with parsing_pool() as pool:
+            uncommitted = []
+            for parsed in parse_batches(batches(), pool):
+                for (uid, message_string, email_data) in parsed:
+                    uncommitted.append(mbox.import_imap_message(
+                        uid, message_string, email_data))
+                    if len(uncommitted) >= commit_size:
+                        mbox.thread_mails(uncommitted)
+                        mbox = mbox.commit_imap_import(commit)
+                        progress.update(len(uncommitted))
+                        uncommitted = []
+                        if stop and stop():
+                            return mbox
+            if uncommitted:
+                mbox.thread_mails(uncommitted)
+                mbox = mbox.commit_imap_import(commit)
+                progress.update(len(uncommitted))
+        progress.report()
+        return mbox
+
+    def import_imap_message(self, email_id, message_string, email_data):
+        """Import a message fetched from IMAP, without committing it
+
+        :returns: the email, or None if the message was skipped
+        :raises ValueError: if the message cannot be parsed"""
+        if self.message_ok_to_import(message_string):
+            (email_object, dummy, error) = self.parse_email(
+                message_string, email_data=email_data)
+            if error:
+                raise ValueError(error)
+            self.db.add(email_object)
+            # Later messages of the batch may be duplicates of this one
+            self.db.flush()
+            translate_content(email_object)  # should delay
+        else:
+            email_object = None
+            print "Skipped message with imap id %s (bounce or vacation message)"% (email_id)
+        self.last_imported_email_uid = email_id
+        return email_object
+
+    def commit_imap_import(self, commit=None):
+        """Commit imported messages with the last imported UID, so an
+        interrupted import resumes after the last committed message.
+
+        :returns: the mailbox, reloaded"""
+        mailbox_id = self.id
+        if commit is None:
+            mark_changed()
+            transaction.commit()
+        else:
+            commit()
+        return AbstractMailbox.get(mailbox_id)
 
     def make_reader(self):
         from assembl.tasks.imaplib2_source_reader import IMAPReader
@@ -879,7 +915,6 @@ class MaildirMailbox(AbstractFilesystemMailbox):
         abstract_mbox = abstract_mbox.db.merge(abstract_mbox)
         session = abstract_mbox.db
         session.add(abstract_mbox)
-        discussion_id = abstract_mbox.discussion_id
 
         if not os.path.isdir(abstract_mbox.filesystem_path):
             raise "There is no directory at %s" % abstract_mbox.filesystem_path
@@ -904,29 +939,39 @@ class MaildirMailbox(AbstractFilesystemMailbox):
                     os.mkdir(tmp_folder_path)
 
         mbox = mailbox.Maildir(abstract_mbox.filesystem_path, factory=None, create=False)
-        mails = mbox.values()
-        #import pdb; pdb.set_trace()
-        def import_email(abstract_mbox, message_data):
-            session = abstract_mbox.db
-            message_string = message_data.as_string()
-
-            (email_object, dummy, error) = abstract_mbox.parse_email(message_string)
-            if error:
-                raise Exception(error)
-            session.add(email_object)
-            transaction.commit()
-            abstract_mbox = AbstractMailbox.get(abstract_mbox.id)
-
-        if len(mails):
-            [import_email(abstract_mbox, message_data) for message_data in mails]
-
-            #We imported mails, we need to re-thread
-            emails = session.query(Email).filter(
-                    Email.discussion_id == discussion_id,
-                    ).options(joinedload_all(Email.parent))
-
-            AbstractMailbox.thread_mails(emails)
-            transaction.commit()
+        keys = mbox.keys()
+        if not keys:
+            return
+        from assembl.lib.config import get_config
+        batch_size = int(get_config().get(
+            'mail_import.commit_batch_size', 100))
+        mailbox_id = abstract_mbox.id
+        progress = MailProgress("Imported", len(keys))
+
+        def batches():
+            for start in range(0, len(keys), batch_size):
+                yield [(key, mbox.get_string(key))
+                       for key in keys[start:start + batch_size]]
+
+        with parsing_pool() as pool:
+            for parsed in parse_batches(batches(), pool):
+                emails = []
+                for (key, message_string, email_data) in parsed:
+                    (email_object, dummy, error) = abstract_mbox.parse_email(
+                        message_string, email_data=email_data)
+                    if error:
+                        raise Exception(error)
+                    session.add(email_object)
+                    # Later messages of the batch may be duplicates of this one
+                    session.flush()
+                    emails.append(email_object)
+                #We imported mails, we need to thread them
+                AbstractMailbox.thread_mails(emails)
+                mark_changed()
+                transaction.commit()
+                progress.update(len(parsed))
+                abstract_mbox = AbstractMailbox.get(mailbox_id)
+        progress.report()
 
 class Email(ImportedPost):
     """
@@ -946,10 +991,21 @@ class Email(ImportedPost):
 
     in_reply_to = Column(CoerceUnicode())
 
+    references = relationship(
+        'EmailReference', order_by='EmailReference.position',
+        cascade="all, delete-orphan", passive_deletes=True)
+
     __mapper_args__ = {
         'polymorphic_identity': 'email',
     }
 
+    def set_references(self, message_ids):
+        "Store the Message-IDs this email refers to, nearest last."
+        if [ref.message_id for ref in self.references] != message_ids:
+            self.references = [
+                EmailReference(message_id=message_id, position=position)
+                for (position, message_id) in enumerate(message_ids)]
+
     def REWRITEMEreply(self, sender, response_body):
         """
         Send a response to this email.
@@ -1020,3 +1076,18 @@ class Email(ImportedPost):
 
     def get_title(self):
         return self.source.mangle_mail_subject(self.subject)
+
+
+class EmailReference(Base):
+    """A Message-ID that an email refers to, in its References or
+    In-Reply-To headers.
+
+    This indexes references, so emails can be threaded incrementally
+    (see :py:meth:`AbstractMailbox.thread_mails`)."""
+    __tablename__ = "email_reference"
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey(
+        Email.id, ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    position = Column(SmallInteger, nullable=False)
+    message_id = Column(CoerceUnicode(), nullable=False, index=True)
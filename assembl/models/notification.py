@@ -1,6 +1,6 @@
 # coding=UTF-8
 """Allow users to be notified of certain events happening in a discussion. Depends on subscribing to those events."""
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import defaultdict
 from abc import abstractmethod
 import transaction
@@ -22,7 +22,11 @@ from sqlalchemy import (
     DateTime,
     ForeignKey,
     event,
-    inspect
+    inspect,
+    and_,
+    exists,
+    func,
+    select,
 )
 from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload)
@@ -39,8 +43,10 @@ from ..lib.model_watcher import IModelEventWatcher
 from ..lib.decl_enums import DeclEnum
 from ..lib.utils import waiting_get
 from ..lib import config
+from ..auth import R_PARTICIPANT
 from .auth import (
-    User, Everyone, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate)
+    User, Everyone, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate,
+    LocalUserRole, Role)
 from .discussion import Discussion
 from .post import Post, SynthesisPost
 from assembl.semantic.virtuoso_mapping import QuadMapPatternS
@@ -119,6 +125,12 @@ class NotificationSubscriptionStatus(DeclEnum):
     INACTIVE_DFT = "INACTIVE_DFT", "This subscription is defined in the template, but not subscribed by default."
 
 
+class NotificationDigestFrequency(DeclEnum):
+    IMMEDIATE = "IMMEDIATE", "Each notification is sent as soon as it is created"
+    HOURLY = "HOURLY", "Notifications are gathered in one email every hour"
+    DAILY = "DAILY", "Notifications are gathered in one email every day"
+
+
 class NotificationSubscription(DiscussionBoundBase):
     """A subscription to a specific type of notification.
 
@@ -173,6 +185,11 @@ class NotificationSubscription(DiscussionBoundBase):
         DateTime,
         nullable = False,
         default = datetime.utcnow)
+    digest_frequency = Column(
+        NotificationDigestFrequency.db_type(),
+        nullable = False,
+        default = NotificationDigestFrequency.IMMEDIATE,
+        server_default = NotificationDigestFrequency.IMMEDIATE.name)
     user_id = Column(
         Integer,
         ForeignKey(
@@ -204,6 +221,13 @@ class NotificationSubscription(DiscussionBoundBase):
     def class_description(self):
         return self.type.description
 
+    @property
+    def notification_push_method(self):
+        """The push method of the notifications created by this subscription"""
+        if self.digest_frequency == NotificationDigestFrequency.IMMEDIATE:
+            return NotificationPushMethodType.EMAIL
+        return NotificationPushMethodType.EMAIL_DIGEST
+
     @abstractmethod
     def followed_object(self):
         pass
@@ -216,31 +240,49 @@ class NotificationSubscription(DiscussionBoundBase):
         discussion = Discussion.get(object.get_discussion_id())
         return discussion_id == object.get_discussion_id() and discussion in self.user.participant_in_discussion
 
+    @classmethod
+    def applicableCondition(cls, discussion_id, verb, object):
+        """
+        The SQL condition on subscriptions of this class that would fire on
+        the object and verb given, equivalent to :py:meth:`wouldCreateNotification`.
+
+        Returns None if none of them would fire.
+        Subclasses that override wouldCreateNotification must override this.
+        """
+        if discussion_id != object.get_discussion_id():
+            return None
+        is_participant = exists().where(and_(
+            LocalUserRole.user_id == cls.user_id,
+            LocalUserRole.discussion_id == discussion_id,
+            LocalUserRole.requested == False,
+            LocalUserRole.role_id == Role.id,
+            Role.name == R_PARTICIPANT))
+        return and_(cls.discussion_id == discussion_id, is_participant)
+
     @classmethod
     def findApplicableInstances(cls, discussion_id, verb, object, user=None):
         """
         Returns all subscriptions that would fire on the object, and verb given
 
-        This naive implementation instanciates every ACTIVE subscription for every user,
-        and calls "would fire" for each.  It is expected that most subclasses will
-        override this with a more optimal implementation
+        Matching is done in a single query, with :py:meth:`applicableCondition`,
+        so the cost does not depend on the number of subscribers.
         """
-        applicable_subscriptions = []
-        subscriptionsQuery = cls.default_db.query(cls)
-        subscriptionsQuery = subscriptionsQuery.filter(cls.status==NotificationSubscriptionStatus.ACTIVE);
-        subscriptionsQuery = subscriptionsQuery.filter(cls.discussion_id==discussion_id);
+        condition = cls.applicableCondition(discussion_id, verb, object)
+        if condition is None:
+            return []
+        subscriptionsQuery = cls.default_db.query(cls).filter(
+            cls.status == NotificationSubscriptionStatus.ACTIVE, condition)
         if user:
-            subscriptionsQuery = subscriptionsQuery.filter(cls.user==user)
-        #print "findApplicableInstances(called) with discussion_id=%s, verb=%s, object=%s, user=%s"%(discussion_id, verb, object, user)
-        #print repr(subscriptionsQuery.all())
-        for subscription in subscriptionsQuery:
-            if(subscription.wouldCreateNotification(object.get_discussion_id(), verb, object)):
-                applicable_subscriptions.append(subscription)
-        return applicable_subscriptions
+            subscriptionsQuery = subscriptionsQuery.filter(cls.user == user)
+        return subscriptionsQuery.all()
 
     @abstractmethod
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate"""
+        """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate
+
+        :returns: the new notification, if any. It is added to the session
+            but not flushed, nor sent; the caller inserts and dispatches
+            the notifications of an event together."""
         pass
 
     def get_human_readable_description(self):
@@ -593,18 +635,23 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowSyntheses, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, SynthesisPost) and discussion_id == object.get_discussion_id()
 
+    @classmethod
+    def applicableCondition(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, SynthesisPost):
+            return None
+        return super(NotificationSubscriptionFollowSyntheses, cls
+                     ).applicableCondition(discussion_id, verb, object)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        from ..tasks.notify import notify
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
+        # Applicability was checked by findApplicableInstances
         notification = NotificationOnPostCreated(
-            post = objectInstance,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
+            post_id = objectInstance.id,
+            first_matching_subscription_id = self.id,
+            push_method = self.notification_push_method,
             #push_address = TODO
             )
         self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+        return notification
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_SYNTHESES
@@ -621,18 +668,23 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowAllMessages, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, Post) and discussion_id == object.get_discussion_id()
 
+    @classmethod
+    def applicableCondition(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, Post):
+            return None
+        return super(NotificationSubscriptionFollowAllMessages, cls
+                     ).applicableCondition(discussion_id, verb, object)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
+        # Applicability was checked by findApplicableInstances
         notification = NotificationOnPostCreated(
             post_id = objectInstance.id,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
+            first_matching_subscription_id = self.id,
+            push_method = self.notification_push_method,
             #push_address = TODO
             )
         self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+        return notification
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_ALL_MESSAGES
@@ -655,18 +707,30 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
                  and object.parent.creator == self.user
                  )
 
+    @classmethod
+    def applicableCondition(cls, discussion_id, verb, object):
+        if (verb != CrudVerbs.CREATE or not isinstance(object, Post)
+                or object.parent_id is None):
+            return None
+        condition = super(
+            NotificationSubscriptionFollowOwnMessageDirectReplies, cls
+            ).applicableCondition(discussion_id, verb, object)
+        if condition is None:
+            return None
+        parent_creator_id = cls.default_db.query(Post.creator_id).filter(
+            Post.id == object.parent_id).as_scalar()
+        return and_(condition, cls.user_id == parent_creator_id)
+
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
+        # Applicability was checked by findApplicableInstances
         notification = NotificationOnPostCreated(
-            post = objectInstance,
-            first_matching_subscription = self,
-            push_method = NotificationPushMethodType.EMAIL,
+            post_id = objectInstance.id,
+            first_matching_subscription_id = self.id,
+            push_method = self.notification_push_method,
             #push_address = TODO
             )
         self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
+        return notification
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_OWN_MESSAGES_DIRECT_REPLIES
@@ -697,14 +761,27 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(object):
         num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
         print "processEvent: %d notifications created for %s %s %d" % (
             num_instances, verb, objectClass.__name__, objectId)
+        notifications = []
         with transaction.manager:
             for userId, applicableInstances in applicableInstancesByUser.iteritems():
                 if(len(applicableInstances) > 0):
                     applicableInstances.sort(cmp=lambda x,y: cmp(x.priority, y.priority))
-                    applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+                    notification = applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
+                    if notification is not None:
+                        notifications.append(notification)
+            if notifications:
+                Notification.allocate_ids(objectInstance.db, notifications)
+                objectInstance.db.flush()
+            # Digest notifications are sent by the send_digests task
+            notification_ids = [
+                n.id for n in notifications
+                if n.push_method == NotificationPushMethodType.EMAIL]
         if bool(current_task):
             # In a celery task, there's no one else to commit
             objectInstance.db.commit()
+        if notification_ids:
+            from ..tasks.notify import dispatch_notifications
+            dispatch_notifications(notification_ids)
 
 
     def processPostCreated(self, id):
@@ -740,6 +817,7 @@ class NotificationPushMethodType(DeclEnum):
     The type of event that caused the notification to be created
     """
     EMAIL = "EMAIL", "Email notification"
+    EMAIL_DIGEST = "EMAIL_DIGEST", "Email notification, sent in a periodic digest"
     LOGIN_NOTIFICATION = "LOGIN_NOTIFICATION", "A notification upon next login to Assembl"
 
 class NotificationDeliveryStateType(DeclEnum):
@@ -788,6 +866,18 @@ class NotificationClasses():
     ABSTRACT_NOTIFICATION_SUBSCRIPTION_ON_USERACCOUNT = "ABSTRACT_NOTIFICATION_SUBSCRIPTION_ON_USERACCOUNT"
 
 
+# Delay before the first retry of a failed delivery, doubled at each attempt
+RETRY_BASE_DELAY = timedelta(minutes=5)
+RETRY_MAX_DELAY = timedelta(days=1)
+# Deliveries still failing after that many attempts are abandoned
+MAX_DELIVERY_ATTEMPTS = 15
+
+
+def next_attempt_default():
+    # The dispatched task makes the first attempt; retries come later.
+    return datetime.utcnow() + RETRY_BASE_DELAY
+
+
 class UnverifiedEmailException(Exception):
     pass
 
@@ -857,9 +947,52 @@ class Notification(Base):
     delivery_confirmation_date = Column(
         DateTime,
         nullable = True)
+    delivery_attempts = Column(
+        Integer,
+        nullable = False,
+        default = 0,
+        server_default = '0')
+    next_attempt = Column(
+        DateTime,
+        nullable = True,
+        index = True,
+        default = next_attempt_default,
+        doc="When process_pending_notifications may try to deliver it; "
+            "null when it is not retryable")
 
     threadlocals = threading.local()
 
+    def delivery_attempted(self):
+        """Count an attempt at delivery, and schedule the next one with an
+        exponential backoff if the delivery state allows retries."""
+        self.delivery_attempts = (self.delivery_attempts or 0) + 1
+        if self.delivery_state not in \
+                NotificationDeliveryStateType.getRetryableDeliveryStates():
+            self.next_attempt = None
+        elif self.delivery_attempts >= MAX_DELIVERY_ATTEMPTS:
+            self.delivery_state = NotificationDeliveryStateType.EXPIRED
+            self.next_attempt = None
+        else:
+            self.next_attempt = datetime.utcnow() + min(
+                RETRY_BASE_DELAY * 2 ** (self.delivery_attempts - 1),
+                RETRY_MAX_DELAY)
+
+    def postpone_delivery(self, delay):
+        "Keep process_pending_notifications away until the delay is over."
+        self.next_attempt = datetime.utcnow() + delay + RETRY_BASE_DELAY
+
+    @classmethod
+    def allocate_ids(cls, db, notifications):
+        """Give ids to new notifications with a single query, so the next
+        flush can insert them with one batched statement per table."""
+        if cls.using_virtuoso:
+            return
+        sequence = func.pg_get_serial_sequence(cls.__table__.name, 'id')
+        ids = db.execute(select([func.nextval(sequence)]).select_from(
+            func.generate_series(1, len(notifications)))).fetchall()
+        for notification, (id,) in zip(notifications, ids):
+            notification.id = id
+
     @abstractmethod
     def event_source_object(self):
         pass
@@ -1084,3 +1217,100 @@ class NotificationOnPostCreated(NotificationOnPost):
             template = jinja_env.get_template('notifications/html_mail_post.jinja2')
         html = template.render(**template_data)
         return Premailer(html, disable_leftover_css=True).transform()
+
+
+class NotificationDigest(object):
+    """A single email gathering many notifications of a user on a discussion.
+
+    Quacks enough like a :py:class:`Notification` to be sent by
+    :py:func:`assembl.tasks.notify.process_notification`."""
+
+    def __init__(self, notifications):
+        assert notifications
+        self.notifications = notifications
+        self.first_notification = notifications[0]
+        self.first_matching_subscription = \
+            self.first_notification.first_matching_subscription
+        self.id = ",".join(str(n.id) for n in notifications)
+
+    @property
+    def delivery_state(self):
+        return self.first_notification.delivery_state
+
+    @delivery_state.setter
+    def delivery_state(self, state):
+        for notification in self.notifications:
+            notification.delivery_state = state
+
+    def delivery_attempted(self):
+        for notification in self.notifications:
+            notification.delivery_attempted()
+
+    def postpone_delivery(self, delay):
+        for notification in self.notifications:
+            notification.postpone_delivery(delay)
+
+    def get_to_email_address(self):
+        return self.first_notification.get_to_email_address()
+
+    def get_notification_subject(self):
+        loc = Notification.get_localizer(self.first_matching_subscription.user)
+        count = len(self.notifications)
+        return "[%s] %s" % (
+            self.first_matching_subscription.discussion.topic,
+            loc.pluralize(
+                "${count} new notification", "${count} new notifications",
+                count, domain='assembl', mapping={'count': count}))
+
+    def render_to_email_html_part(self):
+        """The HTML parts of the notifications, in a single document with
+        the header of the first one and the footer of the last one."""
+        from lxml import html as lxml_html
+        document = None
+        parts = filter(None, (
+            n.render_to_email_html_part() for n in self.notifications))
+        for num, part in enumerate(parts):
+            part = lxml_html.document_fromstring(part)
+            if num > 0:
+                for element in part.find_class('header'):
+                    element.drop_tree()
+            if num < len(parts) - 1:
+                for element in part.find_class('callout'):
+                    element.drop_tree()
+            if document is None:
+                document = part
+            else:
+                document.body.append(lxml_html.Element('hr'))
+                for element in part.body:
+                    document.body.append(element)
+        if document is None:
+            return False
+        return lxml_html.tostring(document, encoding=unicode)
+
+    def render_to_email_text_part(self):
+        return "\n\n".join(filter(None, (
+            n.render_to_email_text_part() for n in self.notifications)))
+
+    def render_to_message(self):
+        from ..lib.frontend_urls import FrontendUrls
+        email_text_part = self.render_to_email_text_part() or None
+        email_html_part = self.render_to_email_html_part()
+        if not email_text_part and not email_html_part:
+            return ''
+        discussion = self.first_matching_subscription.discussion
+        frontendUrls = FrontendUrls(discussion)
+        headers = {
+            'Precedence': 'list',
+            'List-ID': discussion.uri(),
+            'Date': email.Utils.formatdate(),
+            'List-Subscribe':
+                frontendUrls.getUserNotificationSubscriptionsConfigurationUrl(),
+            'List-Unsubscribe':
+                frontendUrls.getUserNotificationSubscriptionsConfigurationUrl(),
+        }
+        return Message(
+            subject=self.get_notification_subject(),
+            sender=self.first_notification.get_from_email_address(),
+            recipients=[self.get_to_email_address()],
+            extra_headers=headers,
+            body=email_text_part, html=email_html_part)
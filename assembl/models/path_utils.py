@@ -5,10 +5,12 @@ from functools import total_ordering
 from collections import defaultdict
 from bisect import bisect_right
 
-from sqlalchemy import String
+import numpy as np
+from sqlalchemy import String, Integer, BigInteger
+from sqlalchemy.dialects.postgresql import ARRAY, BIT
 from sqlalchemy.orm import (with_polymorphic, aliased)
-from sqlalchemy.sql.expression import or_, union, except_
-from sqlalchemy.sql.functions import count
+from sqlalchemy.sql.expression import or_, union, except_, cast, literal
+from sqlalchemy.sql.functions import count, func
 
 from .idea_content_link import (
     IdeaContentLink, IdeaContentPositiveLink, IdeaContentNegativeLink)
@@ -55,6 +57,154 @@ from .action import ViewPost
 # I1 < P1, P2, P3
 
 
+def ids_clause(column, ids):
+    """column IN ids, with the ids sent as a single array parameter
+    (there may be many of them.)"""
+    if not ids:
+        return False
+    if Post.using_virtuoso:
+        return column.in_(ids)
+    return column == func.any(literal(ids, ARRAY(Integer)))
+
+
+class PostTreeIndex(object):
+    """In-memory index of the tree of posts of a discussion.
+
+    Posts are numbered in depth-first order, so the descendants of a post
+    occupy the interval of positions that follows it, up to ``ends[pos]``.
+    The posts under a set of post paths then become numpy masks, computed
+    without ``ancestry LIKE`` clauses.
+
+    Indices are kept per process, invalidated locally when posts are
+    created or moved, and checked against a fingerprint of the discussion's
+    posts when fetched (usually once per request.)"""
+    _by_discussion = {}
+
+    def __init__(self, discussion_id, rows, fingerprint=None):
+        self.discussion_id = discussion_id
+        self.fingerprint = fingerprint
+        self.invalidated = False
+        rows = [(tuple(int(x) for x in (ancestry or '').split(',') if x)
+                 + (id,), id, state, hidden, tombstone_date, type)
+                for (id, ancestry, state, hidden, tombstone_date, type)
+                in rows]
+        # lexicographic order of integer paths is depth-first order
+        rows.sort()
+        size = len(rows)
+        self.ids = np.array([row[1] for row in rows], dtype=np.int64)
+        self.position = {row[1]: pos for (pos, row) in enumerate(rows)}
+        self.ends = np.empty(size, dtype=np.int64)
+        ancestors = []
+        for (pos, row) in enumerate(rows):
+            path = row[0]
+            while ancestors and (
+                    path[:len(ancestors[-1][0])] != ancestors[-1][0]):
+                self.ends[ancestors.pop()[1]] = pos
+            ancestors.append((path, pos))
+        for (path, pos) in ancestors:
+            self.ends[pos] = size
+        synth_post_type = SynthesisPost.__mapper_args__['polymorphic_identity']
+        self.live = np.array([row[4] is None for row in rows], dtype=bool)
+        self.deleted = np.array([
+            row[2] in deleted_publication_states for row in rows], dtype=bool)
+        self.visible = np.array([not row[3] for row in rows], dtype=bool)
+        self.countable = self.visible & np.array([
+            row[2] in countable_publication_states for row in rows],
+            dtype=bool)
+        self.not_synthesis = np.array([
+            row[5] != synth_post_type for row in rows], dtype=bool)
+
+    @staticmethod
+    def fingerprint_query(db, discussion_id):
+        """A cheap query whose result changes with the post tree and states,
+        or None if the database cannot compute it.
+
+        The fingerprint sums the first 60 bits of the md5 of each row,
+        so it does not depend on row order."""
+        if Post.using_virtuoso:
+            return None
+        post = with_polymorphic(
+            Post, [], Post.__table__, aliased=False, flat=True)
+        row_hash = func.md5(func.concat(
+            post.id, ':', post.ancestry, post.publication_state,
+            post.hidden, post.tombstone_date))
+        return db.query(
+            count(post.id),
+            func.sum(cast(cast(
+                func.concat('x', func.substr(row_hash, 1, 15)), BIT(60)),
+                BigInteger))
+            ).filter(post.discussion_id == discussion_id)
+
+    @staticmethod
+    def rows_query(db, discussion_id):
+        post = with_polymorphic(
+            Post, [], Post.__table__, aliased=False, flat=True)
+        return db.query(
+            post.id, post.ancestry, post.publication_state, post.hidden,
+            post.tombstone_date, post.type
+            ).filter(post.discussion_id == discussion_id)
+
+    @classmethod
+    def get(cls, db, discussion_id):
+        "Get a current index for the discussion, rebuilding it if needed."
+        fingerprint_query = cls.fingerprint_query(db, discussion_id)
+        fingerprint = None
+        if fingerprint_query is not None:
+            fingerprint = tuple(fingerprint_query.first())
+        index = cls._by_discussion.get(discussion_id, None)
+        if (index is None or fingerprint is None
+                or index.fingerprint != fingerprint):
+            index = cls(discussion_id, cls.rows_query(db, discussion_id),
+                        fingerprint)
+            cls._by_discussion[discussion_id] = index
+        return index
+
+    @classmethod
+    def invalidate(cls, discussion_id):
+        index = cls._by_discussion.pop(discussion_id, None)
+        if index is not None:
+            index.invalidated = True
+
+    def empty_mask(self):
+        return np.zeros(len(self.ids), dtype=bool)
+
+    def mask_of(self, post_ids):
+        "Mask of the given posts (ignoring those outside the discussion)"
+        mask = self.empty_mask()
+        positions = [self.position[id] for id in post_ids
+                     if id in self.position]
+        mask[positions] = True
+        return mask
+
+    def ids_of(self, mask):
+        return self.ids[mask].tolist()
+
+    def paths_mask(self, paths, include_breakpoints=False):
+        """Mask of the posts included in a reduced list of
+        :py:class:`PostPathData`. The closest enclosing path decides."""
+        starts = []
+        for path in paths:
+            pos = self.position.get(path.last_id, None)
+            if pos is not None:
+                starts.append((pos, path.positive))
+        # Enclosing paths come first in depth-first order, so that
+        # enclosed paths override them. Positives win on the same post.
+        starts.sort()
+        mask = self.empty_mask()
+        for (pos, positive) in starts:
+            mask[pos:self.ends[pos]] = positive
+            if include_breakpoints and not positive:
+                mask[pos] = True
+        return mask
+
+    def deleted_filter(self, include_deleted):
+        """Mask equivalent to the include_deleted parameter of
+        :py:meth:`PostPathLocalCollection.as_clause_base`, or None"""
+        if include_deleted is None:
+            return None
+        return self.deleted if include_deleted else self.live
+
+
 @total_ordering
 class PostPathData(object):
     "Data about a single post_path."
@@ -187,15 +337,32 @@ class PostPathLocalCollection(object):
         # by a positive path.
         if subpath.positive:
             return False
-        point, is_below = self.find_insertion(subpath)
-        if not is_below:
-            return False
-        return self.paths[point-1].positive
+        return self.includes_post(subpath.post_path)
 
     def includes_post(self, post_path):
         "Is this post (given as path) included in this collection?"
-        # Weirdly, same logic as path cancellation.
-        return self.is_cancelled(PostPathData(post_path, False))
+        (point, _) = self.find_insertion(PostPathData(post_path, False))
+        # Enclosing paths sort before the post, and the closest one decides.
+        # It is not always the immediately preceding one, which may be
+        # in a sibling subtree.
+        while point:
+            point -= 1
+            path = self.paths[point]
+            if post_path.startswith(path.post_path):
+                return path.positive
+        return False
+
+    def post_mask(self, post_tree, include_breakpoints=False,
+                  include_deleted=False):
+        """The posts in this collection, as a mask over a :py:class:`PostTreeIndex`.
+
+        Parameters as in :py:meth:`as_clause_base`."""
+        assert self.reduced
+        mask = post_tree.paths_mask(self.paths, include_breakpoints)
+        deleted_filter = post_tree.deleted_filter(include_deleted)
+        if deleted_filter is not None:
+            mask &= deleted_filter
+        return mask
 
     def __nonzero__(self):
         return bool(self.paths)
@@ -220,7 +387,7 @@ class PostPathLocalCollection(object):
         return " ; ".join((`x` for x in self.paths))
 
     def as_clause_base(self, db, include_breakpoints=False,
-                       include_deleted=False):
+                       include_deleted=False, post_tree=None):
         """Express collection as a SQLAlchemy query clause.
 
         :param bool include_breakpoints: Include posts where
@@ -228,8 +395,20 @@ class PostPathLocalCollection(object):
         :param include_deleted: Include posts in deleted_publication_states.
             True means only deleted posts, None means all posts,
             False means only live posts or deleted posts with live descendants.
+        :param post_tree: A :py:class:`PostTreeIndex` of the discussion.
+            If given, post ids are computed in memory instead of through
+            ancestry clauses.
         """
         assert self.reduced
+        if post_tree is not None:
+            post = with_polymorphic(
+                Post, [], Post.__table__,
+                aliased=False, flat=True)
+            post_ids = post_tree.ids_of(self.post_mask(
+                post_tree, include_breakpoints, include_deleted))
+            q = db.query(post.id.label("post_id")).filter(
+                ids_clause(post.id, post_ids))
+            return q.subquery("relposts")
         def base_query(labeled=False):
             post = with_polymorphic(
                 Post, [], Post.__table__,
@@ -322,8 +501,9 @@ class PostPathLocalCollection(object):
         return q
 
     def as_clause(self, db, discussion_id, user_id=None, content=None,
-                  include_deleted=False):
-        subq = self.as_clause_base(db, include_deleted=include_deleted)
+                  include_deleted=False, post_tree=None):
+        subq = self.as_clause_base(
+            db, include_deleted=include_deleted, post_tree=post_tree)
         content = content or with_polymorphic(
             Content, [], Content.__table__,
             aliased=False, flat=True)
@@ -404,12 +584,32 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
     in self.paths is globally complete"""
     def __init__(self, discussion):
         super(PostPathCombiner, self).__init__(discussion)
+        self._post_tree = None
 
     def init_from(self, post_path_global_collection):
         for id, paths in post_path_global_collection.paths.iteritems():
             self.paths[id] = paths.clone()
         self.discussion = post_path_global_collection.discussion
 
+    @property
+    def post_tree(self):
+        "The :py:class:`PostTreeIndex` of the discussion"
+        if self._post_tree is None or self._post_tree.invalidated:
+            self._post_tree = PostTreeIndex.get(
+                self.discussion.db, self.discussion.id)
+        return self._post_tree
+
+    def orphan_mask(self, include_deleted=False):
+        "The posts unrelated to any idea, as a mask over the post_tree"
+        post_tree = self.post_tree
+        mask = ~self.paths[self.root_idea_id].post_mask(
+            post_tree, include_deleted=None)
+        mask &= post_tree.visible & post_tree.not_synthesis
+        deleted_filter = post_tree.deleted_filter(include_deleted)
+        if deleted_filter is not None:
+            mask &= deleted_filter
+        return mask
+
     def visit_idea(self, idea, level, prev_result):
         if isinstance(idea, Idea):
             idea_id = idea.id
@@ -445,9 +645,8 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         return result
 
     def orphan_clause(self, user_id=None, content=None, include_deleted=False):
-        root_path = self.paths[self.root_idea_id]
         db = self.discussion.default_db
-        subq = root_path.as_clause_base(db, include_deleted=include_deleted)
+        orphan_ids = self.post_tree.ids_of(self.orphan_mask(include_deleted))
         content = content or with_polymorphic(
             Content, [], Content.__table__,
             aliased=False, flat=True)
@@ -457,8 +656,8 @@ class PostPathCombiner(PostPathGlobalCollection, IdeaVisitor):
         q = db.query(content.id.label("post_id")).filter(
                 (content.discussion_id == self.discussion.id)
                 & (content.hidden == False)
-                & (content.type.notin_((synth_post_type, webpage_post_type)))
-                & content.id.notin_(subq))
+                & (content.type.notin_((synth_post_type, webpage_post_type))))
+        q = q.filter(ids_clause(content.id, orphan_ids))
         if include_deleted is not None:
             if include_deleted:
                 post = with_polymorphic(
@@ -490,6 +689,8 @@ class PostPathCounter(PostPathCombiner):
         self.read_counts = {}
         self.user_id = user_id
         self.calc_subset = calc_subset
+        self._viewed_mask = None
+        self._viewed_mask_tree = None
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -502,28 +703,28 @@ class PostPathCounter(PostPathCombiner):
         self.counts[idea_id] = parent_result.count
         self.viewed_counts[idea_id] = parent_result.viewed_count
 
-    def get_counts_for_query(self, q):
-        # HACKITY HACK
-        entities = [
-            x.entity_zero.entity for x in q._entities]
-        entities = {e.__mapper__.tables[0].name: e for e in entities}
-        content_entity = entities['content']
-
-        post = with_polymorphic(
-            Post, [], Post.__table__,
-            aliased=False, flat=True)
-        q = q.join(
-            post, (content_entity.id == post.id) &
-                  (post.publication_state.in_(countable_publication_states)))
-
-        if self.user_id:
-            action_entity = entities['action']
-            return q.with_entities(
-                count(content_entity.id), count(action_entity.id)).first()
-        else:
-            (post_count,) = q.with_entities(
-                count(content_entity.id)).first()
-            return (post_count, 0)
+    @property
+    def viewed_mask(self):
+        "The posts viewed by the user, as a mask over the post_tree"
+        if self._viewed_mask_tree is not self.post_tree:
+            post_ids = self.discussion.db.query(ViewPost.post_id).join(
+                Content, Content.id == ViewPost.post_id).filter(
+                ViewPost.actor_id == self.user_id,
+                ViewPost.tombstone_date == None,
+                Content.discussion_id == self.discussion.id)
+            self._viewed_mask_tree = self.post_tree
+            self._viewed_mask = self.post_tree.mask_of(
+                [id for (id,) in post_ids])
+        return self._viewed_mask
+
+    def counts_for_mask(self, mask):
+        "Count the countable (and viewed) posts in the mask"
+        mask = mask & self.post_tree.countable
+        post_count = int(np.count_nonzero(mask))
+        if self.user_id and post_count:
+            return (post_count,
+                    int(np.count_nonzero(mask & self.viewed_mask)))
+        return (post_count, 0)
 
     def get_counts(self, idea_id):
         if self.counts.get(idea_id, None) is not None:
@@ -534,10 +735,8 @@ class PostPathCounter(PostPathCombiner):
             self.counts[idea_id] = 0
             self.viewed_counts[idea_id] = 0
             return (0, 0)
-        q = path_collection.as_clause(
-            self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None)
-        (post_count, viewed_count) = self.get_counts_for_query(q)
+        (post_count, viewed_count) = self.counts_for_mask(
+            path_collection.post_mask(self.post_tree, include_deleted=None))
         (path_collection.count, path_collection.viewed_count) = (
             post_count, viewed_count)
         self.counts[idea_id] = post_count
@@ -545,8 +744,7 @@ class PostPathCounter(PostPathCombiner):
         return (post_count, viewed_count)
 
     def get_orphan_counts(self, include_deleted=False):
-        return self.get_counts_for_query(
-            self.orphan_clause(self.user_id, include_deleted=include_deleted))
+        return self.counts_for_mask(self.orphan_mask(include_deleted))
 
     def end_visit(self, idea, level, result, child_results):
         if isinstance(idea, Idea):
@@ -574,6 +772,7 @@ class DiscussionGlobalData(object):
         self._children_dict = None
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_post_counts = None
 
     @property
     def discussion(self):
@@ -642,11 +841,22 @@ class DiscussionGlobalData(object):
             self._post_path_counter = counter
         return self._post_path_counter
 
+    def idea_post_counts(self):
+        """dictionary idea.id -> (num_posts, num_read_posts)
+
+        Backed by the tables of :py:mod:`assembl.models.idea_post_counts`."""
+        if self._idea_post_counts is None:
+            from .idea_post_counts import get_idea_post_counts
+            self._idea_post_counts = get_idea_post_counts(self)
+        return self._idea_post_counts
+
     def reset_hierarchy(self):
         self._parent_dict = None
         self._children_dict = None
         self._post_path_counter = None
+        self._idea_post_counts = None
 
     def reset_content_links(self):
         self._post_path_collection_raw = None
         self._post_path_counter = None
+        self._idea_post_counts = None
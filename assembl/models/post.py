@@ -22,7 +22,8 @@ from sqlalchemy import (
     func
 )
 from sqlalchemy.orm import (
-    relationship, backref, deferred, column_property, with_polymorphic)
+    relationship, backref, deferred, column_property, with_polymorphic,
+    object_session)
 
 from ..lib.sqla import CrudOperation
 from ..lib.decl_enums import DeclEnum
@@ -282,6 +283,23 @@ class Post(Content):
             parent.id
         ))
 
+    # Changes to these attributes affect the post counts of ideas
+    count_attributes = ('ancestry', 'publication_state', 'hidden')
+
+    def update_derived_data(self, operation=CrudOperation.UPDATE):
+        from .idea_post_counts import (
+            attributes_changed, post_created, post_changed)
+        from .path_utils import PostTreeIndex
+        session = object_session(self)
+        if operation == CrudOperation.CREATE:
+            post_created(session, self.id)
+        elif (operation == CrudOperation.DELETE or
+                attributes_changed(self, self.count_attributes)):
+            post_changed(session, self.discussion_id, self.id)
+        else:
+            return
+        PostTreeIndex.invalidate(self.discussion_id)
+
     def last_updated(self):
         ancestry_query_string = "%s%d,%%" % (self.ancestry or '', self.id)
 
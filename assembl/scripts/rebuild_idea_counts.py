@@ -0,0 +1,30 @@
+"""Recompute the stored per-idea post counts, in case they have drifted."""
+import logging.config
+import argparse
+
+from pyramid.paster import get_appsettings
+import transaction
+
+from assembl.lib.sqla import configure_engine, get_session_maker
+from assembl.lib.zmqlib import configure_zmq
+from assembl.lib.config import set_config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "configuration",
+        help="configuration file with destination database configuration")
+    parser.add_argument(
+        "-d", "--discussion_id", type=int, default=None,
+        help="Only rebuild the counts of this discussion.")
+    args = parser.parse_args()
+    settings = get_appsettings(args.configuration, 'assembl')
+    set_config(settings)
+    logging.config.fileConfig(args.configuration)
+    configure_zmq(settings['changes.socket'], False)
+    configure_engine(settings, True)
+    session = get_session_maker()()
+    from assembl.models.idea_post_counts import rebuild_idea_post_counts
+    with transaction.manager:
+        rebuild_idea_post_counts(session, args.discussion_id)
@@ -58,6 +58,10 @@ Socket.prototype.onOpen = function(ev) {
   if (Ctx.debugSocket) {
     console.log("Socket::onOpen()");
   }
+  if (this.lastSeq) {
+    // Ask for the changes we missed while disconnected
+    this.socket.send("since:" + this.lastSeq);
+  }
   this.socket.send("token:" + Ctx.getCsrfToken());
   this.socket.send("discussion:" + Ctx.getDiscussionId());
   if (Ctx.debugSocket) {
@@ -84,20 +88,26 @@ Socket.prototype.onMessage = function(ev) {
   if (Ctx.debugSocket) {
     console.log("Socket::onMessage()");
   }
+  var data = JSON.parse(ev.data),
+      i = 0,
+      len = data.length;
+
   if (this.state === Socket.STATE_CONNECTING) {
+    // If the server replayed the changes we missed,
+    // collections do not need to be fetched again.
+    var replayed = (len > 0 && data[0]['@type'] == "Connection" && data[0].replayed === true);
     this.connectCallback(this);
-    App.vent.trigger('socket:open');
+    App.vent.trigger('socket:open', replayed);
     if (Ctx.debugSocket) {
       console.log("Socket::onOpen() state is now STATE_OPEN");
     }
     this.state = Socket.STATE_OPEN;
   }
 
-  var data = JSON.parse(ev.data),
-      i = 0,
-      len = data.length;
-
   for (; i < len; i += 1) {
+    if (data[i]['@seq'] !== undefined) {
+      this.lastSeq = data[i]['@seq'];
+    }
     this.processData(data[i]);
   }
 
@@ -141,8 +151,8 @@ Socket.prototype.processData = function(item) {
   }
 
   if (collPromise === null) {
-    if (item['@type'] == "Connection") {
-      //Ignore Connections
+    if (item['@type'] == "Connection" || item['@type'] == "Sequence") {
+      //Ignore Connections and sequence numbers
       return;
     } 
     else {
@@ -2,6 +2,7 @@
 database objects through ZeroMQ, and feeds them to browser clients
 through a websocket."""
 import signal
+import socket
 import time
 import sys
 from os import makedirs, access, R_OK, W_OK
@@ -9,13 +10,16 @@ from os.path import exists, dirname
 import ConfigParser
 import traceback
 from time import sleep
+from collections import defaultdict, deque
 
-import simplejson as json
 import zmq
 from zmq.eventloop import ioloop
 from zmq.eventloop import zmqstream
-import requests
-from tornado import web
+from tornado import web, gen
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from sockjs.tornado import SockJSRouter, SockJSConnection
 from tornado.httpserver import HTTPServer
 
@@ -25,39 +29,285 @@ from assembl.lib.web_token import decode_token, TokenInvalid
 
 # Inspired by socksproxy.
 
-if len(sys.argv) != 2:
-    print "usage: python changes_router.py configuration.ini"
-    exit()
+SECTION = 'app:assembl'
 
+# Set from the configuration file, in configure
+CHANGES_SOCKET = None
+CHANGES_PREFIX = ''
+TOKEN_SECRET = None
+WEBSERVER_PORT = None
+SERVER_HOST = None
+SERVER_PORT = None
+# How long (in seconds) read permissions are cached
+PERMISSION_CACHE_TTL = 60
+# How many recent frames are kept for each discussion, so that clients
+# can resynchronize after reconnecting
+REPLAY_BUFFER_SIZE = 500
+# How long (in seconds) a discussion without connections is still followed
+REPLAY_RETENTION = 300
+# How many worker processes share the websocket connections
+WORKERS = 1
+# Where workers get changes from the forwarder
+WORKERS_SOCKET = INTERNAL_SOCKET
+# Sequence numbers are only meaningful within a run of a worker,
+# set in start_worker
+EPOCH = None
 
-SECTION = 'app:assembl'
 
-settings = ConfigParser.ConfigParser({'changes.prefix': ''})
-settings.read(sys.argv[-1])
-CHANGES_SOCKET = settings.get(SECTION, 'changes.socket')
-CHANGES_PREFIX = settings.get(SECTION, 'changes.prefix')
-TOKEN_SECRET = settings.get(SECTION, 'session.secret')
-WEBSERVER_PORT = settings.getint(SECTION, 'changes.websocket.port')
-# NOTE: Not sure those are always what we want.
-SERVER_HOST = settings.get(SECTION, 'public_hostname')
-SERVER_PORT = settings.getint(SECTION, 'public_port')
-setup_raven(settings)
-
-context = zmq.Context.instance()
-ioloop.install()
-io_loop = ioloop.IOLoop.instance()  # ZMQ loop
-
-if CHANGES_SOCKET.startswith('ipc://'):
-    dir = dirname(CHANGES_SOCKET[6:])
-    if not exists(dir):
-        makedirs(dir)
-
-td = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
-td.bind_in(CHANGES_SOCKET)
-td.bind_out(INTERNAL_SOCKET)
-td.setsockopt_in(zmq.IDENTITY, 'XSUB')
-td.setsockopt_out(zmq.IDENTITY, 'XPUB')
-td.start()
+def configure(settings):
+    "Read the router's settings from the parsed configuration file."
+    global CHANGES_SOCKET, CHANGES_PREFIX, TOKEN_SECRET, WEBSERVER_PORT, \
+        SERVER_HOST, SERVER_PORT, PERMISSION_CACHE_TTL, REPLAY_BUFFER_SIZE, \
+        REPLAY_RETENTION, WORKERS, WORKERS_SOCKET
+    CHANGES_SOCKET = settings.get(SECTION, 'changes.socket')
+    CHANGES_PREFIX = settings.get(SECTION, 'changes.prefix')
+    TOKEN_SECRET = settings.get(SECTION, 'session.secret')
+    WEBSERVER_PORT = settings.getint(SECTION, 'changes.websocket.port')
+    # NOTE: Not sure those are always what we want.
+    SERVER_HOST = settings.get(SECTION, 'public_hostname')
+    SERVER_PORT = settings.getint(SECTION, 'public_port')
+    if settings.has_option(SECTION, 'changes.permission_cache_ttl'):
+        PERMISSION_CACHE_TTL = settings.getint(
+            SECTION, 'changes.permission_cache_ttl')
+    if settings.has_option(SECTION, 'changes.replay_buffer_size'):
+        REPLAY_BUFFER_SIZE = settings.getint(
+            SECTION, 'changes.replay_buffer_size')
+    if settings.has_option(SECTION, 'changes.replay_retention'):
+        REPLAY_RETENTION = settings.getint(
+            SECTION, 'changes.replay_retention')
+    if settings.has_option(SECTION, 'changes.websocket.workers'):
+        WORKERS = settings.getint(SECTION, 'changes.websocket.workers')
+    if WORKERS > 1:
+        if settings.has_option(SECTION, 'changes.workers_socket'):
+            WORKERS_SOCKET = settings.get(SECTION, 'changes.workers_socket')
+        elif CHANGES_SOCKET.startswith('ipc://'):
+            WORKERS_SOCKET = CHANGES_SOCKET + '_workers'
+        else:
+            raise RuntimeError(
+                "changes.workers_socket must be set to use many workers")
+    setup_raven(settings)
+
+
+# Set in start_worker, after forking
+context = None
+io_loop = None
+sockjs_router = None
+dispatcher = None
+web_server = None
+
+
+def start_forwarder():
+    """Forward changes from the publishers to the workers.
+
+    A single worker gets them in process. Many workers subscribe
+    to the forwarder, which runs in its own process."""
+    if CHANGES_SOCKET.startswith('ipc://'):
+        dir = dirname(CHANGES_SOCKET[6:])
+        if not exists(dir):
+            makedirs(dir)
+    if WORKERS > 1:
+        td = zmq.devices.ProcessDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    else:
+        td = zmq.devices.ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    td.bind_in(CHANGES_SOCKET)
+    td.bind_out(WORKERS_SOCKET)
+    td.setsockopt_in(zmq.IDENTITY, 'XSUB')
+    td.setsockopt_out(zmq.IDENTITY, 'XPUB')
+    td.start()
+
+
+# (discussion, user_id) -> (expiry time, permission)
+read_permission_cache = {}
+# (discussion, user_id) -> Future of a permission check in progress
+read_permission_checks = {}
+
+
+@gen.coroutine
+def fetch_read_permission(discussion, user_id):
+    "Ask the web server whether the user can read the discussion"
+    response = yield AsyncHTTPClient().fetch(
+        'http://%s:%d/api/v1/discussion/%s/permissions/read/u/%s' %
+        (SERVER_HOST, SERVER_PORT, discussion, user_id),
+        raise_error=False)
+    if response.code >= 500:
+        # Server or connection trouble (599), do not cache the answer
+        raise gen.Return(None)
+    raise gen.Return(response.code == 200 and response.body == 'true')
+
+
+def can_read(discussion, user_id):
+    """Future of the read permission of the user on the discussion.
+
+    Answers are cached for PERMISSION_CACHE_TTL, and concurrent checks
+    for the same user and discussion share a single request, so that
+    a burst of reconnections does not flood the web server."""
+    key = (discussion, user_id)
+    now = time.time()
+    cached = read_permission_cache.get(key, None)
+    if cached is not None and cached[0] > now:
+        future = Future()
+        future.set_result(cached[1])
+        return future
+    if key in read_permission_checks:
+        return read_permission_checks[key]
+
+    def store_result(check):
+        del read_permission_checks[key]
+        if check.exception() is None and check.result() is not None:
+            if len(read_permission_cache) > 10000:
+                for (k, (expiry, _)) in read_permission_cache.items():
+                    if expiry <= now:
+                        del read_permission_cache[k]
+            read_permission_cache[key] = (
+                time.time() + PERMISSION_CACHE_TTL, check.result())
+
+    check = fetch_read_permission(discussion, user_id)
+    read_permission_checks[key] = check
+    check.add_done_callback(store_result)
+    return check
+
+
+class ReplayBuffer(object):
+    """The recent frames sent to a discussion, with their sequence number.
+
+    Each frame starts with a ``Sequence`` item, so clients know the last
+    sequence number they received and can ask for what followed with a
+    ``since:<seq>`` message when they reconnect."""
+
+    def __init__(self, size, seq=0):
+        # (seq, public payload, {user_id: private payload})
+        self.frames = deque(maxlen=size)
+        # Last sequence number
+        self.seq = seq
+        # Frames after this sequence number are all in the buffer
+        self.start = seq
+
+    def token(self, seq=None):
+        return "%s-%d" % (EPOCH, self.seq if seq is None else seq)
+
+    def add(self, public, private):
+        """Stamp the payloads with the next sequence number and store them.
+
+        Returns the stamped payloads."""
+        self.seq += 1
+        stamp = '[{"@type":"Sequence","@seq":"%s"},' % (self.token(),)
+        if public:
+            public = stamp + public[1:]
+        private = {user_id: stamp + payload[1:]
+                   for (user_id, payload) in private.iteritems()}
+        if len(self.frames) == self.frames.maxlen:
+            self.start = self.frames[0][0]
+        self.frames.append((self.seq, public, private))
+        return public, private
+
+    def replay(self, since, user_id):
+        """The payloads sent after the token `since`, as seen by the user,
+        or None if some of them are not available anymore."""
+        try:
+            epoch, seq = since.rsplit('-', 1)
+            seq = int(seq)
+        except ValueError:
+            return None
+        if epoch != EPOCH or not (self.start <= seq <= self.seq):
+            return None
+        return [private.get(user_id, public)
+                for (frame_seq, public, private) in self.frames
+                if frame_seq > seq and private.get(user_id, public)]
+
+
+class ChangesDispatcher(object):
+    """A single subscriber to the internal socket, which forwards changes
+    to the connections of each discussion.
+
+    ZMQ subscriptions are reference-counted: a discussion is subscribed
+    while at least one connection listens to it, and REPLAY_RETENTION
+    after that, so its replay buffer stays complete across reconnections.
+    The buffer is then dropped; a new one continues the sequence numbers,
+    so that tokens from the old one are not mistaken for recent ones."""
+
+    def __init__(self):
+        # discussion id -> set of connections
+        self.connections = defaultdict(set)
+        # discussion id -> ReplayBuffer
+        self.buffers = {}
+        # discussion id -> timeout of the end of its subscription
+        self.releases = {}
+        # Above the sequence numbers of all dropped buffers
+        self.sequence_base = 0
+        self.socket = context.socket(zmq.SUB)
+        self.socket.connect(WORKERS_SOCKET)
+        self.socket.setsockopt(zmq.SUBSCRIBE, '*')
+        self.stream = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
+        self.stream.on_recv(self.on_recv)
+
+    def subscribe(self, discussion, connection, since=None):
+        """Start sending the discussion's changes to the connection.
+
+        Returns the current sequence token, and the payloads the connection
+        missed since the `since` token, or None if they are not available."""
+        if discussion in self.releases:
+            io_loop.remove_timeout(self.releases.pop(discussion))
+        elif discussion not in self.connections:
+            self.socket.setsockopt(zmq.SUBSCRIBE, discussion)
+            self.buffers[discussion] = ReplayBuffer(
+                REPLAY_BUFFER_SIZE, self.sequence_base)
+        self.connections[discussion].add(connection)
+        buffer = self.buffers[discussion]
+        missed = None
+        if since:
+            missed = buffer.replay(since, connection.userId)
+        return buffer.token(), missed
+
+    def unsubscribe(self, discussion, connection):
+        connections = self.connections.get(discussion, None)
+        if not connections or connection not in connections:
+            return
+        connections.remove(connection)
+        if not connections:
+            self.releases[discussion] = io_loop.call_later(
+                REPLAY_RETENTION, self.release, discussion)
+
+    def release(self, discussion):
+        self.releases.pop(discussion, None)
+        if not self.connections.get(discussion, None):
+            self.connections.pop(discussion, None)
+            self.socket.setsockopt(zmq.UNSUBSCRIBE, discussion)
+            buffer = self.buffers.pop(discussion, None)
+            if buffer is not None:
+                self.sequence_base = max(self.sequence_base, buffer.seq + 1)
+
+    def on_recv(self, data):
+        # See assembl.lib.zmqlib.send_changes for the message format.
+        # Payloads are already serialized, and are forwarded as-is.
+        discussion, public = data[0], data[2]
+        private = dict(zip(data[3::2], data[4::2]))
+        if discussion == '*':
+            for discussion in self.connections.keys():
+                self.dispatch(discussion, public, private)
+        # ZMQ subscriptions are prefixes, check the exact discussion
+        elif discussion in self.connections:
+            self.dispatch(discussion, public, private)
+
+    def dispatch(self, discussion, public, private):
+        public, private = self.buffers[discussion].add(public, private)
+        connections = self.connections[discussion]
+        if not connections:
+            return
+        if not private:
+            if public:
+                sockjs_router.broadcast(connections, public)
+            return
+        others = []
+        by_user = defaultdict(list)
+        for connection in connections:
+            if connection.userId in private:
+                by_user[connection.userId].append(connection)
+            else:
+                others.append(connection)
+        if public and others:
+            sockjs_router.broadcast(others, public)
+        for user_id, user_connections in by_user.iteritems():
+            sockjs_router.broadcast(user_connections, private[user_id])
 
 
 class ZMQRouter(SockJSConnection):
@@ -65,41 +315,29 @@ class ZMQRouter(SockJSConnection):
     token = None
     discussion = None
     userId = None
+    since = None
 
     def on_open(self, request):
         self.valid = True
         self.closing = False
-
-    def on_recv(self, data):
-        try:
-            data = data[-1]
-            if '@private' in data:
-                jsondata = json.loads(data)
-                jsondata = [x for x in jsondata
-                            if x.get('@private', self.userId) == self.userId]
-                if not jsondata:
-                    return
-                data = json.dumps(jsondata)
-            self.send(data)
-        except Exception:
-            capture_exception()
-            self.do_close()
+        self.checking = False
+        self.subscribed = False
 
     def do_close(self):
         self.closing = True
         self.close()
-        self.socket = None
-        if getattr(self, "loop", None):
-            self.loop.stop_on_recv()
-            self.loop.close()
-            self.loop = None
+        if self.subscribed:
+            dispatcher.unsubscribe(self.discussion, self)
+            self.subscribed = False
 
     def on_message(self, msg):
         try:
-            if getattr(self, 'socket', None):
+            if self.subscribed:
                 print "closing old socket"
-                self.loop.add_callback(self.do_close)
+                io_loop.add_callback(self.do_close)
                 return
+            if msg.startswith('since:') and self.valid:
+                self.since = msg.split(':', 1)[1]
             if msg.startswith('discussion:') and self.valid:
                 self.discussion = msg.split(':', 1)[1]
             if msg.startswith('token:') and self.valid:
@@ -110,26 +348,39 @@ class ZMQRouter(SockJSConnection):
                         self.token['userId'])
                 except TokenInvalid:
                     pass
-            if self.token and self.discussion:
-                # Check if token authorizes discussion
-                r = requests.get(
-                    'http://%s:%d/api/v1/discussion/%s/permissions/read/u/%s' %
-                    (SERVER_HOST, SERVER_PORT, self.discussion,
-                        self.token['userId']))
-                print r.text
-                if r.text != 'true':
-                    return
-                self.socket = context.socket(zmq.SUB)
-                self.socket.connect(INTERNAL_SOCKET)
-                self.socket.setsockopt(zmq.SUBSCRIBE, '*')
-                self.socket.setsockopt(zmq.SUBSCRIBE, str(self.discussion))
-                self.loop = zmqstream.ZMQStream(self.socket, io_loop=io_loop)
-                self.loop.on_recv(self.on_recv)
-                print "connected"
-                self.send('[{"@type":"Connection"}]')
+            if self.token and self.discussion and not self.checking:
+                self.check_and_connect()
+        except Exception:
+            capture_exception()
+            self.do_close()
+
+    @gen.coroutine
+    def check_and_connect(self):
+        # Check if token authorizes discussion, without blocking the loop
+        self.checking = True
+        try:
+            can_read_discussion = yield can_read(
+                self.discussion, self.token['userId'])
+            print "read permission:", can_read_discussion
+            if (not can_read_discussion or self.closing
+                    or self.subscribed):
+                return
+            self.discussion = str(self.discussion)
+            seq, missed = dispatcher.subscribe(
+                self.discussion, self, self.since)
+            self.subscribed = True
+            print "connected", "replaying %d frames" % len(missed) \
+                if missed is not None else ""
+            # If replayed, the client does not need to reload its data
+            self.send('[{"@type":"Connection","@seq":"%s","replayed":%s}]' % (
+                seq, 'true' if missed is not None else 'false'))
+            for payload in missed or ():
+                self.send(payload)
         except Exception:
             capture_exception()
             self.do_close()
+        finally:
+            self.checking = False
 
     def on_close(self):
         if self.closing:
@@ -147,42 +398,80 @@ def logger(msg):
 
 
 def log_queue():
-    socket = context.socket(zmq.SUB)
-    socket.connect(INTERNAL_SOCKET)
-    socket.setsockopt(zmq.SUBSCRIBE, '')
-    loop = zmqstream.ZMQStream(socket, io_loop=io_loop)
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.connect(WORKERS_SOCKET)
+    sub_socket.setsockopt(zmq.SUBSCRIBE, '')
+    loop = zmqstream.ZMQStream(sub_socket, io_loop=io_loop)
     loop.on_recv(logger)
 
-log_queue()
-
-sockjs_router = SockJSRouter(
-    ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop)
-routes = sockjs_router.urls
-web_app = web.Application(routes, debug=False)
-
 
 def term(*_ignore):
     web_server.stop()
     io_loop.add_timeout(time.time() + 0.3, io_loop.stop)
 
-signal.signal(signal.SIGTERM, term)
 
-web_server = HTTPServer(web_app)
-web_server.listen(WEBSERVER_PORT)
-try:
-    if CHANGES_SOCKET.startswith('ipc://'):
-        sname = CHANGES_SOCKET[6:]
-        for i in range(5):
-            if exists(sname):
-                break
-            sleep(0.1)
-        else:
-            raise RuntimeError("could not create socket " + sname)
-        if not access(sname, R_OK | W_OK):
-            raise RuntimeError(sname + " cannot be accessed")
-    io_loop.start()
-except KeyboardInterrupt:
-    term()
-except Exception:
-    capture_exception()
-    raise
+def start_worker(task_id, sockets):
+    global EPOCH, context, io_loop, sockjs_router, dispatcher, web_server
+    EPOCH = "%d.%d" % (time.time(), task_id or 0)
+    context = zmq.Context.instance()
+    io_loop = ioloop.IOLoop.instance()  # ZMQ loop
+    log_queue()
+    router_settings = {}
+    if WORKERS > 1:
+        # Other transports send many requests per session, which could
+        # reach different workers.
+        router_settings['disabled_transports'] = [
+            'xhr', 'xhr_streaming', 'jsonp', 'eventsource', 'htmlfile']
+    sockjs_router = SockJSRouter(
+        ZMQRouter, prefix=CHANGES_PREFIX, io_loop=io_loop,
+        user_settings=router_settings)
+    dispatcher = ChangesDispatcher()
+    web_app = web.Application(sockjs_router.urls, debug=False)
+    signal.signal(signal.SIGTERM, term)
+    web_server = HTTPServer(web_app)
+    if sockets is None:
+        # Each worker listens, and the kernel balances connections
+        sockets = bind_sockets(WEBSERVER_PORT, reuse_port=True)
+    web_server.add_sockets(sockets)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print "usage: python changes_router.py configuration.ini"
+        exit()
+    settings = ConfigParser.ConfigParser({'changes.prefix': ''})
+    settings.read(sys.argv[-1])
+    configure(settings)
+    ioloop.install()
+    start_forwarder()
+    sockets = None
+    task_id = None
+    if WORKERS > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            # Workers accept connections on a socket bound before forking
+            sockets = bind_sockets(WEBSERVER_PORT)
+        task_id = fork_processes(WORKERS)
+    else:
+        sockets = bind_sockets(WEBSERVER_PORT)
+    start_worker(task_id, sockets)
+    try:
+        if CHANGES_SOCKET.startswith('ipc://'):
+            sname = CHANGES_SOCKET[6:]
+            for i in range(5):
+                if exists(sname):
+                    break
+                sleep(0.1)
+            else:
+                raise RuntimeError("could not create socket " + sname)
+            if not access(sname, R_OK | W_OK):
+                raise RuntimeError(sname + " cannot be accessed")
+        io_loop.start()
+    except KeyboardInterrupt:
+        term()
+    except Exception:
+        capture_exception()
+        raise
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,6 @@ import sys
 from imaplib2 import IMAP4_SSL, IMAP4
 import transaction
 
-from assembl.models import ContentSource
-
 from .source_reader import (
     ReaderStatus, SourceDispatcher, SourceReader,
     ReaderError, ClientError, IrrecoverableError)
@@ -93,38 +91,9 @@ class IMAPReader(SourceReader):
             raise IrrecoverableError(e)
         except IMAP4.error as e:
             raise ClientError(e)
-
-    def import_email(self, email_id):
-        mailbox = self.mailbox
-        # print "running fetch for message: "+email_id
-        try:
-            status, message_data = mailbox.uid('fetch', email_id, "(RFC822)")
-            if not is_ok((status,)):
-                raise ClientError(message_data)
-
-            # print repr(message_data)
-            for response_part in message_data:
-                if isinstance(response_part, tuple):
-                    message_string = response_part[1]
-            if not message_string:
-                raise ClientError()
-            try:
-                if self.source.message_ok_to_import(message_string):
-                    (email_object, dummy, error) = self.source.parse_email(message_string)
-                    if error:
-                        raise ReaderError(error)
-                    self.source.db.add(email_object)
-                else:
-                    print "Skipped message with imap id %s (bounce or vacation message)" % (email_id)
-                # print "Setting self.source.last_imported_email_uid to "+email_id
-                self.source.last_imported_email_uid = email_id
-                self.source.db.commit()
-            finally:
-                self.source = ContentSource.get(self.source.id)
-        except IMAP4.abort as e:
-            raise IrrecoverableError(e)
-        except IMAP4.error as e:
-            raise ClientError(e)
+        finally:
+            self.selected_folder = False
+            self.mailbox = None
 
     def do_read(self):
         only_new = not self.reimporting
@@ -170,10 +139,13 @@ class IMAPReader(SourceReader):
 
             if len(email_ids):
                 print "Processing messages from IMAP: %d "% (len(email_ids))
-                for email_id in email_ids:
-                    self.import_email(email_id)
-                    if self.status != ReaderStatus.READING:
-                        break
+                try:
+                    self.source = self.source.import_imap_messages(
+                        mailbox, email_ids,
+                        stop=lambda: self.status != ReaderStatus.READING,
+                        commit=self.source.db.commit)
+                except ValueError as e:
+                    raise ReaderError(e)
             else:
                 print "No IMAP messages to process"
             self.successful_read()
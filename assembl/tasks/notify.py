@@ -1,6 +1,10 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
-from time import sleep
+import smtplib
+import socket
+from time import time
+from threading import Lock
+from collections import defaultdict
 from datetime import datetime, timedelta
 from traceback import print_exc
 import logging
@@ -8,6 +12,7 @@ import logging
 import transaction
 from pyramid_mailer import mailer_factory_from_settings
 from pyramid_mailer.message import Message
+from repoze.sendmail.encoding import encode_message
 
 from ..lib.sqla import mark_changed
 from ..lib.raven_client import capture_exception
@@ -28,13 +33,40 @@ CELERYBEAT_SCHEDULE = {
             'exchange': 'notify'
         }
     },
+    'send-hourly-digests': {
+        'task': 'assembl.tasks.notify.send_digests',
+        'schedule': timedelta(hours=1),
+        'args': ('HOURLY',),
+        'options': {
+            'routing_key': 'notify',
+            'exchange': 'notify'
+        }
+    },
+    'send-daily-digests': {
+        'task': 'assembl.tasks.notify.send_digests',
+        'schedule': timedelta(days=1),
+        'args': ('DAILY',),
+        'options': {
+            'routing_key': 'notify',
+            'exchange': 'notify'
+        }
+    },
 }
 
 
 class NotifyCeleryApp(CeleryWithConfig):
     def on_configure_with_settings(self, settings):
-        global notify_process_mailer
+        global notify_process_mailer, smtp_rate_limiter, NOTIFY_WORKERS
         notify_process_mailer = mailer_factory_from_settings(settings)
+        NOTIFY_WORKERS = int(settings.get('%s.num_workers' % (self.main,), 1))
+        broker = settings.get('%s.broker' % (self.main,), None
+                              ) or settings.get('celery_tasks.broker', '')
+        if broker.startswith('redis://'):
+            from redis import StrictRedis
+            smtp_rate_limiter = RedisSMTPRateLimiter(
+                StrictRedis.from_url(broker))
+        else:
+            smtp_rate_limiter = SMTPRateLimiter()
         # setup SETTINGS_SMTP_DELAY
         for name, val in settings.iteritems():
             if name.startswith(SETTINGS_SMTP_DELAY):
@@ -53,12 +85,8 @@ notify_celery_app._preconf = {
 }
 
 
-# When was a mail last sent by notifications to a given domain?
-# Propagates to superdomains.
-DOMAIN_LAST_SENT = {}
-
 # Minimum delay between emails sent to a domain.
-# For this to work, you need to have a SINGLE celery process for notification.
+# The most specific domain applies.
 SMTP_DOMAIN_DELAYS = {
     '': timedelta(0)
 }
@@ -68,62 +96,180 @@ SMTP_DOMAIN_DELAYS = {
 # Use seconds (float) as values.
 SETTINGS_SMTP_DELAY = "celery_tasks.notify.smtp_delay."
 
+# Maximum number of notifications sent by a single task,
+# over a single SMTP connection.
+NOTIFICATION_BATCH_SIZE = 100
 
-def email_was_sent(email):
-    domain = email.split("@")[-1].lower().split('.')
-    now = datetime.utcnow()
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        DOMAIN_LAST_SENT[dom] = now
+# Number of notify worker processes, from celery_tasks.notify.num_workers
+NOTIFY_WORKERS = 1
 
 
-def wait_if_necessary(email):
-    domain = email.split("@")[-1].lower().split('.')
-    # Look for most specific delay rule
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        if dom in SMTP_DOMAIN_DELAYS:
-            delay = SMTP_DOMAIN_DELAYS[dom]
-            break
-    else:
-        return
-    # Not looking at superdomains. make delays as generic as needed
-    last_sent = DOMAIN_LAST_SENT.get(dom, None)
-    if last_sent is None:
-        return
-    elapsed = datetime.utcnow() - last_sent
-    if elapsed < delay:
-        sleep((delay - elapsed).total_seconds())
+class SMTPRateLimiter(object):
+    """Spaces out the emails sent to each domain by SMTP_DOMAIN_DELAYS.
+
+    Each email reserves the next free sending slot of its domain; when that
+    slot is in the future, the email must be sent again later, at that time,
+    instead of waiting for it in the worker.
+    This implementation only knows about emails sent by the current process."""
+
+    def __init__(self):
+        self.next_slots = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def get_delay_rule(email):
+        "The most specific (domain, delay in seconds) rule for that email"
+        domain = email.split("@")[-1].lower().split('.')
+        for i in range(len(domain) + 1):
+            dom = '.'.join(domain[i:])
+            if dom in SMTP_DOMAIN_DELAYS:
+                return dom, SMTP_DOMAIN_DELAYS[dom].total_seconds()
+        return None, 0
+
+    def reserve(self, email):
+        """Reserve a sending slot for that email.
+
+        :returns: the number of seconds until the slot; 0 means now."""
+        domain, delay = self.get_delay_rule(email)
+        if not delay:
+            return 0
+        return self.reserve_slot(domain, delay, time())
+
+    def reserve_slot(self, domain, delay, now):
+        with self.lock:
+            slot = max(self.next_slots.get(domain, 0), now)
+            self.next_slots[domain] = slot + delay
+        return slot - now
+
+
+class RedisSMTPRateLimiter(SMTPRateLimiter):
+    """A :py:class:`SMTPRateLimiter` shared by all notify workers,
+    through the redis celery broker."""
+
+    KEY_PREFIX = 'assembl:smtp_slot:'
+
+    # Atomically reserve the next slot of a domain, from the time given.
+    # Floats are returned as strings, as redis would truncate them.
+    RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local delay = tonumber(ARGV[2])
+local slot = math.max(tonumber(redis.call('GET', KEYS[1]) or 0), now)
+redis.call('SET', KEYS[1], tostring(slot + delay),
+           'PX', math.ceil((slot + delay - now) * 1000))
+return tostring(slot - now)
+"""
+
+    def __init__(self, redis):
+        self.reserve_script = redis.register_script(self.RESERVE_SCRIPT)
+
+    def reserve_slot(self, domain, delay, now):
+        return float(self.reserve_script(
+            keys=[self.KEY_PREFIX + domain], args=[repr(now), repr(delay)]))
+
+
+smtp_rate_limiter = SMTPRateLimiter()
+
+
+class SMTPBatch(object):
+    """Sends many messages over a single SMTP connection.
+
+    The connection is opened with the first message, and opened again
+    after a connection error."""
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+        self.connection = None
+
+    def connect(self):
+        # Same handshake as repoze.sendmail's SMTPMailer.send
+        smtp_mailer = self.mailer.smtp_mailer
+        connection = smtp_mailer.smtp_factory()
+        code, response = connection.ehlo()
+        if code < 200 or code >= 300:
+            code, response = connection.helo()
+            if code < 200 or code >= 300:
+                raise smtplib.SMTPHeloError(code, response)
+        if connection.has_extn('starttls') and not smtp_mailer.no_tls:
+            connection.starttls()
+            connection.ehlo()
+        elif smtp_mailer.force_tls:
+            raise RuntimeError('TLS is not available but TLS is required')
+        if smtp_mailer.username is not None \
+                and smtp_mailer.password is not None:
+            connection.login(smtp_mailer.username, smtp_mailer.password)
+        return connection
+
+    def send(self, message):
+        if getattr(self.mailer, 'smtp_mailer', None) is None:
+            # Not an SMTP mailer, e.g. a DebugMailer
+            self.mailer.send_immediately(message, fail_silently=False)
+            return
+        if self.connection is None:
+            self.connection = self.connect()
+        try:
+            self.connection.sendmail(
+                message.sender, message.send_to,
+                encode_message(message.to_message()))
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                self.connection.close()
+            self.connection = None
+
 
+def process_notification(notification, smtp=None, slot_reserved=False):
+    """Send the notification, and update its delivery state.
 
-def process_notification(notification):
+    :param notification: a :py:class:`assembl.models.notification.Notification`
+        or :py:class:`assembl.models.notification.NotificationDigest`
+
+    :param smtp: an :py:class:`SMTPBatch` to send the email with;
+        if absent, the email is sent over a new connection.
+    :param slot_reserved: whether a sending slot was already reserved with
+        the rate limiter, i.e. the notification was postponed.
+    :returns: if the recipient's domain is rate limited, the number of
+        seconds until the notification may be sent. It was not sent, and
+        must be processed again at that time, with slot_reserved."""
     from ..models.notification import (
         NotificationDeliveryStateType, UnverifiedEmailException,
         MissingEmailException)
-    import smtplib
-    import socket
-    from assembl.lib import config
 
     assert notification
     sys.stderr.write(
-        "process_notification called with notification %d, state was %s" % (
+        "process_notification called with notification %s, state was %s" % (
             notification.id, notification.delivery_state))
     if notification.delivery_state not in \
             NotificationDeliveryStateType.getRetryableDeliveryStates():
         sys.stderr.write(
-            "Refusing to process notification %d because its delivery state is: %s" % (
+            "Refusing to process notification %s because its delivery state is: %s" % (
                 notification.id, notification.delivery_state))
         return
     try:
+        recipient = notification.get_to_email_address()
+        if not slot_reserved:
+            wait = smtp_rate_limiter.reserve(recipient)
+            if wait > 0:
+                sys.stderr.write(
+                    "Postponing notification %s by %.1f seconds" % (
+                        notification.id, wait))
+                notification.postpone_delivery(timedelta(seconds=wait))
+                return wait
         email = notification.render_to_message()
         # sys.stderr.write(email_str)
-        recipient = notification.get_to_email_address()
-        wait_if_necessary(recipient)
-        notify_process_mailer.send_immediately(email, fail_silently=False)
+        if smtp is None:
+            notify_process_mailer.send_immediately(email, fail_silently=False)
+        else:
+            smtp.send(email)
 
         notification.delivery_state = \
             NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
-        email_was_sent(recipient)
     except UnverifiedEmailException as e:
         sys.stderr.write("Not sending to unverified email: "+repr(e))
         notification.delivery_state = \
@@ -133,6 +279,7 @@ def process_notification(notification):
             NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
         sys.stderr.write("Missing email! :"+repr(e))
     except (smtplib.SMTPConnectError,
+            smtplib.SMTPServerDisconnected,
             socket.timeout, socket.error,
             smtplib.SMTPHeloError) as e:
         sys.stderr.write("Temporary failure: "+repr(e))
@@ -147,14 +294,15 @@ def process_notification(notification):
             NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
         sys.stderr.write("Invalid configuration! :"+repr(e))
 
+    notification.delivery_attempted()
     mark_changed()
     sys.stderr.write(
-        "process_notification finished processing %d, state is now %s"
+        "process_notification finished processing %s, state is now %s"
         % (notification.id, notification.delivery_state))
 
 
 @notify_celery_app.task()
-def notify(id):
+def notify(id, slot_reserved=False):
     """ Can be triggered by
     http://localhost:6543/data/Discussion/6/all_users/2/notifications/12/process_now """
     from ..models.notification import Notification, waiting_get
@@ -162,24 +310,192 @@ def notify(id):
     with transaction.manager:
         notification = waiting_get(Notification, id)
         assert notification
-        process_notification(notification)
+        wait = process_notification(notification, slot_reserved=slot_reserved)
+    if wait:
+        notify.apply_async((id, True), countdown=wait)
 
 
 @notify_celery_app.task()
-def process_pending_notifications():
-    """ Can be triggered by http://localhost:6543/data/Notification/process_now """
+def notify_batch(ids, slot_reserved=False):
+    """Send the given notifications, reusing a single SMTP connection."""
+    from ..models.notification import Notification
+    sys.stderr.write("notify_batch called with %d notifications" % len(ids))
+    smtp = SMTPBatch(notify_process_mailer)
+    postponed = defaultdict(list)
+    try:
+        with transaction.manager:
+            # Notifications already claimed by process_pending_notifications
+            # are skipped; they are being sent.
+            notifications = claim_notifications(
+                Notification.default_db, ids=ids)
+            for notification in notifications:
+                # Do not lose the state of notifications already sent
+                try:
+                    wait = process_notification(
+                        notification, smtp, slot_reserved)
+                    if wait:
+                        postponed[round(wait, 1)].append(notification.id)
+                except Exception:
+                    capture_exception()
+                    notification.delivery_attempted()
+    finally:
+        smtp.close()
+    postpone_notifications(postponed)
+
+
+def claim_notifications(db, ids=None, limit=None):
+    """Lock email notifications that can be sent, skipping those locked
+    by other workers, until the end of the transaction.
+
+    :param ids: claim among those notifications; otherwise, claim those
+        due for another attempt, oldest first.
+    :param limit: the maximum number of notifications claimed.
+    :returns: the claimed notifications, ordered by id."""
     from ..models.notification import (
-        Notification, NotificationDeliveryStateType)
-    sys.stderr.write("process_pending_notifications called")
-    retryable_notifications = Notification.default_db.query(Notification.id).filter(
+        Notification, NotificationDeliveryStateType,
+        NotificationPushMethodType)
+    query = db.query(Notification.id).filter(
         Notification.delivery_state.in_(
-        NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
-        try:
+            NotificationDeliveryStateType.getRetryableDeliveryStates()),
+        Notification.push_method == NotificationPushMethodType.EMAIL)
+    if ids is not None:
+        if not ids:
+            return []
+        query = query.filter(Notification.id.in_(ids)).order_by(
+            Notification.id)
+    else:
+        query = query.filter(
+            Notification.next_attempt <= datetime.utcnow()).order_by(
+            Notification.next_attempt)
+    if limit:
+        query = query.limit(limit)
+    if not Notification.using_virtuoso:
+        # Needs postgres 9.5. Virtuoso has no equivalent, so workers
+        # may claim the same notifications there.
+        query = query.suffix_with("FOR UPDATE SKIP LOCKED")
+    claimed = [id for (id,) in query]
+    if not claimed:
+        return []
+    return db.query(Notification).filter(
+        Notification.id.in_(claimed)).order_by(Notification.id).all()
+
+
+def dispatch_notifications(ids):
+    """Send new notifications, with one task per batch.
+
+    Call after the notifications are committed."""
+    for start in range(0, len(ids), NOTIFICATION_BATCH_SIZE):
+        notify_batch.delay(ids[start:start + NOTIFICATION_BATCH_SIZE])
+
+
+def postpone_notifications(postponed):
+    """Send rate limited notifications at the time of their reserved slot.
+
+    :param postponed: a dictionary of notification ids by delay, rounded
+        to a tenth of a second so notifications can share a task."""
+    for wait, ids in postponed.iteritems():
+        for start in range(0, len(ids), NOTIFICATION_BATCH_SIZE):
+            notify_batch.apply_async(
+                (ids[start:start + NOTIFICATION_BATCH_SIZE], True),
+                countdown=wait)
+
+
+@notify_celery_app.task()
+def send_digests(frequency):
+    """Send pending digest notifications, in one email per user and
+    discussion, for subscriptions with the given digest frequency."""
+    from ..models.notification import (
+        Notification, NotificationSubscription,
+        NotificationDeliveryStateType, NotificationDigestFrequency,
+        NotificationPushMethodType)
+    frequency = NotificationDigestFrequency.from_string(frequency)
+    frequencies = [frequency]
+    if frequency == NotificationDigestFrequency.HOURLY:
+        # Leftovers of subscriptions that stopped using digests
+        frequencies.append(NotificationDigestFrequency.IMMEDIATE)
+    sys.stderr.write("send_digests called for %s" % frequency.name)
+    digests = defaultdict(list)
+    with transaction.manager:
+        pending = Notification.default_db.query(
+            Notification.id, NotificationSubscription.user_id,
+            NotificationSubscription.discussion_id).join(
+            Notification.first_matching_subscription).filter(
+            Notification.push_method ==
+            NotificationPushMethodType.EMAIL_DIGEST,
+            Notification.delivery_state.in_(
+                NotificationDeliveryStateType.getRetryableDeliveryStates()),
+            NotificationSubscription.digest_frequency.in_(frequencies)
+            ).order_by(Notification.id)
+        for (notification_id, user_id, discussion_id) in pending:
+            digests[(user_id, discussion_id)].append(notification_id)
+    smtp = SMTPBatch(notify_process_mailer)
+    try:
+        for ids in digests.itervalues():
+            try:
+                send_digest_with(ids, smtp)
+            except Exception:
+                capture_exception()
+    finally:
+        smtp.close()
+
+
+def send_digest_with(ids, smtp, slot_reserved=False):
+    from ..models.notification import Notification, NotificationDigest
+    with transaction.manager:
+        notifications = Notification.default_db.query(Notification).filter(
+            Notification.id.in_(ids)).order_by(Notification.id).all()
+        if not notifications:
+            return
+        wait = process_notification(
+            NotificationDigest(notifications), smtp, slot_reserved)
+    if wait:
+        send_digest.apply_async((ids, True), countdown=wait)
+
+
+@notify_celery_app.task()
+def send_digest(ids, slot_reserved=False):
+    """Send the given notifications in a single digest email."""
+    smtp = SMTPBatch(notify_process_mailer)
+    try:
+        send_digest_with(ids, smtp, slot_reserved)
+    finally:
+        smtp.close()
+
+
+@notify_celery_app.task()
+def process_pending_notifications(helper=False):
+    """ Can be triggered by http://localhost:6543/data/Notification/process_now
+
+    Sends the notifications due for another attempt, one page at a time.
+    Each page is claimed with row locks that other workers skip, so when
+    there is a backlog, the other notify workers are asked to help."""
+    from ..models.notification import Notification
+    sys.stderr.write("process_pending_notifications called")
+    postponed = defaultdict(list)
+    smtp = SMTPBatch(notify_process_mailer)
+    try:
+        while True:
             with transaction.manager:
-                process_notification(Notification.get(notification_id))
-        except:
-            capture_exception()
+                notifications = claim_notifications(
+                    Notification.default_db, limit=NOTIFICATION_BATCH_SIZE)
+                for notification in notifications:
+                    try:
+                        wait = process_notification(notification, smtp)
+                        if wait:
+                            postponed[round(wait, 1)].append(notification.id)
+                    except Exception:
+                        capture_exception()
+                        # Do not claim it again right away
+                        notification.delivery_attempted()
+            if len(notifications) < NOTIFICATION_BATCH_SIZE:
+                break
+            if not helper:
+                helper = True
+                for i in range(NOTIFY_WORKERS - 1):
+                    process_pending_notifications.delay(True)
+    finally:
+        smtp.close()
+    postpone_notifications(postponed)
 
 
 def includeme(config):
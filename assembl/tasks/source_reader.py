@@ -1,11 +1,18 @@
 #!/usr/bin/python
 """A long-running process that receives requests to read data from various ContentSources,
-and reads at reasonable intervals. It can also handle sources that can push changes. """
+and reads at reasonable intervals. It can also handle sources that can push changes.
+
+Read cycles run in a fixed pool of worker threads (see :py:class:`SourceScheduler`),
+unless ``source_reader.num_workers`` is 0: then each reader runs in its own thread."""
 import sys
 import signal
+from collections import defaultdict
+from heapq import heappush, heappop
+from itertools import count
 from random import uniform
 from time import sleep
-from threading import Thread, Event, currentThread
+from threading import Thread, Event, Condition, currentThread
+from urlparse import urlparse
 from traceback import print_stack
 from datetime import datetime, timedelta
 from abc import ABCMeta, abstractmethod
@@ -28,6 +35,8 @@ from assembl.lib.sqla import configure_engine
 
 log = logging.getLogger('assembl')
 pool_counter = 0
+# How long (in seconds) shutdown waits for the current read cycles
+SHUTDOWN_TIMEOUT = 10
 
 
 class ReaderStatus(OrderedEnum):
@@ -156,6 +165,8 @@ class SourceReader(Thread):
         self.reimporting = False
         self.can_push = False  # Set to true for, eg, imap with polling.
         self.event = Event()
+        # The host this reader connects to, see get_host
+        self.host = None
 
     def set_status(self, status):
         lvl = logging.INFO if status in known_transitions[self.status] else logging.ERROR
@@ -252,6 +263,17 @@ class SourceReader(Thread):
         self.reimporting = reimport
         self.extra_args = kwargs
 
+    def get_host(self, source):
+        """The host the reader of this source connects to.
+
+        The scheduler limits the number of readers connected to a host."""
+        host = getattr(source, 'host', None)
+        if host:
+            return host
+        url = getattr(source, 'url', None)
+        if url:
+            return urlparse(url).hostname
+
     def handle_new_content(self, content):
         from .translate import translate_content
         translate_content(content)  # should delay
@@ -365,6 +387,72 @@ class SourceReader(Thread):
         if self.source and not inspect(self.source).detached:
             self.source.db.close()
 
+    def step(self):
+        """Run one read cycle for a :py:class:`SourceScheduler` worker:
+        log in, read, and close the connection until the next cycle.
+
+        This follows the read loop of :py:meth:`run`, with the same error
+        backoff, but returns instead of waiting.
+
+        :returns: when the next read cycle should start, or None if the
+            reader is done (shut down, idle or in irrecoverable error)"""
+        from assembl.models import ContentSource
+        if self.source is None:
+            self.setup()
+        else:
+            # The previous cycle may have run in another worker's session
+            self.source = ContentSource.get(self.source_id)
+        try:
+            if self.status in (
+                    ReaderStatus.SHUTDOWN, ReaderStatus.IRRECOVERABLE_ERROR):
+                return None
+            try:
+                self.login()
+                self.successful_login()
+            except ReaderError as e:
+                self.new_error(e)
+                if self.status > ReaderStatus.TRANSIENT_ERROR:
+                    self.try_close()
+                return self.next_read_time()
+            except Exception as e:
+                self.new_error(e, ReaderStatus.CLIENT_ERROR, expected=False)
+                self.try_close()
+                return None
+            if self.status == ReaderStatus.SHUTDOWN:
+                return None
+            self.after_login = False
+            try:
+                self.read()
+            except ReaderError as e:
+                self.new_error(e)
+                if self.status > ReaderStatus.TRANSIENT_ERROR:
+                    self.try_close()
+            except Exception as e:
+                self.new_error(e, ReaderStatus.CLIENT_ERROR, expected=False)
+                self.try_close()
+                return self.next_read_time()
+            if not self.is_connected():
+                return self.next_read_time()
+            if (self.last_read - self.last_prod
+                    > self.max_idle_period):
+                # Nobody cares, I can stop reading
+                self.close()
+                return None
+            # Do not hold connections between cycles; in particular,
+            # push-capable readers are polled instead of waiting for push.
+            self.try_close()
+            return datetime.utcnow() + self.time_between_reads
+        finally:
+            if self.source and not inspect(self.source).detached:
+                self.source.db.close()
+
+    def next_read_time(self):
+        "When to log in again after an error, or None to stop reading."
+        if self.status in (
+                ReaderStatus.SHUTDOWN, ReaderStatus.IRRECOVERABLE_ERROR):
+            return None
+        return self.error_backoff_until or datetime.utcnow()
+
     @abstractmethod
     def login(self):
         pass
@@ -495,12 +583,169 @@ def external_shutdown():
             {"shutdown": True}, serializer="json", routing_key=ROUTING_KEY)
 
 
+class _ScheduledWakeup(object):
+    """Stands for the event of a reader run by a :py:class:`SourceScheduler`:
+    setting it schedules the reader's next cycle now."""
+
+    def __init__(self, scheduler, reader):
+        self.scheduler = scheduler
+        self.reader = reader
+
+    def set(self):
+        self.scheduler.schedule(self.reader)
+
+    def clear(self):
+        pass
+
+
+class SourceScheduler(object):
+    """Runs the read cycles of many readers with a fixed pool of workers.
+
+    Readers wait in a priority queue ordered by the time of their next
+    cycle (see :py:meth:`SourceReader.step`). Each worker thread takes the
+    first reader that is due, unless max_per_host readers of the same host
+    are already running. Workers use their own (thread-local) database
+    session, so the connection pool only needs one connection per worker.
+    """
+
+    def __init__(self, num_workers=8, max_per_host=2):
+        self.num_workers = num_workers
+        self.max_per_host = max_per_host
+        self.condition = Condition()
+        # heap of (time, sequence, reader)
+        self.queue = []
+        # reader -> (time, sequence) of its valid queue entry
+        self.scheduled = {}
+        self.running = set()
+        # readers that were woken up while running
+        self.woken = set()
+        self.host_counts = defaultdict(int)
+        self.sequence = count()
+        self.stopping = False
+        self.workers = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker = Thread(target=self.work, name="SourceReader-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def add(self, reader):
+        "Run the reader's cycles in the pool, starting now."
+        reader.event = _ScheduledWakeup(self, reader)
+        self.schedule(reader)
+
+    def is_active(self, reader):
+        with self.condition:
+            return reader in self.scheduled or reader in self.running
+
+    def schedule(self, reader, when=None):
+        "Schedule the next cycle of the reader, if not scheduled earlier."
+        with self.condition:
+            self._schedule(reader, when)
+
+    def _schedule(self, reader, when=None):
+        "Schedule the next cycle of the reader. Call with the lock."
+        now = datetime.utcnow()
+        when = when or now
+        if self.stopping:
+            return
+        if reader in self.running:
+            if when <= now:
+                self.woken.add(reader)
+            return
+        current = self.scheduled.get(reader, None)
+        if current is not None and current[0] <= when:
+            return
+        entry = (when, next(self.sequence), reader)
+        # The previous entry, if any, becomes stale
+        self.scheduled[reader] = entry[:2]
+        heappush(self.queue, entry)
+        self.condition.notify()
+
+    def _next_reader(self):
+        "Wait for a reader that is due and can run. Call with the lock."
+        while not self.stopping:
+            now = datetime.utcnow()
+            blocked = []
+            chosen = None
+            while self.queue and self.queue[0][0] <= now:
+                entry = heappop(self.queue)
+                reader = entry[2]
+                if self.scheduled.get(reader, None) != entry[:2]:
+                    continue  # stale
+                if reader.host is not None and \
+                        self.host_counts[reader.host] >= self.max_per_host:
+                    blocked.append(entry)
+                    continue
+                chosen = reader
+                break
+            for entry in blocked:
+                heappush(self.queue, entry)
+            if chosen is not None:
+                del self.scheduled[chosen]
+                self.running.add(chosen)
+                self.host_counts[chosen.host] += 1
+                return chosen
+            # Wait until the next entry is due, or a host is freed
+            future = [entry[0] for entry in self.queue if entry[0] > now]
+            timeout = (min(future) - now).total_seconds() if future else None
+            self.condition.wait(timeout)
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                reader = self._next_reader()
+            if reader is None:
+                return
+            next_time = None
+            try:
+                next_time = reader.step()
+            except Exception:
+                log.exception("Error in read cycle of %r" % (reader,))
+                capture_exception()
+            with self.condition:
+                self.running.discard(reader)
+                self.host_counts[reader.host] -= 1
+                if reader in self.woken:
+                    self.woken.discard(reader)
+                    if next_time is not None:
+                        next_time = min(next_time, datetime.utcnow())
+                # Under the same lock, so the reader is always active
+                # until its last cycle
+                if next_time is not None:
+                    self._schedule(reader, next_time)
+                self.condition.notify_all()
+
+    def stop(self, timeout=None):
+        """Stop the workers, and wait for their current cycles to end,
+        for at most timeout seconds in all, if given."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        deadline = None
+        if timeout is not None:
+            deadline = datetime.utcnow() + timedelta(seconds=timeout)
+        for worker in self.workers:
+            if worker is currentThread():
+                continue
+            if deadline is None:
+                worker.join()
+            else:
+                worker.join(max(
+                    (deadline - datetime.utcnow()).total_seconds(), 0))
+
+
 class SourceDispatcher(ConsumerMixin):
 
-    def __init__(self, connection):
+    def __init__(self, connection, scheduler=None):
         super(SourceDispatcher, self).__init__()
         self.connection = connection
         self.readers = {}
+        # If None, each reader runs in its own thread
+        self.scheduler = scheduler
 
     def get_consumers(self, Consumer, channel):
         global _queue
@@ -529,6 +774,13 @@ class SourceDispatcher(ConsumerMixin):
             reader.shutdown()
             reader = None
 
+        if (reader is not None and self.scheduler is not None
+                and self.scheduler.is_active(reader)):
+            # Still scheduled, maybe waiting for an error backoff
+            reader.setup_read(reimport, **kwargs)
+            reader.wake()
+            return True
+
         if not (reader and reader.is_connected()):
             source = ContentSource.get(source_id)
             if not source:
@@ -543,7 +795,11 @@ class SourceDispatcher(ConsumerMixin):
                 return False
             
             reader.setup_read(reimport, **kwargs)
-            reader.start()
+            if self.scheduler is not None:
+                reader.host = reader.get_host(source)
+                self.scheduler.add(reader)
+            else:
+                reader.start()
             return True
 
         if reader is None:
@@ -559,6 +815,9 @@ class SourceDispatcher(ConsumerMixin):
         for reader in self.readers.itervalues():
             if reader is not None:
                 reader.shutdown()
+        if self.scheduler is not None:
+            # Workers are daemon threads: do not wait for stuck cycles
+            self.scheduler.stop(SHUTDOWN_TIMEOUT)
 
 
 def includeme(config):
@@ -579,8 +838,18 @@ if __name__ == '__main__':
     registry.settings = settings
     set_config(settings)
     fileConfig(config_file_name)
+    # Fork the email parsing processes before starting any thread
+    from assembl.models.mail import init_parsing_pool
+    init_parsing_pool()
+    num_workers = int(settings.get('source_reader.num_workers', 8))
     # set the basic session maker without zope or autoflush
-    engine = configure_engine(settings, False, autoflush=False, max_overflow=20)
+    if num_workers:
+        # One session per worker, and one for the dispatcher
+        engine = configure_engine(
+            settings, False, autoflush=False, pool_size=num_workers + 1)
+    else:
+        engine = configure_engine(
+            settings, False, autoflush=False, max_overflow=20)
 
     # @event.listens_for(engine, "checkin")
     def show_checkin(*args):
@@ -599,8 +868,13 @@ if __name__ == '__main__':
     configure(registry, 'source_reader')
     url = (settings.get('celery_tasks.broker') or
            settings.get('celery_tasks.imap.broker'))
+    scheduler = None
+    if num_workers:
+        scheduler = SourceScheduler(num_workers, int(settings.get(
+            'source_reader.max_connections_per_host', 2)))
+        scheduler.start()
     with BrokerConnection(url) as conn:
-        sourcedispatcher = SourceDispatcher(conn)
+        sourcedispatcher = SourceDispatcher(conn, scheduler)
         def shutdown(*args):
             sourcedispatcher.shutdown()
         signal.signal(signal.SIGTERM, shutdown)
@@ -0,0 +1,57 @@
+from threading import Event
+
+import mock
+
+from assembl.lib.sqla import ChangesAggregator
+
+
+def test_changes_aggregator_coalesces():
+    sent = []
+
+    def send_changes(socket, discussion, changes):
+        sent.append((discussion, changes))
+
+    aggregator = ChangesAggregator()
+    with mock.patch('assembl.lib.sqla.get_pub_socket'), \
+            mock.patch('assembl.lib.sqla.send_changes', send_changes):
+        aggregator.add([
+            (("1", "local:Post/1", "changes"), {"@id": "local:Post/1", "v": 1}),
+            (("2", "local:Post/2", "changes"), {"@id": "local:Post/2"}),
+            (("1", "local:Post/3", "changes"), {"@id": "local:Post/3"}),
+            (("1", "local:Post/1", "changes"), {"@id": "local:Post/1", "v": 2}),
+            (("1", "local:Post/4", "changes"), None),
+        ])
+    assert sorted(sent) == [
+        ("1", [{"@id": "local:Post/1", "v": 2}, {"@id": "local:Post/3"}]),
+        ("2", [{"@id": "local:Post/2"}]),
+    ]
+    assert not aggregator.pending
+
+
+def test_changes_aggregator_window():
+    sent = []
+    done = Event()
+
+    def send_changes(socket, discussion, changes):
+        sent.append((discussion, changes))
+        done.set()
+
+    aggregator = ChangesAggregator(window=0.05)
+    with mock.patch('assembl.lib.sqla.get_pub_socket'), \
+            mock.patch('assembl.lib.sqla.send_changes', send_changes):
+        aggregator.add([
+            (("1", "local:Post/1", "changes"), {"@id": "local:Post/1", "v": 1}),
+        ])
+        aggregator.add([
+            (("1", "local:Post/2", "changes"), {"@id": "local:Post/2"}),
+        ])
+        aggregator.add([
+            (("1", "local:Post/1", "changes"), {"@id": "local:Post/1", "v": 2}),
+        ])
+        # Nothing is sent before the window closes
+        assert not sent
+        assert done.wait(5)
+    assert sent == [
+        ("1", [{"@id": "local:Post/1", "v": 2}, {"@id": "local:Post/2"}]),
+    ]
+    assert not aggregator.pending
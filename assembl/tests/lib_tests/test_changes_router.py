@@ -0,0 +1,269 @@
+import mock
+import zmq
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+from zmq.eventloop import ioloop
+
+from assembl.tasks import changes_router
+
+
+class FakeResponse(object):
+    def __init__(self, code, body=''):
+        self.code = code
+        self.body = body
+
+
+class TestReadPermission(AsyncTestCase):
+
+    def setUp(self):
+        super(TestReadPermission, self).setUp()
+        changes_router.read_permission_cache.clear()
+        changes_router.read_permission_checks.clear()
+        self.fetches = []
+        patcher = mock.patch.object(
+            changes_router, 'fetch_read_permission', self.fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, discussion, user_id):
+        future = Future()
+        self.fetches.append(((discussion, user_id), future))
+        return future
+
+    @gen_test
+    def test_concurrent_checks_share_one_fetch(self):
+        first = changes_router.can_read('1', 2)
+        second = changes_router.can_read('1', 2)
+        other_user = changes_router.can_read('1', 3)
+        assert second is first
+        assert [key for (key, _) in self.fetches] == [('1', 2), ('1', 3)]
+        self.fetches[0][1].set_result(True)
+        self.fetches[1][1].set_result(False)
+        assert (yield first) is True
+        assert (yield second) is True
+        assert (yield other_user) is False
+        assert not changes_router.read_permission_checks
+
+    @gen_test
+    def test_cache_hit_and_expiry(self):
+        check = changes_router.can_read('1', 2)
+        self.fetches[0][1].set_result(True)
+        assert (yield check) is True
+        # Cached: no new fetch
+        assert (yield changes_router.can_read('1', 2)) is True
+        assert len(self.fetches) == 1
+        # Expired: fetched again
+        changes_router.read_permission_cache[('1', 2)] = (0, True)
+        check = changes_router.can_read('1', 2)
+        assert len(self.fetches) == 2
+        self.fetches[1][1].set_result(False)
+        assert (yield check) is False
+        assert changes_router.read_permission_cache[('1', 2)][1] is False
+
+    @gen_test
+    def test_failed_check_is_not_cached(self):
+        check = changes_router.can_read('1', 2)
+        self.fetches[0][1].set_result(None)
+        assert (yield check) is None
+        assert not changes_router.read_permission_cache
+        check = changes_router.can_read('1', 2)
+        assert len(self.fetches) == 2
+        self.fetches[1][1].set_exception(IOError())
+        try:
+            yield check
+        except IOError:
+            pass
+        assert not changes_router.read_permission_cache
+        assert not changes_router.read_permission_checks
+
+
+class TestFetchReadPermission(AsyncTestCase):
+
+    @gen_test
+    def test_fetch_read_permission(self):
+        client = mock.Mock()
+        with mock.patch.object(
+                changes_router, 'AsyncHTTPClient', return_value=client), \
+                mock.patch.multiple(
+                    changes_router, SERVER_HOST='localhost', SERVER_PORT=80):
+            for (response, expected) in (
+                    (FakeResponse(200, 'true'), True),
+                    (FakeResponse(200, 'false'), False),
+                    (FakeResponse(403), False),
+                    (FakeResponse(599), None)):
+                future = Future()
+                future.set_result(response)
+                client.fetch.return_value = future
+                result = yield changes_router.fetch_read_permission('1', 2)
+                assert result is expected
+        assert client.fetch.call_args == mock.call(
+            'http://localhost:80/api/v1/discussion/1/permissions/read/u/2',
+            raise_error=False)
+
+
+class FakeConnection(object):
+    def __init__(self, user_id):
+        self.userId = user_id
+
+
+class DispatcherTestCase(AsyncTestCase):
+    socket_name = 'inproc://test_changes_dispatcher'
+
+    def get_new_ioloop(self):
+        return ioloop.ZMQIOLoop()
+
+    def setUp(self):
+        super(DispatcherTestCase, self).setUp()
+        context = zmq.Context.instance()
+        # Stands for the forwarder, and shows subscriptions
+        self.publisher = context.socket(zmq.XPUB)
+        self.publisher.bind(self.socket_name)
+        self.addCleanup(self.publisher.close, 0)
+        self.sockjs_router = mock.Mock()
+        patcher = mock.patch.multiple(
+            changes_router, context=context, io_loop=self.io_loop,
+            sockjs_router=self.sockjs_router, EPOCH='1.0',
+            WORKERS_SOCKET=self.socket_name, REPLAY_RETENTION=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dispatcher = changes_router.ChangesDispatcher()
+        assert self.subscriptions() == ['\x01*']
+
+    def tearDown(self):
+        # Before the loop closes it
+        self.dispatcher.stream.close(0)
+        super(DispatcherTestCase, self).tearDown()
+
+    def subscriptions(self, timeout=100):
+        "The subscription changes received by the publisher since last call"
+        changes = []
+        while self.publisher.poll(timeout):
+            changes.append(self.publisher.recv())
+            timeout = 10
+        return changes
+
+
+class TestChangesDispatcher(DispatcherTestCase):
+
+    @gen_test
+    def test_subscription_is_shared(self):
+        connection1 = FakeConnection('local:AgentProfile/1')
+        connection2 = FakeConnection('local:AgentProfile/2')
+        self.dispatcher.subscribe('1', connection1)
+        assert self.subscriptions() == ['\x011']
+        self.dispatcher.subscribe('1', connection2)
+        self.dispatcher.unsubscribe('1', connection1)
+        yield gen.sleep(0.01)
+        assert self.subscriptions(10) == []
+        self.dispatcher.unsubscribe('1', connection2)
+        # Released after REPLAY_RETENTION
+        yield gen.sleep(0.01)
+        assert self.subscriptions() == ['\x001']
+        assert '1' not in self.dispatcher.connections
+
+    @gen_test
+    def test_prefix_subscriptions_are_filtered(self):
+        connection1 = FakeConnection('local:AgentProfile/1')
+        connection2 = FakeConnection('local:AgentProfile/2')
+        self.dispatcher.subscribe('1', connection1)
+        self.dispatcher.subscribe('1', connection2)
+        # Matches the subscription to '1'
+        self.dispatcher.on_recv(['12', '0', '[{"@id":"a"}]'])
+        assert not self.sockjs_router.broadcast.called
+        self.dispatcher.on_recv([
+            '1', '1', '[{"@id":"b"}]',
+            'local:AgentProfile/2', '[{"@id":"b"},{"@id":"c"}]'])
+        calls = self.sockjs_router.broadcast.call_args_list
+        assert len(calls) == 2
+        sent = {tuple(connections): payload
+                for ((connections, payload), _) in calls}
+        stamp = '[{"@type":"Sequence","@seq":"1.0-1"},'
+        assert sent == {
+            (connection1,): stamp + '{"@id":"b"}]',
+            (connection2,): stamp + '{"@id":"b"},{"@id":"c"}]'}
+
+    @gen_test
+    def test_buffer_is_dropped_after_retention(self):
+        connection = FakeConnection('local:AgentProfile/1')
+        assert self.dispatcher.subscribe('1', connection) == ('1.0-0', None)
+        self.dispatcher.on_recv(['1', '0', '[{"@id":"a"}]'])
+        self.dispatcher.unsubscribe('1', connection)
+        yield gen.sleep(0.01)
+        assert '1' not in self.dispatcher.buffers
+        # The old token is not accepted by the new buffer
+        token, missed = self.dispatcher.subscribe('1', connection, '1.0-1')
+        assert token == '1.0-2'
+        assert missed is None
+
+    @gen_test
+    def test_buffer_is_kept_during_retention(self):
+        connection = FakeConnection('local:AgentProfile/1')
+        self.dispatcher.subscribe('1', connection)
+        self.dispatcher.on_recv(['1', '0', '[{"@id":"a"}]'])
+        with mock.patch.object(changes_router, 'REPLAY_RETENTION', 60):
+            self.dispatcher.unsubscribe('1', connection)
+        self.dispatcher.on_recv(['1', '0', '[{"@id":"b"}]'])
+        token, missed = self.dispatcher.subscribe('1', connection, '1.0-1')
+        assert token == '1.0-2'
+        assert missed == ['[{"@type":"Sequence","@seq":"1.0-2"},{"@id":"b"}]']
+        assert not self.dispatcher.releases
+
+
+class TestReplayBuffer(object):
+
+    def setup_method(self, method):
+        patcher = mock.patch.object(changes_router, 'EPOCH', '1.0')
+        patcher.start()
+        self.patcher = patcher
+
+    def teardown_method(self, method):
+        self.patcher.stop()
+
+    def stamp(self, seq, payload):
+        return '[{"@type":"Sequence","@seq":"1.0-%d"},%s' % (
+            seq, payload[1:])
+
+    def test_replay(self):
+        buffer = changes_router.ReplayBuffer(10)
+        assert buffer.token() == '1.0-0'
+        public, private = buffer.add('[{"@id":"a"}]', {})
+        assert public == self.stamp(1, '[{"@id":"a"}]')
+        assert private == {}
+        buffer.add('[{"@id":"b"}]', {'u1': '[{"@id":"b"},{"@id":"c"}]'})
+        buffer.add('', {'u2': '[{"@id":"d"}]'})
+        assert buffer.token() == '1.0-3'
+        assert buffer.replay('1.0-0', 'u1') == [
+            self.stamp(1, '[{"@id":"a"}]'),
+            self.stamp(2, '[{"@id":"b"},{"@id":"c"}]')]
+        assert buffer.replay('1.0-1', 'u2') == [
+            self.stamp(2, '[{"@id":"b"}]'),
+            self.stamp(3, '[{"@id":"d"}]')]
+        assert buffer.replay('1.0-3', 'u1') == []
+
+    def test_invalid_tokens(self):
+        buffer = changes_router.ReplayBuffer(10)
+        buffer.add('[{"@id":"a"}]', {})
+        for token in ('', '1', '1.0-', '1.0-a', 'garbage'):
+            assert buffer.replay(token, 'u1') is None
+        # From another run of the worker
+        assert buffer.replay('0.9-0', 'u1') is None
+        # From the future
+        assert buffer.replay('1.0-2', 'u1') is None
+
+    def test_overflow(self):
+        buffer = changes_router.ReplayBuffer(2)
+        for payload in ('[{"@id":"a"}]', '[{"@id":"b"}]', '[{"@id":"c"}]'):
+            buffer.add(payload, {})
+        # The first frame is gone
+        assert buffer.replay('1.0-0', 'u1') is None
+        assert buffer.replay('1.0-1', 'u1') == [
+            self.stamp(2, '[{"@id":"b"}]'), self.stamp(3, '[{"@id":"c"}]')]
+
+    def test_start_sequence(self):
+        buffer = changes_router.ReplayBuffer(10, 5)
+        assert buffer.token() == '1.0-5'
+        assert buffer.replay('1.0-4', 'u1') is None
+        assert buffer.replay('1.0-5', 'u1') == []
+        buffer.add('[{"@id":"a"}]', {})
+        assert buffer.token() == '1.0-6'
@@ -0,0 +1,27 @@
+import json
+
+import mock
+import pytest
+
+from assembl.lib.json import StreamedJSONList
+
+
+def test_streamed_json_list():
+    items = [{"@id": "local:Post/%d" % i} for i in range(5)]
+    streamed = StreamedJSONList(iter(items), "posts", lambda: {"total": 5})
+    streamed.chunk_size = 20
+    chunks = list(streamed)
+    assert len(chunks) > 1
+    assert json.loads(''.join(chunks)) == {"posts": items, "total": 5}
+    assert json.loads(''.join(StreamedJSONList(iter(items)))) == items
+
+
+def test_streamed_json_list_error_is_reported():
+    def items():
+        yield {"@id": "local:Post/1"}
+        raise ValueError()
+
+    with mock.patch('assembl.lib.json.capture_exception') as capture:
+        with pytest.raises(ValueError):
+            list(StreamedJSONList(items()))
+    assert capture.called
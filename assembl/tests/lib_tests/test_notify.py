@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+import mock
+
+from assembl.tasks.notify import SMTPBatch, SMTPRateLimiter
+
+
+def test_smtp_batch_reuses_connection():
+    mailer = mock.Mock()
+    mailer.smtp_mailer.no_tls = True
+    mailer.smtp_mailer.force_tls = False
+    mailer.smtp_mailer.username = None
+    connection = mailer.smtp_mailer.smtp_factory.return_value
+    connection.ehlo.return_value = (250, 'OK')
+    connection.has_extn.return_value = False
+    smtp = SMTPBatch(mailer)
+    with mock.patch('assembl.tasks.notify.encode_message'):
+        for i in range(3):
+            smtp.send(mock.Mock())
+    smtp.close()
+    assert mailer.smtp_mailer.smtp_factory.call_count == 1
+    assert connection.sendmail.call_count == 3
+    connection.quit.assert_called_once_with()
+
+
+def test_smtp_rate_limiter_reserves_slots():
+    limiter = SMTPRateLimiter()
+    delays = {'': timedelta(0), 'example.com': timedelta(seconds=2)}
+    with mock.patch('assembl.tasks.notify.SMTP_DOMAIN_DELAYS', delays), \
+            mock.patch('assembl.tasks.notify.time', return_value=100.0):
+        assert limiter.reserve('a@other.org') == 0
+        assert limiter.reserve('a@example.com') == 0
+        assert limiter.reserve('b@mail.example.com') == 2
+        assert limiter.reserve('c@example.com') == 4
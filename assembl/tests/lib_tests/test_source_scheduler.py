@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+from threading import Event, Lock
+from time import sleep
+
+from assembl.tasks.source_reader import SourceScheduler
+
+
+class FakeReader(object):
+    def __init__(self, host, running, lock, cycles=2,
+                 delay=timedelta(milliseconds=10)):
+        self.host = host
+        self.running = running
+        self.lock = lock
+        self.cycles = cycles
+        self.delay = delay
+        self.steps = 0
+        self.done = Event()
+
+    def step(self):
+        with self.lock:
+            self.running[self.host] = self.running.get(self.host, 0) + 1
+            self.running['max_' + self.host] = max(
+                self.running.get('max_' + self.host, 0),
+                self.running[self.host])
+        sleep(0.01)
+        with self.lock:
+            self.running[self.host] -= 1
+        self.steps += 1
+        if self.steps == self.cycles:
+            self.done.set()
+            return None
+        return datetime.utcnow() + self.delay
+
+
+def test_source_scheduler_limits_connections_per_host():
+    running = {}
+    lock = Lock()
+    readers = [FakeReader(host, running, lock)
+               for host in ('a', 'a', 'a', 'b', 'b')]
+    scheduler = SourceScheduler(num_workers=4, max_per_host=2)
+    scheduler.start()
+    try:
+        for reader in readers:
+            scheduler.add(reader)
+        for reader in readers:
+            assert reader.done.wait(5)
+    finally:
+        scheduler.stop()
+    assert all(reader.steps == 2 for reader in readers)
+    assert running['max_a'] <= 2
+    assert running['max_b'] <= 2
+    assert not scheduler.scheduled
+    assert not scheduler.running
+
+
+def test_source_scheduler_wakes_reader():
+    running = {}
+    reader = FakeReader('a', running, Lock(), delay=timedelta(hours=1))
+    scheduler = SourceScheduler(num_workers=1)
+    scheduler.start()
+    try:
+        scheduler.add(reader)
+        while scheduler.is_active(reader) and not reader.steps:
+            sleep(0.01)
+        # Waking schedules the next cycle now instead of in an hour
+        reader.event.set()
+        assert reader.done.wait(5)
+    finally:
+        scheduler.stop()
+
+
+def test_source_scheduler_keeps_readers_active_between_cycles():
+    running = {}
+    reader = FakeReader('a', running, Lock(), cycles=5,
+                        delay=timedelta(0))
+    scheduler = SourceScheduler(num_workers=2)
+    scheduler.start()
+    try:
+        scheduler.add(reader)
+        while True:
+            active = scheduler.is_active(reader)
+            if reader.done.is_set():
+                break
+            # Only inactive after the last cycle
+            assert active
+    finally:
+        scheduler.stop()
+    assert reader.steps == 5
+
+
+def test_source_scheduler_stop_timeout():
+    reader = FakeReader('a', {}, Lock())
+    stuck = Event()
+
+    def step():
+        # A read cycle that hangs until the end of the test
+        stuck.wait()
+
+    reader.step = step
+    scheduler = SourceScheduler(num_workers=2)
+    scheduler.start()
+    try:
+        scheduler.add(reader)
+        while reader not in scheduler.running:
+            sleep(0.01)
+        start = datetime.utcnow()
+        scheduler.stop(0.1)
+        assert datetime.utcnow() - start < timedelta(seconds=1)
+        assert reader in scheduler.running
+    finally:
+        stuck.set()
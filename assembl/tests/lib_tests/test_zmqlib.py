@@ -0,0 +1,92 @@
+import threading
+import time
+
+import mock
+import pytest
+import zmq
+
+from assembl.lib.zmqlib import partition_changes
+
+
+def test_partition_changes():
+    user1 = "local:AgentProfile/1"
+    user2 = "local:AgentProfile/2"
+    changes = [
+        {"@id": "local:Post/1"},
+        {"@id": "local:UserRole/1", "@private": user1},
+        {"@id": "local:Post/2"},
+        {"@id": "local:UserRole/2", "@private": user2},
+    ]
+    public, by_user = partition_changes(changes)
+    assert public == [changes[0], changes[2]]
+    assert by_user == {
+        user1: changes[:3],
+        user2: [changes[0], changes[2], changes[3]],
+    }
+    public, by_user = partition_changes(changes[:1])
+    assert public == changes[:1]
+    assert not by_user
+
+
+@pytest.fixture(scope="function")
+def pub_socket_settings(request):
+    "Publisher sockets of zmqlib without multiplexing, for inproc tests"
+    from assembl.lib import zmqlib
+    patcher = mock.patch.multiple(
+        zmqlib, MULTIPLEX=False,
+        CHANGES_SOCKET='inproc://' + request.function.__name__,
+        READY_TIMEOUT=100, _thread_sockets=threading.local())
+    patcher.start()
+
+    def fin():
+        socket = getattr(zmqlib._thread_sockets, 'socket', None)
+        if socket is not None:
+            socket.close(0)
+        patcher.stop()
+    request.addfinalizer(fin)
+    return zmqlib
+
+
+def test_pub_socket_waits_for_subscriber(pub_socket_settings):
+    zmqlib = pub_socket_settings
+    subscriber = zmqlib.context.socket(zmq.SUB)
+    subscriber.bind(zmqlib.CHANGES_SOCKET)
+    subscriber.setsockopt(zmq.SUBSCRIBE, '')
+    received = []
+
+    def receive():
+        # The subscriber must be active to send its subscription,
+        # like the forwarder of the changes router.
+        if subscriber.poll(1000):
+            received.append(subscriber.recv_multipart())
+    thread = threading.Thread(target=receive)
+    thread.start()
+    zmqlib.READY_TIMEOUT = 1000
+    try:
+        start = time.time()
+        socket = zmqlib.get_pub_socket()
+        assert time.time() - start < 0.5
+        # The first message is not lost
+        socket.send_multipart(['1', '0', '[]'])
+        thread.join()
+        assert received == [['1', '0', '[]']]
+        # Reused in the same thread, not in others
+        assert zmqlib.get_pub_socket() is socket
+        other_sockets = []
+        thread = threading.Thread(
+            target=lambda: other_sockets.append(zmqlib.get_pub_socket()))
+        thread.start()
+        thread.join()
+        assert other_sockets[0] is not socket
+        other_sockets[0].close(0)
+    finally:
+        thread.join()
+        subscriber.close(0)
+
+
+def test_pub_socket_ready_timeout(pub_socket_settings):
+    zmqlib = pub_socket_settings
+    start = time.time()
+    socket = zmqlib.get_pub_socket()
+    assert time.time() - start >= 0.09
+    assert not socket.closed
@@ -17,3 +17,42 @@ def test_subscribe_to_discussion(
     participant2_user.unsubscribe(discussion)
     test_session.flush()
     assert discussion in participant2_user.participant_in_discussion, "The user should no longer be subscribed to the discussion"
+
+
+def test_roles_cache_invalidation(
+        test_session, discussion, participant2_user):
+    from assembl.auth import R_MODERATOR
+    from assembl.auth.util import get_roles
+    from assembl.models import LocalUserRole, Role
+    test_session.flush()
+    assert R_MODERATOR not in get_roles(participant2_user.id, discussion.id)
+    # Cached now, but adding a role must invalidate it
+    lur = LocalUserRole(
+        user=participant2_user, discussion=discussion,
+        role=Role.get_role(R_MODERATOR, test_session))
+    test_session.add(lur)
+    test_session.flush()
+    assert R_MODERATOR in get_roles(participant2_user.id, discussion.id)
+    test_session.delete(lur)
+    test_session.flush()
+    assert R_MODERATOR not in get_roles(participant2_user.id, discussion.id)
+
+
+def test_permission_set():
+    from assembl.auth import (
+        PermissionSet, CrudPermissions, IF_OWNED, P_READ, P_ADD_POST,
+        P_DELETE_POST, P_DELETE_MY_POST, P_SYSADMIN)
+    permissions = PermissionSet([P_READ])
+    assert P_READ in permissions
+    assert P_ADD_POST not in permissions
+    permissions.append(P_ADD_POST)
+    assert P_ADD_POST in permissions
+    merged = permissions | [P_DELETE_MY_POST]
+    assert sorted(merged) == sorted([P_READ, P_ADD_POST, P_DELETE_MY_POST])
+    assert P_DELETE_MY_POST not in permissions
+    crud = CrudPermissions(P_ADD_POST, P_READ, P_SYSADMIN, P_DELETE_POST,
+                           delete_owned=P_DELETE_MY_POST)
+    assert crud.can(CrudPermissions.DELETE, merged) == IF_OWNED
+    assert crud.can(CrudPermissions.DELETE, permissions) is False
+    assert crud.can(CrudPermissions.UPDATE, PermissionSet([P_SYSADMIN]))
+    assert crud.can(CrudPermissions.CREATE, permissions) is True
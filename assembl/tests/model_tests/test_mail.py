@@ -448,4 +448,214 @@ Yes!
 
     check_striping_plaintext(original, expected, "Gmail plaintext, circa 2012")
 
-    
\ No newline at end of file
+
+def test_email_references_follow_jwz_order():
+    from email.parser import HeaderParser
+    from assembl.models.mail import email_references
+    headers = HeaderParser().parsestr(
+        "Message-ID: <c@example.com>\n"
+        "References: <a@example.com>\n"
+        "\t<b@example.com> <c@example.com>\n"
+        "In-Reply-To: <d@example.com> (Some One's message)\n\n")
+    assert email_references(headers) == [
+        "a@example.com", "b@example.com", "d@example.com"]
+    headers = HeaderParser().parsestr(
+        "Message-ID: <c@example.com>\n"
+        "References: <a@example.com> <b@example.com>\n"
+        "In-Reply-To: <b@example.com>\n\n")
+    assert email_references(headers) == ["a@example.com", "b@example.com"]
+
+
+def test_parse_batches_reads_one_batch_ahead():
+    from multiprocessing.pool import ThreadPool
+    from assembl.models.mail import parse_batches
+    message = ("Message-ID: <%d@example.com>\n"
+               "From: Some One <someone@example.com>\n"
+               "To: list@example.com\n"
+               "Subject: Test\n"
+               "Date: Mon, 13 Mar 2017 10:00:00 +0000\n\n"
+               "Body %d\n")
+    read = []
+
+    def batches():
+        for start in (0, 2):
+            read.append(start)
+            yield [(n, message % (n, n)) for n in (start, start + 1)]
+
+    pool = ThreadPool(1)
+    try:
+        parsed_batches = parse_batches(batches(), pool)
+        first = next(parsed_batches)
+        # The second batch was read before the first one was handed over
+        assert read == [0, 2]
+        assert [key for (key, _, _) in first] == [0, 1]
+        (data, error) = first[1][2]
+        assert error is None
+        assert data['message_id'] == "1@example.com"
+        assert [key for (key, _, _) in next(parsed_batches)] == [2, 3]
+        assert list(parsed_batches) == []
+    finally:
+        pool.terminate()
+
+
+def test_parsing_pool_does_not_fork_with_threads():
+    from multiprocessing.pool import ThreadPool
+    from threading import Event, Thread
+    from assembl.models import mail
+    stop = Event()
+    thread = Thread(target=stop.wait)
+    thread.start()
+    try:
+        assert mail._parsing_pool is None
+        with mail.parsing_pool() as pool:
+            assert isinstance(pool, ThreadPool)
+        assert mail._parsing_pool is None
+    finally:
+        stop.set()
+        thread.join()
+
+
+class FakeIMAPMailbox(object):
+    def __init__(self, response):
+        self.response = response
+        self.commands = []
+
+    def uid(self, *args):
+        self.commands.append(args)
+        return self.response
+
+
+def test_fetch_messages_pairs_uids_and_literals():
+    from imaplib2 import IMAP4
+    from assembl.models.mail import IMAPMailbox
+    # UID before the message literal
+    mailbox = FakeIMAPMailbox(('OK', [
+        ('1 (UID 12 RFC822 {9}', 'Message 1'), ')',
+        ('2 (UID 10 RFC822 {9}', 'Message 2'), ')']))
+    assert IMAPMailbox.fetch_messages(mailbox, ['10', '12']) == [
+        ('10', 'Message 2'), ('12', 'Message 1')]
+    assert mailbox.commands == [('fetch', '10,12', "(UID RFC822)")]
+    # UID after the message literal
+    mailbox = FakeIMAPMailbox(('OK', [
+        ('1 (RFC822 {9}', 'Message 1'), ' UID 12)',
+        ('2 (RFC822 {9}', 'Message 2'), ' UID 10)']))
+    assert IMAPMailbox.fetch_messages(mailbox, ['10', '12']) == [
+        ('10', 'Message 2'), ('12', 'Message 1')]
+    # Missing UID
+    mailbox = FakeIMAPMailbox(('OK', [
+        ('1 (RFC822 {9}', 'Message 1'), ')']))
+    with pytest.raises(IMAP4.error):
+        IMAPMailbox.fetch_messages(mailbox, ['12'])
+    mailbox = FakeIMAPMailbox(('NO', ['Error']))
+    with pytest.raises(IMAP4.error):
+        IMAPMailbox.fetch_messages(mailbox, ['12'])
+
+
+def test_strip_quotations_html_outlook_without_structure():
+    headers = ("<p>From: a</p><p>Sent: b</p>"
+               "<p>To: c</p><p>Subject: d</p>")
+    original = ("<html><body><p>Mine</p><div>%s</div>"
+                "<p>quoted</p></body></html>") % headers
+    assert AbstractMailbox.strip_full_message_quoting_html(original) == \
+        "<html><body><p>Mine</p></body></html>"
+    # Nested candidates are ambiguous: nothing is stripped
+    original = ("<html><body><p>Mine</p><div><div>%s</div></div>"
+                "</body></html>") % headers
+    assert AbstractMailbox.strip_full_message_quoting_html(original) == \
+        original
+
+
+class ThreadingMailbox(object):
+    "Imports and threads test emails in a mailbox, and deletes them after"
+
+    message = ("Message-ID: <%(message_id)s>\n"
+               "From: Some One <someone@example.com>\n"
+               "To: list@example.com\n"
+               "Subject: Test\n"
+               "Date: Mon, 13 Mar 2017 10:%(minute)02d:00 +0000\n"
+               "%(references)s\n"
+               "Body\n")
+
+    def __init__(self, mailbox, test_session):
+        self.mailbox = mailbox
+        self.test_session = test_session
+        self.emails = []
+
+    def add(self, message_id, references=(), thread=True):
+        headers = ''
+        if references:
+            headers = "References: %s\nIn-Reply-To: <%s>\n" % (
+                ' '.join('<%s>' % ref for ref in references), references[-1])
+        (email_object, _, error) = self.mailbox.parse_email(
+            self.message % dict(message_id=message_id, references=headers,
+                                minute=len(self.emails)))
+        assert error is None
+        self.test_session.add(email_object)
+        self.test_session.flush()
+        self.emails.append(email_object)
+        if thread:
+            self.mailbox.thread_mails([email_object])
+        return email_object
+
+    def delete(self):
+        creators = {e.creator for e in self.emails}
+        for email_object in reversed(self.emails):
+            self.test_session.delete(email_object)
+        self.test_session.flush()
+        for creator in creators:
+            self.test_session.delete(creator)
+        self.test_session.flush()
+
+
+def test_thread_mails_reparents_earlier_replies(
+        abstract_mailbox, test_session):
+    emails = ThreadingMailbox(abstract_mailbox, test_session)
+    try:
+        reply = emails.add("b@example.com", ["a@example.com"])
+        assert reply.parent is None
+        parent = emails.add("a@example.com")
+        assert reply.parent == parent
+        assert reply.ancestor_ids() == [parent.id]
+    finally:
+        emails.delete()
+
+
+def test_thread_mails_skips_missing_references(
+        abstract_mailbox, test_session):
+    emails = ThreadingMailbox(abstract_mailbox, test_session)
+    try:
+        root = emails.add("a@example.com")
+        reply = emails.add(
+            "c@example.com", ["a@example.com", "b@example.com"])
+        # The nearest known message
+        assert reply.parent == root
+        middle = emails.add("b@example.com", ["a@example.com"])
+        assert middle.parent == root
+        assert reply.parent == middle
+        assert reply.ancestor_ids() == [root.id, middle.id]
+    finally:
+        emails.delete()
+
+
+def test_thread_mails_avoids_cycles(abstract_mailbox, test_session):
+    emails = ThreadingMailbox(abstract_mailbox, test_session)
+    try:
+        first = emails.add("a@example.com", ["b@example.com"])
+        second = emails.add("b@example.com", ["a@example.com"])
+        assert first.parent == second
+        assert second.parent is None
+    finally:
+        emails.delete()
+
+
+def test_thread_mails_keeps_other_parents(
+        abstract_mailbox, root_post_1, test_session):
+    emails = ThreadingMailbox(abstract_mailbox, test_session)
+    try:
+        emails.add("a@example.com")
+        reply = emails.add("b@example.com", ["a@example.com"], False)
+        reply.set_parent(root_post_1)
+        abstract_mailbox.thread_mails([reply])
+        assert reply.parent == root_post_1
+    finally:
+        emails.delete()
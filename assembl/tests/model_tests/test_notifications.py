@@ -213,3 +213,83 @@ def test_notification_multiple_subscriptions_create_single_notification(
 
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
+
+
+def test_applicable_condition_matches_would_create(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, reply_post_2, synthesis_post_1, test_app):
+    from assembl.models.notification import CrudVerbs
+    test_session.flush()
+    subscriptions = []
+    for cls in (NotificationSubscriptionFollowSyntheses,
+                NotificationSubscriptionFollowAllMessages,
+                NotificationSubscriptionFollowOwnMessageDirectReplies):
+        for user in (participant1_user, participant2_user):
+            subscription = cls(
+                discussion=discussion, user=user,
+                creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+            test_session.add(subscription)
+            subscriptions.append(subscription)
+    test_session.flush()
+    for post in (root_post_1, reply_post_1, reply_post_2, synthesis_post_1):
+        for subscription in subscriptions:
+            found = subscription.__class__.findApplicableInstances(
+                discussion.id, CrudVerbs.CREATE, post)
+            expected = subscription.wouldCreateNotification(
+                discussion.id, CrudVerbs.CREATE, post)
+            assert (subscription in found) == bool(expected)
+
+
+def test_notification_digest(test_session, discussion, participant1_user,
+                             reply_post_2, test_app, root_post_1,
+                             synthesis_post_1):
+    from assembl.models.notification import (
+        NotificationDigest, NotificationDigestFrequency,
+        NotificationPushMethodType, NotificationDeliveryStateType)
+    test_session.flush()
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+        digest_frequency=NotificationDigestFrequency.HOURLY,
+    )
+    test_session.add(subscription)
+    test_session.flush()
+
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_2.id)
+    dispatcher.processPostCreated(synthesis_post_1.id)
+    notifications = test_session.query(Notification).filter_by(
+        first_matching_subscription_id=subscription.id).all()
+    assert len(notifications) == 2
+    assert all(n.push_method == NotificationPushMethodType.EMAIL_DIGEST
+               for n in notifications), "Digest notifications are not sent immediately"
+
+    digest = NotificationDigest(notifications)
+    digest.delivery_state = NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+    assert all(n.delivery_state == NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+               for n in notifications)
+
+
+def test_notification_retry_backoff(test_session):
+    from datetime import datetime
+    from assembl.models.notification import (
+        NotificationOnPostCreated, NotificationDeliveryStateType,
+        RETRY_BASE_DELAY, MAX_DELIVERY_ATTEMPTS)
+    notification = NotificationOnPostCreated(
+        delivery_state=NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE)
+    notification.delivery_attempted()
+    first_delay = notification.next_attempt - datetime.utcnow()
+    assert RETRY_BASE_DELAY * 0.9 < first_delay <= RETRY_BASE_DELAY
+    notification.delivery_attempted()
+    second_delay = notification.next_attempt - datetime.utcnow()
+    assert RETRY_BASE_DELAY * 1.9 < second_delay <= RETRY_BASE_DELAY * 2
+
+    notification.delivery_attempts = MAX_DELIVERY_ATTEMPTS - 1
+    notification.delivery_attempted()
+    assert notification.delivery_state == NotificationDeliveryStateType.EXPIRED
+    assert notification.next_attempt is None
+
+    notification.delivery_state = NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+    notification.delivery_attempted()
+    assert notification.next_attempt is None
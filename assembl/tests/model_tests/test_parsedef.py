@@ -60,3 +60,47 @@ def test_load_mailbox(
         test_webrequest, discussion, admin_user, jack_layton_mailbox):
     _test_load_fixture(
         test_webrequest, discussion, admin_user, jack_layton_mailbox)
+
+
+def test_json_plan_is_reused(discussion, root_post_1):
+    from assembl.lib.sqla import _json_plans
+    json1 = root_post_1.generic_json('default')
+    plan = root_post_1._get_json_plan('default')
+    assert _json_plans[(root_post_1.__class__, 'default')][1] is plan
+    assert root_post_1._get_json_plan('default') is plan
+    assert root_post_1.generic_json('default') == json1
+
+
+def _count_queries(test_session, function):
+    from sqlalchemy import event
+    queries = []
+
+    def before_cursor_execute(*args):
+        queries.append(args[2])
+    engine = test_session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = function()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return result, len(queries)
+
+
+def test_generic_json_many(
+        test_session, root_post_1, reply_post_1, reply_post_2, reply_post_3):
+    from assembl.lib.sqla import generic_json_many
+    posts = [root_post_1, reply_post_1, reply_post_2, reply_post_3]
+    test_session.expire_all()
+    expected, single_count = _count_queries(
+        test_session, lambda: [p.generic_json() for p in posts])
+    test_session.expire_all()
+    result, many_count = _count_queries(
+        test_session, lambda: generic_json_many(posts))
+    assert result == expected
+    assert many_count < single_count
+    # The number of queries does not depend on the number of instances
+    test_session.expire_all()
+    result, fewer_count = _count_queries(
+        test_session, lambda: generic_json_many(posts[2:]))
+    assert result == expected[2:]
+    assert many_count <= fewer_count
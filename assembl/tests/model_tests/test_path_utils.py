@@ -90,6 +90,60 @@ def test_jack_layton_linked_discussion(
     assert not positive
 
 
+def test_post_tree_index_matches_clauses(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1):
+    ideas = (
+        subidea_1, subidea_1_1, subidea_1_1_1, subidea_1_1_1_1,
+        subidea_1_1_1_1_1, subidea_1_1_1_1_2, subidea_1_1_1_1_2_1,
+        subidea_1_1_1_1_2_2, subidea_1_2, subidea_1_2_1)
+    counters = subidea_1.prepare_counters(subidea_1.discussion_id, True)
+    post_tree = counters.post_tree
+    for idea in ideas:
+        paths = counters.paths[idea.id]
+        for include_deleted in (False, True, None):
+            for include_breakpoints in (False, True):
+                by_sql = test_session.execute(paths.as_clause_base(
+                    test_session, include_breakpoints, include_deleted))
+                by_index = test_session.execute(paths.as_clause_base(
+                    test_session, include_breakpoints, include_deleted,
+                    post_tree))
+                assert set(by_sql) == set(by_index)
+        mask = post_tree.paths_mask(paths.paths)
+        for (post_id, ancestry) in test_session.query(
+                Post.id, Post.ancestry).filter_by(
+                discussion_id=subidea_1.discussion_id):
+            post_path = "%s%d," % (ancestry or '', post_id)
+            assert paths.includes_post(post_path) == (
+                mask[post_tree.position[post_id]])
+
+
+def test_post_tree_index_fingerprint(
+        test_session, discussion, reply_post_1, reply_post_2):
+    from assembl.models.path_utils import PostTreeIndex
+    if Post.using_virtuoso:
+        assert PostTreeIndex.fingerprint_query(
+            test_session, discussion.id) is None
+        return
+
+    def fingerprint():
+        return tuple(PostTreeIndex.fingerprint_query(
+            test_session, discussion.id).first())
+    initial = fingerprint()
+    assert initial[0] == 3
+    assert fingerprint() == initial
+    reply_post_2.hidden = True
+    test_session.flush()
+    assert fingerprint() != initial
+    reply_post_2.hidden = False
+    test_session.flush()
+    assert fingerprint() == initial
+    index = PostTreeIndex.get(test_session, discussion.id)
+    assert PostTreeIndex.get(test_session, discussion.id) is index
+
+
 def test_deleted_post_count(
         test_session, test_webrequest, reply_deleted_post_4,
         subidea_1_1, reply_to_deleted_post_5, extract_post_1_to_subidea_1_1):
@@ -156,5 +210,130 @@ def test_delete_posts(
     assert reply_post_1.is_tombstone
 
 
+def test_idea_post_counts_incremental(
+        test_session, discussion, participant1_user, reply_post_1,
+        subidea_1_1, extract_post_1_to_subidea_1_1):
+    from assembl.models import LangString, ViewPost
+    from assembl.models.path_utils import DiscussionGlobalData
+    from assembl.models.idea_post_counts import (
+        IdeaPostCount, IdeaReadPostCount)
+    test_session.commit()
+
+    def stored_counts():
+        (num_posts,) = test_session.query(IdeaPostCount.num_posts).filter_by(
+            idea_id=subidea_1_1.id).first()
+        (num_read,) = test_session.query(
+            IdeaReadPostCount.num_read_posts).filter_by(
+            idea_id=subidea_1_1.id, user_id=participant1_user.id).first()
+        return (num_posts, num_read)
+
+    data = DiscussionGlobalData(
+        test_session, discussion.id, participant1_user.id)
+    (num_posts, num_read) = data.idea_post_counts()[subidea_1_1.id]
+    test_session.commit()
+    assert stored_counts() == (num_posts, num_read)
+    post = Post(
+        discussion=discussion, creator=participant1_user,
+        subject=LangString.create(u"re2: root post"),
+        body=LangString.create(u"post body"),
+        type="post", message_id="msg_count@example.com")
+    test_session.add(post)
+    test_session.flush()
+    post.set_parent(reply_post_1)
+    view = ViewPost(post=post, actor=participant1_user)
+    test_session.add(view)
+    test_session.commit()
+    assert stored_counts() == (num_posts + 1, num_read + 1)
+    view.is_tombstone = True
+    test_session.commit()
+    assert stored_counts() == (num_posts + 1, num_read)
+    test_session.delete(view)
+    test_session.delete(post)
+    test_session.commit()
+    # Deleting a post invalidates the counts
+    assert not test_session.query(IdeaPostCount).filter_by(
+        discussion_id=discussion.id).count()
+
+
+def test_ideas_showing_posts_matches_counter(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1):
+    from assembl.models.path_utils import DiscussionGlobalData
+    from assembl.models.idea_post_counts import _ideas_showing_posts
+    test_session.commit()
+    discussion_id = subidea_1.discussion_id
+    data = DiscussionGlobalData(test_session, discussion_id)
+    data.idea_post_counts()
+    counter = data.post_path_counter(None, True)
+    posts = test_session.query(Post.id, Post.ancestry).filter_by(
+        discussion_id=discussion_id).all()
+    ideas_of_post = _ideas_showing_posts(
+        test_session, [post_id for (post_id, _) in posts])
+    for (post_id, ancestry) in posts:
+        post_path = "%s%d," % (ancestry or '', post_id)
+        assert set(ideas_of_post[post_id]) == {
+            idea_id for idea_id in counter.counts
+            if counter.paths[idea_id].includes_post(post_path)}
+
+
+def test_idea_post_counts_without_rebuild(
+        test_session, test_webrequest, jack_layton_linked_discussion,
+        subidea_1, participant1_user):
+    import mock
+    from assembl.models import LangString, ViewPost
+    from assembl.models.path_utils import (
+        DiscussionGlobalData, PostPathGlobalCollection)
+    from assembl.models.idea_post_counts import (
+        IdeaPostCount, IdeaReadPostCount)
+    test_session.commit()
+    discussion = subidea_1.discussion
+    user_id = participant1_user.id
+    DiscussionGlobalData(
+        test_session, discussion.id, user_id).idea_post_counts()
+    test_session.commit()
+    posts = test_session.query(Post).filter_by(
+        discussion_id=discussion.id).order_by(Post.creation_date).all()
+
+    def stored_counts():
+        totals = dict(test_session.query(
+            IdeaPostCount.idea_id, IdeaPostCount.num_posts).filter_by(
+            discussion_id=discussion.id))
+        reads = dict(test_session.query(
+            IdeaReadPostCount.idea_id,
+            IdeaReadPostCount.num_read_posts).filter_by(
+            discussion_id=discussion.id, user_id=user_id))
+        return totals, reads
+
+    before = stored_counts()
+    # Loading the paths of the whole discussion would mean a rebuild
+    with mock.patch.object(
+            PostPathGlobalCollection, 'load_discussion',
+            side_effect=AssertionError("counts rebuilt")):
+        view = ViewPost(post=posts[-1], actor=participant1_user)
+        test_session.add(view)
+        test_session.commit()
+        post = Post(
+            discussion=discussion, creator=participant1_user,
+            subject=LangString.create(u"re: count"),
+            body=LangString.create(u"post body"),
+            type="post", message_id="msg_count_2@example.com")
+        test_session.add(post)
+        test_session.flush()
+        post.set_parent(posts[-1])
+        test_session.commit()
+    after = stored_counts()
+    assert after != before
+    # Same as counts computed from scratch
+    counter = DiscussionGlobalData(
+        test_session, discussion.id, user_id).post_path_counter(
+        user_id, True)
+    assert after == (
+        {idea_id: counter.counts[idea_id] for idea_id in after[0]},
+        {idea_id: counter.viewed_counts[idea_id] for idea_id in after[1]})
+    test_session.delete(view)
+    test_session.delete(post)
+    test_session.commit()
+
+
 if Post.using_virtuoso:
     test_jack_layton_linked_discussion = pytest.mark.xfail(test_jack_layton_linked_discussion)
@@ -354,6 +354,52 @@ def test_api_get_posts_queries(
     # TODO: Other query types, and sorting
 
 
+def test_api_get_posts_pagination(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, reply_post_1, reply_post_2):
+    base_post_url = get_url(discussion, 'posts')
+    expected = [root_post_1.uri(), reply_post_1.uri(), reply_post_2.uri()]
+
+    for order in ('chronological', 'reverse_chronological'):
+        ids = []
+        url = base_post_url + "?view=id_only&page_size=2&order=" + order
+        while url:
+            res = test_app.get(url)
+            assert res.status_code == 200
+            res_data = json.loads(res.body)
+            assert res_data['total'] == 3
+            assert len(res_data['posts']) <= 2
+            ids.extend(p['@id'] for p in res_data['posts'])
+            url = None
+            if res_data['next_cursor']:
+                url = (base_post_url + "?view=id_only&page_size=2&order=" +
+                       order + "&cursor=" + res_data['next_cursor'])
+        if order == 'reverse_chronological':
+            ids.reverse()
+        assert ids == expected
+
+    # All three posts are in the same thread
+    url = base_post_url + "?view=id_only&page_size=1&threaded=true"
+    res = test_app.get(url)
+    res_data = json.loads(res.body)
+    assert len(res_data['posts']) == 3
+    assert res_data['next_cursor'] is None
+
+
+def test_api_get_posts_stream(
+        discussion, test_app, test_session, participant1_user,
+        root_post_1, reply_post_1, reply_post_2):
+    base_post_url = get_url(discussion, 'posts')
+
+    for query in ("?view=default", "?view=id_only&order=reverse_chronological",
+                  "?view=default&page_size=2"):
+        res = test_app.get(base_post_url + query)
+        assert res.status_code == 200
+        streamed = test_app.get(base_post_url + query + "&stream=true")
+        assert streamed.status_code == 200
+        assert json.loads(streamed.body) == json.loads(res.body)
+
+
 def test_api_weird_failure_on_joinedload(
         discussion, test_app, test_session, participant1_user,
         root_post_1, reply_post_1, reply_post_2):
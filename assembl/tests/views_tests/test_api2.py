@@ -62,6 +62,17 @@ def test_get_ideas(discussion, test_app, synthesis_1,
     assert subidea_1_1_1_id not in syn_ideas
 
 
+def test_get_collection_stream(discussion, test_app, subidea_1_1_1,
+                               root_post_1, reply_post_1, test_session):
+    for collection in ('ideas', 'posts'):
+        url = '/data/Discussion/%d/%s' % (discussion.id, collection)
+        res = test_app.get(url)
+        assert res.status_code == 200
+        streamed = test_app.get(url + '?stream=true')
+        assert streamed.status_code == 200
+        assert streamed.json == res.json
+
+
 def test_add_idea_in_synthesis(
         discussion, test_app, test_session, subidea_1_1):
     synthesis = discussion.next_synthesis
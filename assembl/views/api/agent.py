@@ -9,6 +9,7 @@ from cornice import Service
 from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import (P_READ, Everyone, P_SYSADMIN, P_ADMIN_DISC)
 from assembl.auth.util import get_permissions
+from assembl.lib.sqla import generic_json_many
 from assembl.models import (
     Discussion, AgentProfile, EmailAccount, User, Username)
 
@@ -37,8 +38,7 @@ def _get_agents_real(discussion, user_id=None, view_def='default'):
     num_posts_per_user = \
         AgentProfile.count_posts_in_discussion_all_profiles(discussion)
 
-    def view(agent):
-        result = agent.generic_json(view_def, user_id, permissions)
+    def view(agent, result):
         if result is None:
             return
         if include_emails or agent.id == user_id:
@@ -47,7 +47,9 @@ def _get_agents_real(discussion, user_id=None, view_def='default'):
         if post_count:
             result['post_count'] = post_count
         return result
-    return [view(agent) for agent in agents if agent is not None]
+    agents = [agent for agent in agents if agent is not None]
+    return [view(agent, result) for (agent, result) in zip(
+        agents, generic_json_many(agents, view_def, user_id, permissions))]
 
 
 @agents.get(permission=P_READ)
@@ -84,8 +84,8 @@ def _get_extracts_real(discussion, view_def='default', ids=None, user_id=None):
         Extract.text_fragment_identifiers))
     permissions = get_permissions(user_id, discussion.id)
 
-    return [extract.generic_json(view_def, user_id, permissions)
-            for extract in all_extracts]
+    return sqla.generic_json_many(
+        all_extracts, view_def, user_id, permissions)
 
 
 
@@ -14,6 +14,7 @@ from assembl.models import (
     Extract, SubGraphIdeaAssociation)
 from assembl.auth import (P_READ, P_ADD_IDEA, P_EDIT_IDEA)
 from assembl.auth.util import get_permissions
+from assembl.lib.sqla import generic_json_many
 
 ideas = Service(name='ideas', path=API_DISCUSSION_PREFIX + '/ideas',
                 description="The ideas collection",
@@ -121,9 +122,7 @@ def _get_ideas_real(discussion, view_def=None, ids=None, user_id=None):
         undefer(Idea.num_children))
 
     permissions = get_permissions(user_id, discussion.id)
-    Idea.prepare_counters(discussion.id, True)
-    retval = [idea.generic_json(view_def, user_id, permissions)
-              for idea in ideas]
+    retval = generic_json_many(ideas, view_def, user_id, permissions)
     retval = [x for x in retval if x is not None]
     for r in retval:
         if r.get('widget_links', None) is not None:
@@ -2,8 +2,11 @@
 from math import ceil
 import logging
 from collections import defaultdict
+from datetime import datetime
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 import simplejson as json
+from simplejson import JSONDecodeError
 from cornice import Service
 from pyramid.httpexceptions import (
     HTTPNotFound, HTTPUnauthorized, HTTPBadRequest)
@@ -11,11 +14,11 @@ from pyramid.i18n import TranslationStringFactory
 from pyramid.settings import asbool
 from pyramid.security import authenticated_userid, Everyone
 
-from sqlalchemy import String, text
+from sqlalchemy import String, Integer, text, case, func
 
 from sqlalchemy.orm import (
     joinedload_all, aliased, subqueryload_all, undefer)
-from sqlalchemy.sql.expression import bindparam, and_
+from sqlalchemy.sql.expression import bindparam, and_, or_
 from sqlalchemy.sql import cast, column
 from sqlalchemy.sql.functions import count
 
@@ -24,6 +27,8 @@ from jwzthreading import restrip_pat
 import transaction
 
 from assembl.lib.parsedatetime import parse_datetime
+from assembl.lib.json import StreamedJSONList
+from assembl.lib.sqla import iter_query_chunks
 from assembl.views.api import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_ADD_POST
 from assembl.auth.util import get_permissions
@@ -53,6 +58,125 @@ post_read = Service(name='post_read', path=API_DISCUSSION_PREFIX + '/post_read/{
 
 _ = TranslationStringFactory('assembl')
 
+# Number of posts loaded at once when streaming
+STREAM_CHUNK_SIZE = 200
+
+MAX_PAGE_SIZE = 500
+
+_CURSOR_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _post_sort_keys(order, cls):
+    """The (expression, descending) pairs that define the order of posts.
+
+    They always end with the id, so they can be used for keyset pagination;
+    except for the score, which is only known to the text index."""
+    if order == 'chronological':
+        return [(cls.creation_date, False), (cls.id, False)]
+    elif order == 'reverse_chronological':
+        return [(cls.creation_date, True), (cls.id, True)]
+    elif order == 'score':
+        return [(Content.body_text_index.score_name, True)]
+    elif order == 'popularity':
+        # assume reverse chronological otherwise
+        return [(cls.disagree_count - cls.like_count, False),
+                (cls.creation_date, True), (cls.id, True)]
+    return [(cls.id, False)]
+
+
+def _order_clauses(sort_keys):
+    return [expr.desc() if descending else expr
+            for (expr, descending) in sort_keys]
+
+
+def _keyset_condition(sort_keys, values):
+    """The condition selecting rows strictly after the given key values"""
+    clauses = []
+    for i, (expr, descending) in enumerate(sort_keys):
+        conditions = [
+            k == v for ((k, _), v) in zip(sort_keys[:i], values[:i])]
+        conditions.append(expr < values[i] if descending else expr > values[i])
+        clauses.append(and_(*conditions))
+    return or_(*clauses)
+
+
+def _thread_root_id(cls):
+    """The id of the first post of the thread, from the ancestry"""
+    return case([(func.coalesce(cls.ancestry, '') == '', cls.id)],
+                else_=cast(func.split_part(cls.ancestry, ',', 1), Integer))
+
+
+def _encode_cursor(order, threaded, values):
+    values = [v.strftime(_CURSOR_DATE_FORMAT) if isinstance(v, datetime)
+              else v for v in values]
+    return urlsafe_b64encode(json.dumps([order, threaded, values]))
+
+
+def _decode_cursor(cursor, order, threaded, num_keys):
+    "Decode a pagination cursor. Raises ValueError if invalid."
+    try:
+        c_order, c_threaded, values = json.loads(
+            urlsafe_b64decode(cursor.encode('ascii')))
+        if c_order != order or c_threaded != threaded:
+            raise ValueError("The cursor was created for another ordering")
+        if len(values) != num_keys:
+            raise ValueError("Wrong cursor length")
+        return [datetime.strptime(v, _CURSOR_DATE_FORMAT)
+                if isinstance(v, basestring) else v for v in values]
+    except (TypeError, UnicodeError, JSONDecodeError) as e:
+        raise ValueError(e)
+
+
+def _paginate_posts(posts, PostClass, order, threaded, cursor, page,
+                    page_size, total):
+    """Restrict the ordered posts query to a page.
+
+    Uses keyset pagination on the sort keys after a cursor, offsets
+    otherwise. In threaded mode, pages contain whole threads, and the
+    keys are those of the first post of the thread.
+    Returns the restricted query and the cursor of the next page, if any."""
+    if order == 'score':
+        # No keyset on the text index score, use offsets.
+        offset = (page - 1) * page_size
+        if cursor:
+            (offset,) = _decode_cursor(cursor, order, False, 1)
+            if not isinstance(offset, int) or offset < 0:
+                raise ValueError("Invalid offset")
+        next_cursor = None
+        if offset + page_size < total:
+            next_cursor = _encode_cursor(order, False, [offset + page_size])
+        return posts.offset(offset).limit(page_size), next_cursor
+    if threaded:
+        Root = aliased(Post)
+        sort_keys = _post_sort_keys(order, Root)
+        thread_root_ids = posts.with_entities(
+            _thread_root_id(PostClass)).order_by(None).subquery()
+        keyed = Root.default_db.query(Root).filter(
+            Root.id.in_(thread_root_ids)).order_by(
+            *_order_clauses(sort_keys))
+    else:
+        sort_keys = _post_sort_keys(order, PostClass)
+        keyed = posts
+    if cursor:
+        keyed = keyed.filter(_keyset_condition(sort_keys, _decode_cursor(
+            cursor, order, threaded, len(sort_keys))))
+    elif page > 1:
+        keyed = keyed.offset((page - 1) * page_size)
+    # One more than the page, to know if there is a next page
+    key_rows = keyed.with_entities(
+        *[expr for (expr, _) in sort_keys]).limit(page_size + 1).all()
+    next_cursor = None
+    if len(key_rows) > page_size:
+        next_cursor = _encode_cursor(
+            order, threaded, list(key_rows[page_size - 1]))
+    if threaded:
+        # the id is the last sort key
+        root_ids = [row[-1] for row in key_rows[:page_size]]
+        posts = posts.filter(_thread_root_id(PostClass).in_(root_ids))
+    else:
+        posts = keyed.limit(page_size)
+    return posts, next_cursor
+
 
 @posts.get(permission=P_READ)
 def get_posts(request):
@@ -63,6 +187,11 @@ def get_posts(request):
     is_*, is for filters that can be reversed (ex:is_unread=true returns only unread
      message, is_unread=false returns only read messages)
     order: can be chronological, reverse_chronological, popularity
+    stream: send posts as they are serialized (not with order=score)
+    page_size, cursor: paginate. Give the next_cursor of a page to get the
+     next one; page (without cursor) allows to skip directly to a page.
+    threaded: paginate on whole threads: a page is made of page_size threads,
+     with all their selected posts.
     root_post_id: all posts below the one specified.
     family_post_id: all posts below the one specified, and all its ancestors.
     post_reply_to: replies to a given post
@@ -110,6 +239,16 @@ def get_posts(request):
     if page < 1:
         page = 1
 
+    # Pagination is only applied if page_size or cursor is given.
+    cursor = request.GET.get('cursor', None)
+    paginate = cursor is not None or 'page_size' in request.GET
+    try:
+        page_size = int(request.GET.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        page_size = DEFAULT_PAGE_SIZE
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    threaded = asbool(request.GET.get('threaded', False))
+
     root_post_id = request.GET.getall('root_post_id')
     if root_post_id:
         root_post_id = get_database_id("Post", root_post_id[0])
@@ -127,6 +266,8 @@ def get_posts(request):
 
     view_def = request.GET.get('view') or 'default'
 
+    stream = asbool(request.GET.get('stream', False))
+
     only_synthesis = request.GET.get('only_synthesis')
 
     post_author_id = request.GET.get('post_author')
@@ -321,7 +462,7 @@ def get_posts(request):
         posts = posts.filter(parent_alias.creator_id == post_replies_to)
     # Post read/unread management
     is_unread = request.GET.get('is_unread')
-    translations = None
+    translations, service = None, None
     if user_id != Everyone:
         # This is horrible, but the join creates complex subqueries that
         # virtuoso cannot decode properly.
@@ -330,7 +471,9 @@ def get_posts(request):
                 ViewPost.tombstone_condition(),
                 ViewPost.actor_id == user_id,
                 *ViewPost.get_discussion_conditions(discussion_id))}
-        my_sentiments = {l.post_id: l for l in discussion.db.query(
+        my_sentiments = {l.post_id: l.generic_json(
+                             'default', user_id, permissions)
+                         for l in discussion.db.query(
             SentimentOfPost).filter(
                 SentimentOfPost.tombstone_condition(),
                 SentimentOfPost.actor_id == user_id,
@@ -365,6 +508,7 @@ def get_posts(request):
 
     # posts = posts.options(contains_eager(Post.source))
     # Horrible hack... But useful for structure load
+    eager_options = []
     if view_def == 'id_only':
         pass  # posts = posts.options(defer(Post.body))
     else:
@@ -385,33 +529,48 @@ def get_posts(request):
             sentiment_counts_by_post_id[post_id][
                 sentiment_type[SentimentOfPost.TYPE_PREFIX_LEN:]
             ] = sentiment_count
-        posts = posts.options(
+        eager_options = [
             # undefer(Post.idea_content_links_above_post),
             joinedload_all(Post.creator),
             joinedload_all(Post.extracts),
             joinedload_all(Post.widget_idea_links),
             joinedload_all(SynthesisPost.publishes_synthesis),
-            subqueryload_all(Post.attachments))
+            subqueryload_all(Post.attachments)]
         if len(discussion.discussion_locales) > 1:
-            posts = posts.options(*Content.subqueryload_options())
+            eager_options.extend(Content.subqueryload_options())
         else:
-            posts = posts.options(*Content.joinedload_options())
+            eager_options.extend(Content.joinedload_options())
 
-    if order == 'chronological':
-        posts = posts.order_by(Content.creation_date)
-    elif order == 'reverse_chronological':
-        posts = posts.order_by(Content.creation_date.desc())
-    elif order == 'score':
-        posts = posts.order_by(Content.body_text_index.score_name.desc())
-    elif order == 'popularity':
-        # assume reverse chronological otherwise
-        posts = posts.order_by(Content.disagree_count - Content.like_count, Content.creation_date.desc())
-    else:
-        posts = posts.order_by(Content.id)
+    # Counts are taken on the whole selection, before pagination.
+    counted_posts = posts
+    posts = posts.order_by(*_order_clauses(_post_sort_keys(order, PostClass)))
     # print str(posts)
 
-    no_of_posts = 0
-    no_of_posts_viewed_by_user = 0
+    next_cursor = None
+    if paginate:
+        total = counted_posts.count()
+        viewed = 0
+        if user_id != Everyone:
+            viewed = counted_posts.filter(PostClass.id.in_(
+                discussion.db.query(ViewPost.post_id).filter(
+                    ViewPost.actor_id == user_id,
+                    ViewPost.tombstone_condition()).subquery())).count()
+        try:
+            posts, next_cursor = _paginate_posts(
+                posts, PostClass, order, threaded, cursor, page, page_size,
+                total)
+        except ValueError:
+            raise HTTPBadRequest(localizer.translate(
+                _("Invalid pagination cursor")))
+
+    # Streaming works on chunks of post ids, and happens after the
+    # request transaction is over; posts cannot be preloaded or scored.
+    stream = stream and order != 'score' and deleted is not True
+    if stream:
+        post_ids_query = posts.with_entities(PostClass.id)
+    posts = posts.options(*eager_options)
+
+    counts = {"total": 0, "viewed": 0}
 
     if deleted is True:
         # We just got deleted posts, now we want their ancestors for context
@@ -429,94 +588,101 @@ def get_posts(request):
         if ancestor_ids:
             ancestors = discussion.db.query(
                 PostClass).filter(PostClass.id.in_(ancestor_ids))
-            if view_def == 'id_only':
-                pass  # ancestors = ancestors.options(defer(Post.body))
-            else:
-                ancestors = ancestors.options(
-                    # undefer(Post.idea_content_links_above_post),
-                    joinedload_all(Post.creator),
-                    joinedload_all(Post.extracts),
-                    joinedload_all(Post.widget_idea_links),
-                    joinedload_all(SynthesisPost.publishes_synthesis),
-                    subqueryload_all(Post.attachments))
-                if len(discussion.discussion_locales) > 1:
-                    ancestors = ancestors.options(
-                        *Content.subqueryload_options())
-                else:
-                    ancestors = ancestors.options(
-                        *Content.joinedload_options())
+            ancestors = ancestors.options(*eager_options)
             posts.extend(ancestors.all())
 
-    for query_result in posts:
-        score, viewpost = None, None
-        if not isinstance(query_result, (list, tuple)):
-            query_result = [query_result]
-        post = query_result[0]
-        if deleted is True:
-            add_ancestors(post)
-
-        if user_id != Everyone:
-            viewpost = post.id in read_posts
+    root_post_id = root_post.id if root_post is not None else None
+
+    def serialize_posts(posts, translations, service):
+        for query_result in posts:
+            score, viewpost = None, None
+            if not isinstance(query_result, (list, tuple)):
+                query_result = [query_result]
+            post = query_result[0]
+            if deleted is True:
+                add_ancestors(post)
+
+            if user_id != Everyone:
+                viewpost = post.id in read_posts
+                if view_def != "id_only":
+                    translate_content(
+                        post, translation_table=translations, service=service)
+            counts["total"] += 1
+            serializable_post = post.generic_json(
+                view_def, user_id, permissions) or {}
+            if order == 'score':
+                score = query_result[1]
+                serializable_post['score'] = score
+
+            if viewpost:
+                serializable_post['read'] = True
+                counts["viewed"] += 1
+            elif user_id != Everyone and root_post_id == post.id:
+                # Mark post read, we requested it explicitely
+                viewed_post = ViewPost(
+                    actor_id=user_id,
+                    post=post
+                    )
+                post.db.add(viewed_post)
+                serializable_post['read'] = True
+            else:
+                serializable_post['read'] = False
+            serializable_post['my_sentiment'] = my_sentiments.get(
+                post.id, None)
             if view_def != "id_only":
-                translate_content(
-                    post, translation_table=translations, service=service)
-        no_of_posts += 1
-        serializable_post = post.generic_json(
-            view_def, user_id, permissions) or {}
-        if order == 'score':
-            score = query_result[1]
-            serializable_post['score'] = score
-
-        if viewpost:
-            serializable_post['read'] = True
-            no_of_posts_viewed_by_user += 1
-        elif user_id != Everyone and root_post is not None and root_post.id == post.id:
-            # Mark post read, we requested it explicitely
-            viewed_post = ViewPost(
-                actor_id=user_id,
-                post=root_post
-                )
-            discussion.db.add(viewed_post)
-            serializable_post['read'] = True
+                serializable_post['indirect_idea_content_links'] = (
+                    post.indirect_idea_content_links_with_cache(
+                        ideaContentLinkCache.get(post.id, None)))
+                serializable_post['sentiment_counts'] = sentiment_counts_by_post_id[post.id]
+
+            yield serializable_post
+
+    def page_data():
+        data = {}
+        data["page"] = page
+        if paginate:
+            data["unread"] = total - viewed
+            data["total"] = total
+            data["next_cursor"] = next_cursor
         else:
-            serializable_post['read'] = False
-        my_sentiment = my_sentiments.get(post.id, None)
-        if my_sentiment is not None:
-            my_sentiment = my_sentiment.generic_json('default', user_id, permissions)
-        serializable_post['my_sentiment'] = my_sentiment
-        if view_def != "id_only":
-            serializable_post['indirect_idea_content_links'] = (
-                post.indirect_idea_content_links_with_cache(
-                    ideaContentLinkCache.get(post.id, None)))
-            serializable_post['sentiment_counts'] = sentiment_counts_by_post_id[post.id]
-
-        post_data.append(serializable_post)
-
-    # Benoitg:  For now, this completely garbles threading without intelligent
-    #handling of pagination.  Disabling
-    #posts = posts.limit(page_size).offset(data['startIndex']-1)
-    # This code isn't up to date.  If limiting the query by page, we need to 
-    # calculate the counts with a separate query to have the right number of 
-    # results
-    #no_of_messages_viewed_by_user = discussion.db.query(ViewPost).join(
-    #    Post
-    #).filter(
-    #    Post.discussion_id == discussion_id,
-    #    ViewPost.actor_id == user_id,
-    #).count() if user_id else 0
-
-    data = {}
-    data["page"] = page
-    data["unread"] = no_of_posts - no_of_posts_viewed_by_user
-    data["total"] = no_of_posts
-    data["maxPage"] = max(1, ceil(float(data["total"])/page_size))
-    #TODO:  Check if we want 1 based index in the api
-    data["startIndex"] = (page_size * page) - (page_size-1)
-
-    if data["page"] == data["maxPage"]:
-        data["endIndex"] = data["total"]
-    else:
-        data["endIndex"] = data["startIndex"] + (page_size-1)
+            data["unread"] = counts["total"] - counts["viewed"]
+            data["total"] = counts["total"]
+        data["maxPage"] = max(1, ceil(float(data["total"])/page_size))
+        #TODO:  Check if we want 1 based index in the api
+        data["startIndex"] = (page_size * page) - (page_size-1)
+
+        if data["page"] == data["maxPage"]:
+            data["endIndex"] = data["total"]
+        else:
+            data["endIndex"] = data["startIndex"] + (page_size-1)
+        return data
+
+    if stream:
+        def stream_posts():
+            # The request transaction is committed before the response
+            # body is produced, so this runs in its own transaction.
+            with transaction.manager:
+                translations, service = None, None
+                if user_id != Everyone and view_def != "id_only":
+                    service = Discussion.get(discussion_id).translation_service()
+                    if service:
+                        translations = PrefCollectionTranslationTable(
+                            service, LanguagePreferenceCollection.getCurrent(
+                                request, refresh=True))
+                for chunk_ids in iter_query_chunks(
+                        post_ids_query, STREAM_CHUNK_SIZE):
+                    chunk_ids = [id for (id,) in chunk_ids]
+                    chunk = {post.id: post for post in Post.default_db.query(
+                        PostClass).filter(PostClass.id.in_(chunk_ids)
+                        ).options(*eager_options)}
+                    for serializable_post in serialize_posts(
+                            [chunk[id] for id in chunk_ids if id in chunk],
+                            translations, service):
+                        yield serializable_post
+        return StreamedJSONList(stream_posts(), "posts", page_data)
+
+    post_data = list(serialize_posts(posts, translations, service))
+    data = page_data()
     data["posts"] = post_data
 
     return data
@@ -10,6 +10,7 @@ from assembl.models import Discussion
 
 from assembl.auth import P_READ
 from assembl.auth.util import get_permissions
+from assembl.lib.sqla import generic_json_many
 
 sources = Service(
     name='sources',
@@ -33,6 +34,5 @@ def get_sources(request):
     user_id = authenticated_userid(request) or Everyone
     permissions = get_permissions(user_id, discussion_id)
 
-    res = [source.generic_json(view_def, user_id, permissions)
-           for source in discussion.sources]
+    res = generic_json_many(discussion.sources, view_def, user_id, permissions)
     return [x for x in res if x is not None]
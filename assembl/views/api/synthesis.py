@@ -8,6 +8,7 @@ from cornice import Service
 from . import API_DISCUSSION_PREFIX
 from assembl.auth import P_READ, P_EDIT_SYNTHESIS
 from assembl.auth.util import get_permissions
+from assembl.lib.sqla import generic_json_many
 from assembl.models import Discussion, Synthesis
 
 syntheses = Service(name='syntheses',
@@ -29,8 +30,7 @@ def get_syntheses(request):
     permissions = get_permissions(user_id, discussion_id)
     syntheses = discussion.get_all_syntheses()
     view_def = request.GET.get('view') or 'default'
-    res = [synthesis.generic_json(view_def, user_id, permissions)
-           for synthesis in syntheses]
+    res = generic_json_many(syntheses, view_def, user_id, permissions)
     return [x for x in res if x is not None]
 
 
@@ -49,8 +49,11 @@ from pyramid.security import authenticated_userid, Everyone
 from pyramid.response import Response
 from pyramid.settings import asbool
 from simplejson import dumps
+import transaction
 
-from assembl.lib.sqla import ObjectNotUniqueError
+from assembl.lib.sqla import (
+    ObjectNotUniqueError, generic_json_many, iter_query_chunks)
+from assembl.lib.json import StreamedJSONList
 from ..traversal import (
     InstanceContext, CollectionContext, ClassContext, Api2Context)
 from assembl.auth import (
@@ -69,6 +72,8 @@ API_PREFIX = '/data/'
 FORM_HEADER = "Content-Type:(application/x-www-form-urlencoded)|(multipart/form-data)"
 JSON_HEADER = "Content-Type:application/(.*\+)?json"
 MULTIPART_HEADER = "Content-Type:multipart/form-data"
+# Number of instances loaded at once when streaming a collection
+STREAM_CHUNK_SIZE = 200
 
 
 def check_permissions(
@@ -109,7 +114,7 @@ def class_view(request):
     if view == 'id_only':
         return [ctx._class.uri_generic(x) for (x,) in q.all()]
     else:
-        r = [i.generic_json(view, user_id, permissions) for i in q.all()]
+        r = generic_json_many(q.all(), view, user_id, permissions)
         return [x for x in r if x is not None]
 
 
@@ -179,11 +184,26 @@ def collection_view(request, default_view='default'):
         q = ctx.get_target_class().restrict_to_owners(q, user_id)
     if view == 'id_only':
         return [ctx.collection_class.uri_generic(x) for (x,) in q.all()]
+    elif asbool(request.GET.get('stream', False)):
+        return StreamedJSONList(stream_collection(
+            q, view, user_id, permissions))
     else:
-        res = [i.generic_json(view, user_id, permissions) for i in q.all()]
+        res = generic_json_many(q.all(), view, user_id, permissions)
         return [x for x in res if x is not None]
 
 
+def stream_collection(query, view, user_id, permissions):
+    """Serialize the query results by chunks, for :py:class:`StreamedJSONList`.
+
+    The request transaction is committed before the response body is
+    produced, so this runs in its own transaction."""
+    with transaction.manager:
+        for chunk in iter_query_chunks(query, STREAM_CHUNK_SIZE):
+            for json in generic_json_many(chunk, view, user_id, permissions):
+                if json is not None:
+                    yield json
+
+
 def collection_add(request, args):
     ctx = request.context
     user_id = authenticated_userid(request) or Everyone
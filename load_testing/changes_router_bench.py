@@ -0,0 +1,178 @@
+"""Measure how the changes router scales with its number of workers.
+
+For each worker count, this starts the changes router with a copy of the
+configuration, opens many websocket connections to a discussion from a few
+client processes, publishes changes as the web server would, and reports
+how many frames per second reached the clients, with their latency.
+
+The web server must be running, as the router checks read permissions:
+the discussion must be readable by the given user (by default, everyone).
+
+usage: python load_testing/changes_router_bench.py development.ini \\
+    --discussion 1 --workers 1 2 4
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from uuid import uuid4
+from ConfigParser import RawConfigParser
+from multiprocessing import Process, Queue
+from tempfile import NamedTemporaryFile
+
+import zmq
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from assembl.auth import Everyone
+from assembl.lib.web_token import encode_token
+
+SECTION = 'app:assembl'
+
+
+def make_token(secret, user_id):
+    return encode_token({
+        'consumerKey': 'assembl', 'userId': user_id, 'ttl': 86400}, secret)
+
+
+def run_clients(url, token, discussion, num_connections, duration, queue):
+    """Open connections, wait for changes and report when each one was
+    sent and received."""
+    deliveries = []
+    connected = [0]
+
+    @gen.coroutine
+    def client():
+        # A SockJS session over websocket
+        connection = yield websocket_connect(
+            '%s/0/%s/websocket' % (url, uuid4().hex))
+        connection.write_message(json.dumps(["token:" + token]))
+        connection.write_message(json.dumps(["discussion:" + discussion]))
+        while True:
+            frame = yield connection.read_message()
+            if frame is None:
+                break
+            # SockJS frames: o (open), h (heartbeat), a[...] (messages)
+            if not frame.startswith('a'):
+                continue
+            now = time.time()
+            for message in json.loads(frame[1:]):
+                for change in json.loads(message):
+                    if change.get('@type') == 'Connection':
+                        connected[0] += 1
+                        if connected[0] == num_connections:
+                            queue.put(('ready', None))
+                    elif change.get('@type') == 'LoadTest':
+                        deliveries.append((change['sent'], now))
+
+    loop = IOLoop.current()
+    for i in range(num_connections):
+        loop.spawn_callback(client)
+    loop.call_later(duration, loop.stop)
+    loop.start()
+    queue.put(('done', deliveries))
+
+
+def publish(changes_socket, discussion, num_messages, rate):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.PUB)
+    socket.connect(changes_socket)
+    # Let subscriptions reach us
+    time.sleep(1)
+    start = time.time()
+    for order in range(num_messages):
+        change = {"@type": "LoadTest", "@id": "local:LoadTest/%d" % order,
+                  "sent": time.time()}
+        socket.send_multipart(
+            [discussion, str(order), json.dumps([change])])
+        delay = start + float(order + 1) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    socket.close()
+
+
+def bench(args, settings, workers):
+    settings.set(SECTION, 'changes.websocket.workers', str(workers))
+    with NamedTemporaryFile(suffix='.ini', delete=False) as config:
+        settings.write(config)
+    router = subprocess.Popen(
+        [sys.executable, 'assembl/tasks/changes_router.py', config.name],
+        preexec_fn=os.setsid)
+    try:
+        time.sleep(2)
+        url = 'ws://localhost:%d%s' % (
+            settings.getint(SECTION, 'changes.websocket.port'),
+            settings.get(SECTION, 'changes.prefix'))
+        token = make_token(
+            settings.get(SECTION, 'session.secret'), args.user_id)
+        duration = 10 + float(args.messages) / args.rate
+        queue = Queue()
+        per_process = args.connections // args.client_processes
+        clients = [Process(target=run_clients, args=(
+            url, token, args.discussion, per_process, duration, queue))
+            for i in range(args.client_processes)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            queue.get(timeout=duration)
+        start = time.time()
+        publish(settings.get(SECTION, 'changes.socket'), args.discussion,
+                args.messages, args.rate)
+        deliveries = []
+        for client in clients:
+            kind, values = queue.get()
+            while kind != 'done':
+                kind, values = queue.get()
+            deliveries.extend(values)
+        for client in clients:
+            client.join()
+        expected = args.messages * per_process * args.client_processes
+        if not deliveries:
+            print "%d workers: no frame delivered" % (workers,)
+            return
+        latencies = sorted(received - sent for (sent, received) in deliveries)
+        elapsed = max(received for (_, received) in deliveries) - start
+        print "%d workers: %d/%d frames delivered, %.0f frames/s, " \
+            "latency median %.1fms, 95%% %.1fms" % (
+                workers, len(deliveries), expected,
+                len(deliveries) / elapsed,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 95 // 100] * 1000)
+    finally:
+        os.killpg(router.pid, signal.SIGTERM)
+        router.wait()
+        os.unlink(config.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how the changes router scales with workers.")
+    parser.add_argument("configuration", help="configuration file")
+    parser.add_argument("--discussion", required=True,
+                        help="id of a discussion readable by the user")
+    parser.add_argument("--user-id", default=Everyone,
+                        help="user id of the connections")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4],
+                        help="worker counts to compare")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="number of websocket connections")
+    parser.add_argument("--client-processes", type=int, default=4,
+                        help="number of processes opening connections")
+    parser.add_argument("--messages", type=int, default=500,
+                        help="number of changesets to publish")
+    parser.add_argument("--rate", type=float, default=50,
+                        help="changesets published per second")
+    args = parser.parse_args()
+    settings = RawConfigParser()
+    settings.read(args.configuration)
+    for workers in args.workers:
+        bench(args, settings, workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Measure the quote stripping of imported mail on a corpus of real mails.
+
+The corpus is made of the text/plain and text/html parts of the messages
+of the given maildirs (by default, the Jack Layton test fixture).
+Each part goes through the quote stripping that the import applies, and
+the time per part is reported for plain text and HTML.
+
+To check that a change does not change the output, save the results before
+the change and compare them after:
+
+usage: python load_testing/quote_stripping_bench.py --save before.json
+       (apply the change)
+       python load_testing/quote_stripping_bench.py --compare before.json
+"""
+import argparse
+import email
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from assembl.models.mail import AbstractMailbox
+
+DEFAULT_CORPUS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'assembl', 'tests', 'fixtures', 'jack_layton_fixtures_maildir')
+
+
+def read_corpus(maildirs):
+    """The (name, mime type, decoded body) of the text parts of the mails."""
+    parts = []
+    for maildir in maildirs:
+        for folder in ('cur', 'new'):
+            path = os.path.join(maildir, folder)
+            if not os.path.isdir(path):
+                continue
+            for filename in sorted(os.listdir(path)):
+                with open(os.path.join(path, filename)) as f:
+                    message = email.message_from_file(f)
+                default_charset = message.get_charset() or 'ISO-8859-1'
+                for index, part in enumerate(message.walk()):
+                    mime_type = part.get_content_type()
+                    if mime_type not in ('text/plain', 'text/html'):
+                        continue
+                    body = part.get_payload(decode=True).decode(
+                        part.get_content_charset(default_charset), 'replace')
+                    parts.append((
+                        "%s/%s/%s#%d" % (maildir, folder, filename, index),
+                        mime_type, body))
+    return parts
+
+
+def strip(mime_type, body):
+    if mime_type == 'text/html':
+        return AbstractMailbox.strip_full_message_quoting_html(body)
+    return AbstractMailbox.strip_full_message_quoting_plaintext(body)
+
+
+def bench(parts, repeat):
+    results = {}
+    for mime_type in ('text/plain', 'text/html'):
+        bodies = [(name, body) for (name, part_type, body) in parts
+                  if part_type == mime_type]
+        if not bodies:
+            continue
+        start = time.time()
+        for i in range(repeat):
+            for (name, body) in bodies:
+                results[name] = strip(mime_type, body)
+        elapsed = time.time() - start
+        print "%s: %d parts, %.3fms per part" % (
+            mime_type, len(bodies), elapsed * 1000 / (repeat * len(bodies)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the quote stripping of imported mail.")
+    parser.add_argument("maildirs", nargs='*', default=[DEFAULT_CORPUS],
+                        help="maildirs of the corpus")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="number of passes over the corpus")
+    parser.add_argument("--save", help="save the results in this file")
+    parser.add_argument("--compare",
+                        help="compare the results with those of this file")
+    args = parser.parse_args()
+    results = bench(read_corpus(args.maildirs), args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f)
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        different = sorted(
+            name for name in set(reference) | set(results)
+            if reference.get(name, None) != results.get(name, None))
+        for name in different:
+            print "Different output for", name
+        print "%d/%d parts with the same output" % (
+            len(results) - len(different), len(results))
+        if different:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()